@@ -14,14 +14,18 @@ def calc_anom_score(feat_data, gmm_model):
 
 
 def analyse_audio_file(model_file_path: str, features_file_path: str):
-    
+    return analyse_features(model_file_path, np.load(features_file_path))
+
+
+def analyse_features(model_file_path: str, aud_feats: np.ndarray):
+    '''
+    Find anomalies in the 960ms vggish features of a clip
+    '''
     # Load the GMM model which has been fit to 5 days of audio
     print('Loading DP-GMM model from file')
     with open(model_file_path, 'rb') as handle:
         (dp_gmm_model, anom_threshold) = pickle.load(handle)
 
-    aud_feats = np.load(features_file_path)
-
     # Calculate anomaly scores per 0.96s chunk of audio
     anom_scores = calc_anom_score(aud_feats, dp_gmm_model)
 
@@ -1,21 +1,54 @@
 import hashlib
 import os
-from concurrent.futures import TimeoutError
 
-from google.cloud import pubsub_v1
+from bugg_runtime import (ackMessage, downloadFromCloudStorage,
+                          getAudioDBRecord, getDb, getDocument, getRecorder,
+                          inferenceSlot, invalidateDocument,
+                          markAnalysisComplete, shouldSkip, subscribe,
+                          timeStage)
+from bugg_runtime.readcache import DOC_CACHE_SECS
+from google.cloud import firestore
 
-from bugg import *
-from calc_anomaly_scores import analyse_audio_file
+from calc_anomaly_scores import analyse_audio_file, analyse_features
 from utils import *
 
 subscription_id = "analyses.anomaly-detection-sub"
+# Completed models never change, so they can be cached for much longer than the pending ones
+complete_model_cache_secs = int(os.environ.get("BUGG_COMPLETE_MODEL_CACHE_SECS", "3600"))
 analysis_id = "anomaly-detection"
+# Runs on the features vggish produces. The fused runner chains it straight after vggish using process_upstream
+trigger = "vggish"
 
 def on_process_audio_features(model_file_path: str, features_file_path: str, audio_id: str, audio_rec: dict):
     
     print(f"PROCESSING audioId={audio_id} {model_file_path} {features_file_path}")
     
-    results = analyse_audio_file(model_file_path, features_file_path)
+    with inferenceSlot(), timeStage("inference"):
+        results = analyse_audio_file(model_file_path, features_file_path)
+
+    save_results(audio_id, results)
+
+
+def process_upstream(audio_id: str, audio_rec: dict, vggish_results: dict):
+    """
+    Entry point for the fused runner, which hands over vggish's features in memory rather than via cloud storage
+    """
+    model_rec = get_or_create_model(audio_rec)
+    if model_rec is None:
+        # The model training job will publish the clip again once the model is ready
+        return
+
+    model_file_path = downloadFromCloudStorage(model_rec["uri"], f"/tmp/{model_rec['filename']}")
+
+    print(f"PROCESSING audioId={audio_id} {model_file_path} with vggish features from memory")
+
+    with inferenceSlot(), timeStage("inference"):
+        results = analyse_features(model_file_path, vggish_results["raw_audioset_feats_960ms"])
+
+    save_results(audio_id, results)
+
+
+def save_results(audio_id: str, results: list):
     print(len(results), "results", results)
 
     detections = []
@@ -41,6 +74,13 @@ def on_process_audio_features(model_file_path: str, features_file_path: str, aud
 
     print(f"{audio_id} completed with {len(detections)} detections")
 
+def model_cache_secs(model_rec):
+    # A pending model is only cached briefly so we notice when it flips to complete
+    if model_rec is not None and model_rec["status"] == "complete":
+        return complete_model_cache_secs
+    return DOC_CACHE_SECS
+
+
 def get_or_create_model(audio_rec):
     """
     Will return the record from Firebase or create the record and return None.
@@ -58,10 +98,10 @@ def get_or_create_model(audio_rec):
 
     db = getDb()
 
-    model_rec = db.collection("analyses").document("anomaly-detection") \
-        .collection("models").document(model_info["id"]).get()
+    model_path = f"analyses/anomaly-detection/models/{model_info['id']}"
+    item = getDocument(model_path, ttlSecs=model_cache_secs)
 
-    if not model_rec.exists:
+    if item is None:
         print(f"Model {model_info['id']} needs to be created. Deferring processing")
         # create the record in firebase    <--    this is a lock. May need a mechanism to retry these?
         db.collection("analyses").document("anomaly-detection") \
@@ -80,10 +120,9 @@ def get_or_create_model(audio_rec):
                 u"uri": model_info["uri"],
                 u"status": "pending"
             }, merge=True)
+        invalidateDocument(model_path)
         return None
     else:
-        item = model_rec.to_dict()
-
         if item["status"] == "complete":
             return item
             
@@ -96,7 +135,14 @@ def on_message(message):
     audio_id = message.data.decode("utf-8") 
 
     # Fetch the database record we have for this audio clip
-    audio_rec = getAudioDBRecord(audio_id)
+    with timeStage("fetch_record"):
+        audio_rec = getAudioDBRecord(audio_id)
+
+    # Redeliveries and resubmitted windows don't need the model and features downloading again
+    if shouldSkip(message, [analysis_id], audio_id, audio_rec):
+        ackMessage(message)
+        print(f"Skipping {audio_id} as {analysis_id} already completed it")
+        return
 
     # Ensure the vggish processing has been completed. We'll be downloading the features later.
     if "vggish" not in audio_rec["analysesPerformed"]:
@@ -125,32 +171,13 @@ def on_message(message):
         # Maybe it is better to keep them around. The preemptable VMs we use will likely restart before the disk is full.
         # os.remove(model_file_path)
 
-    message.ack()
+    # Held back until the completion is committed when write-behind is on
+    ackMessage(message)
     print(f"Processing complete for {audio_id}")
 
 
 def start():
-    project_id = "bugg-301712"
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, subscription_id)
-
-    # Limit the subscriber to only have one outstanding message at a time.
-    flow_control = pubsub_v1.types.FlowControl(max_messages=1)
-
-    streaming_pull_future = subscriber.subscribe(
-        subscription_path, callback=on_message, flow_control=flow_control
-    )
-    print(f"Listening for messages on {subscription_path}..\n")
-
-    # Wrap subscriber in a 'with' block to automatically call close() when done.
-    with subscriber:
-        try:
-            # When `timeout` is not set, result() will block indefinitely,
-            # unless an exception is encountered first.
-            streaming_pull_future.result()
-        except TimeoutError:
-            streaming_pull_future.cancel()  # Trigger the shutdown.
-            streaming_pull_future.result()  # Block until the shutdown is complete.
+    subscribe(subscription_id, on_message, analysisId=analysis_id)
 
 
 if __name__ == "__main__":
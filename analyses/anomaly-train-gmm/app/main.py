@@ -4,14 +4,14 @@ from concurrent import futures
 from concurrent.futures import TimeoutError
 
 import dateutil.parser
-from firebase_admin import firestore
+from bugg_runtime import (PROJECT_ID, getDb, getPublisherClient,
+                          getSubscriberClient)
+from bugg_runtime.lanes import BULK_LANE, bulkTopic
 from google.api_core import retry
-from google.cloud import pubsub_v1
+from google.cloud import firestore, pubsub_v1
 
-from bugg import getDb
 from train_model import train_gmm_model
 
-project_id = "bugg-301712"
 subscription_id = "analyses.anomaly-train-gmm-sub"
 
 def on_message(message):
@@ -78,8 +78,10 @@ def on_message(message):
         .where("uploadedAt", ">=", from_date).where("uploadedAt", "<=", to_date).order_by(u"uploadedAt", direction=firestore.Query.ASCENDING).get()
 
     print(f"Submitting {len(docs)} audio records to be processed")
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(project_id, "analyses.anomaly-detection")
+    publisher = getPublisherClient()
+    # A whole window of audio is a backfill, so it goes in the bulk lane when there is one rather than ahead of new uploads
+    topic = "analyses.anomaly-detection"
+    topic_path = publisher.topic_path(PROJECT_ID, bulkTopic(topic) if BULK_LANE else topic)
     publish_futures = []
 
     # Resolve the publish future in a separate thread.
@@ -104,9 +106,8 @@ def on_message(message):
 
 
 def start():
-    project_id = "bugg-301712"
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, subscription_id)
+    subscriber = getSubscriberClient()
+    subscription_path = subscriber.subscription_path(PROJECT_ID, subscription_id)
 
     # Wrap the subscriber in a 'with' block to automatically call close() to
     # close the underlying gRPC channel when done.
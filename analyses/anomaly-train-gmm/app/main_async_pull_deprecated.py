@@ -4,10 +4,9 @@ from concurrent import futures
 from concurrent.futures import TimeoutError
 
 import dateutil.parser
-from firebase_admin import firestore
-from google.cloud import pubsub_v1
+from bugg_runtime import getDb
+from google.cloud import firestore, pubsub_v1
 
-from bugg import getDb
 from train_model import train_gmm_model
 
 project_id = "bugg-301712"
@@ -5,11 +5,10 @@ import time
 from concurrent import futures
 
 import dateutil.parser
-from firebase_admin import firestore
+from bugg_runtime import getDb
 from google.api_core import retry
-from google.cloud import pubsub_v1
+from google.cloud import firestore, pubsub_v1
 
-from bugg import getDb
 from train_model import train_gmm_model
 
 multiprocessing.log_to_stderr()
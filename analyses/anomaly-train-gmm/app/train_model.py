@@ -5,8 +5,8 @@ from timeit import default_timer as timer
 
 import dateutil.parser
 import numpy as np
-from firebase_admin import firestore, storage
-from google.cloud import storage as gcstorage
+from bugg_runtime import getBucket, getDb
+from google.cloud import firestore
 from joblib import Parallel, delayed
 from sklearn.mixture import BayesianGaussianMixture
 
@@ -18,9 +18,8 @@ def download_features(docId, vggish_performed, project, features_folder, bucket_
         bucket_path = f'artifacts/vggish/{project}/{docId}/raw_audioset_feats_960ms.npy'
         local_path = os.path.join(features_folder, f"{docId}_raw_audioset_feats_960ms.npy")         
 
-        storage_client = gcstorage.Client()
-
-        bucket = storage_client.bucket(bucket_name)
+        # Each joblib worker process builds its client once and reuses it for every file
+        bucket = getBucket(bucket_name)
         blob = bucket.blob(bucket_path)
         blob.download_to_filename(local_path)
 
@@ -49,10 +48,10 @@ def train_gmm_model(project: str, recorder: str, from_iso_date: str, to_iso_date
     os.makedirs(features_folder)
 
     bucket_name = "bugg-301712.appspot.com"
-    bucket = storage.bucket(bucket_name)
+    bucket = getBucket(bucket_name)
 
     # get the audio records from firestore for this date range
-    db = firestore.client()
+    db = getDb()
     audio_col_ref = db.collection(u'audio')
     docs = audio_col_ref.where(u'project', u'==', project).where(u'recorder', u'==', recorder).where("uploadedAt",">=",from_date).where("uploadedAt","<=",to_date).order_by("uploadedAt",  direction=firestore.Query.DESCENDING).stream()
 
@@ -12,10 +12,15 @@ except:
 import argparse
 import math
 import operator
+import threading
 import time
 
 import librosa
 import numpy as np
+from bugg_runtime import timeStage
+
+# Found relative to this file so the model loads from any working directory (e.g. in the fused runner)
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model')
 
 
 def loadModel():
@@ -28,7 +33,7 @@ def loadModel():
     print('LOADING TF LITE MODEL...', end=' ')
 
     # Load TFLite model and allocate tensors.
-    interpreter = tflite.Interpreter(model_path='model/BirdNET_6K_GLOBAL_MODEL.tflite')
+    interpreter = tflite.Interpreter(model_path=os.path.join(MODEL_DIR, 'BirdNET_6K_GLOBAL_MODEL.tflite'))
     interpreter.allocate_tensors()
 
     # Get input and output tensors.
@@ -42,7 +47,7 @@ def loadModel():
 
     # Load labels
     CLASSES = []
-    with open('model/labels.txt', 'r') as lfile:
+    with open(os.path.join(MODEL_DIR, 'labels.txt'), 'r') as lfile:
         for line in lfile.readlines():
             CLASSES.append(line.replace('\n', ''))
 
@@ -81,12 +86,17 @@ def splitSignal(sig, rate, overlap, seconds=3.0, minlen=1.5):
 
     return sig_splits
 
-def readAudioData(path, overlap, sample_rate=48000):
+# The rate the model was trained at
+SAMPLE_RATE = 48000
+
+
+def readAudioData(path, overlap, sample_rate=SAMPLE_RATE):
 
     print('READING AUDIO DATA...', end=' ', flush=True)
 
     # Open file with librosa (uses ffmpeg or libav)
-    sig, rate = librosa.load(path, sr=sample_rate, mono=True, res_type='kaiser_fast')
+    with timeStage('decode'):
+        sig, rate = librosa.load(path, sr=sample_rate, mono=True, res_type='kaiser_fast')
 
     # Split audio into 3-second chunks
     chunks = splitSignal(sig, rate, overlap)
@@ -158,7 +168,8 @@ def analyzeAudioData(chunks, lat, lon, week, sensitivity, overlap, interpreter):
         sig = np.expand_dims(c, 0)
 
         # Make prediction
-        p = predict([sig, mdata], interpreter, sensitivity)
+        with timeStage('inference'):
+            p = predict([sig, mdata], interpreter, sensitivity)
 
         # Save result and timestamp
         pred_end = pred_start + 3.0
@@ -185,23 +196,41 @@ def writeResultsToFile(detections, min_conf, path):
 
 # Load model
 interpreter = None
+# The interpreter isn't thread safe, so it is loaded once and used by one message at a time
+interpreter_lock = threading.Lock()
 
 
 def analyseAudioFile(file_path: str, week_of_year: int, lat: float, lon: float, minimum_confidence_threshold: float):
     global WHITE_LIST
     WHITE_LIST = []
 
-    global interpreter
-    if interpreter == None:
-        interpreter = loadModel()
-
     # Read audio data
     audioData = readAudioData(file_path, 0.0)
 
+    return analyseChunks(audioData, week_of_year, lat, lon, minimum_confidence_threshold)
+
+
+def analyseWaveform(sig, week_of_year: int, lat: float, lon: float, minimum_confidence_threshold: float):
+    """
+    As analyseAudioFile, for audio already decoded to mono at SAMPLE_RATE (e.g. by the fused runner)
+    """
+    global WHITE_LIST
+    WHITE_LIST = []
+
+    return analyseChunks(splitSignal(sig, SAMPLE_RATE, 0.0), week_of_year, lat, lon, minimum_confidence_threshold)
+
+
+def analyseChunks(audioData, week_of_year: int, lat: float, lon: float, minimum_confidence_threshold: float):
+    global interpreter
+
     # Process audio data and get detections
     week = max(1, min(week_of_year, 48))
     sensitivity = 1.0
-    detections = analyzeAudioData(audioData, lat, lon, week, sensitivity, 0.0, interpreter)
+    with interpreter_lock:
+        if interpreter == None:
+            interpreter = loadModel()
+
+        detections = analyzeAudioData(audioData, lat, lon, week, sensitivity, 0.0, interpreter)
 
     # Write detections to output file
     min_conf = max(0.01, min(minimum_confidence_threshold, 0.99))   
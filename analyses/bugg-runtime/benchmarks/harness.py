@@ -0,0 +1,210 @@
+"""
+Running a worker in-process against the local backend, for the benchmarks and load tests.
+
+Import this before bugg_runtime (or anything that imports it) so BUGG_BACKEND defaults to local.
+"""
+import datetime
+import importlib.util
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+os.environ.setdefault("BUGG_BACKEND", "local")
+os.environ.setdefault("BUGG_LOCAL_STORAGE_DIR", tempfile.mkdtemp(prefix="bugg-bench-"))
+
+import numpy as np
+from google.cloud.firestore import DELETE_FIELD, GeoPoint
+
+from bugg_runtime import BACKEND, BUCKET_NAME, getBucket, getDb
+
+ANALYSES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+BUNDLED_CLIP = os.path.join(ANALYSES_DIR, "birdnet-lite", "app", "example", "XC563936 - Soundscape.mp3")
+
+# Workers that take an audio id and run on_process_audio through an AudioPipeline
+WORKERS = ["vggish", "birdnet-lite", "human-speech-filtering", "fused"]
+
+PROJECT = "bench-project"
+RECORDER = "bench-recorder"
+
+
+def loadWorker(name: str):
+    """
+    Imports a worker's main.py from its app directory, the way its image runs it
+    """
+    if BACKEND != "local":
+        raise RuntimeError("Refusing to run a worker against the real backend, set BUGG_BACKEND=local")
+
+    if name == "fused":
+        # The fused image keeps each analysis's app under one directory, so link them up the same way
+        fusedDir = tempfile.mkdtemp(prefix="bugg-fused-")
+        for analysis in ["vggish", "birdnet-lite", "anomaly-detection", "human-speech-filtering"]:
+            os.symlink(os.path.join(ANALYSES_DIR, analysis, "app"), os.path.join(fusedDir, analysis))
+        os.environ.setdefault("FUSED_ANALYSES_DIR", fusedDir)
+
+    appDir = os.path.join(ANALYSES_DIR, name, "app")
+    sys.path.insert(0, appDir)
+    spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_main", os.path.join(appDir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthesiseClip(path: str, secs: float, sampleRate: int = 48000, seed: int = 0):
+    """
+    Writes a mono 16-bit WAV of background noise with a few bird-like chirps over it
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(secs * sampleRate)) / sampleRate
+    signal = 0.05 * rng.randn(len(t))
+    for start in rng.uniform(0, max(secs - 1, 0), size=int(secs / 5) + 1):
+        chirp = (t >= start) & (t < start + 0.5)
+        signal[chirp] += 0.3 * np.sin(2 * np.pi * (3000 + 4000 * (t[chirp] - start)) * (t[chirp] - start))
+
+    samples = (np.clip(signal, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sampleRate)
+        f.writeframes(samples.tobytes())
+
+
+def fixtureClips(paths: list = None, syntheticSecs: list = ()) -> list:
+    """
+    The clips to run: the given files (the bundled soundscape by default) and synthetic ones of each length
+    """
+    clips = list(paths) if paths else [BUNDLED_CLIP]
+    for secs in syntheticSecs:
+        path = os.path.join(tempfile.gettempdir(), f"bugg-synthetic-{secs:g}s.wav")
+        if not os.path.exists(path):
+            synthesiseClip(path, secs)
+        clips.append(path)
+    return clips
+
+
+def stageClips(clips: list, count: int, prefix: str = "clip", audioIds: list = None) -> list:
+    """
+    Uploads the clips to the local bucket and creates count audio records cycling through
+    them, each with its own id (or those given). Returns the ids.
+    """
+    db = getDb()
+    bucket = getBucket()
+    uploadedAt = datetime.datetime(2022, 6, 1, tzinfo=datetime.timezone.utc)
+
+    uris = []
+    for i, clip in enumerate(clips):
+        name = f"audio/{PROJECT}/{RECORDER}/fixture-{i}{os.path.splitext(clip)[1]}"
+        bucket.blob(name).upload_from_filename(clip)
+        uris.append(f"gs://{BUCKET_NAME}/{name}")
+
+    db.document(f"projects/{PROJECT}/recorders/{RECORDER}").set({"createdAt": uploadedAt - datetime.timedelta(days=60)})
+
+    audioIds = list(audioIds) if audioIds else [f"{prefix}-{i}" for i in range(count)]
+    for i, audioId in enumerate(audioIds):
+        db.collection("audio").document(audioId).set({
+            "id": audioId,
+            "uri": uris[i % len(uris)],
+            "project": PROJECT,
+            "recorder": RECORDER,
+            "uploadedAt": uploadedAt + datetime.timedelta(minutes=5 * i),
+            "location": GeoPoint(51.5, -0.12),
+            "analysesPerformed": [],
+            "detections": [],
+        })
+    return audioIds
+
+
+def resetRecord(audioId: str):
+    """
+    Clears the analyses' results off a staged record so it can be processed again
+    """
+    getDb().collection("audio").document(audioId).update({
+        "analysesPerformed": [],
+        "detections": [],
+        "hasDetections": DELETE_FIELD,
+        "detectionCount": DELETE_FIELD,
+        "detectionCounts": DELETE_FIELD,
+    })
+
+
+class BenchMessage():
+    """
+    Stands in for a Pub/Sub message, recording when it was acked or nacked
+    """
+
+    def __init__(self, messageId: str, data: bytes):
+        self.message_id = messageId
+        self.data = data
+        self.attributes = {}
+        self.delivery_attempt = 1
+        self.started = None
+        self.settled = None
+        self.acked = None
+        self._done = threading.Event()
+
+    def ack(self):
+        self._settle(True)
+
+    def nack(self):
+        self._settle(False)
+
+    def modify_ack_deadline(self, seconds: int):
+        pass
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def latency(self) -> float:
+        return self.settled - self.started
+
+    def _settle(self, acked: bool):
+        if not self._done.is_set():
+            self.settled = time.monotonic()
+            self.acked = acked
+            self._done.set()
+
+
+def rssBytes() -> int:
+    """
+    The process's resident set size now, from /proc where there is one
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peakRssBytes()
+
+
+def peakRssBytes() -> int:
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+
+def percentile(values: list, p: float) -> float:
+    return float(np.percentile(values, p)) if values else None
+
+
+def environment() -> dict:
+    """
+    What the results were measured on, to compare like with like
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ANALYSES_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "env": {k: v for k, v in os.environ.items() if k.startswith("BUGG_") and k != "BUGG_LOCAL_STORAGE_DIR"},
+    }
@@ -0,0 +1,141 @@
+"""
+Times vggish's log mel spectrogram, the hottest pure numpy code run on each clip, on 1, 5
+and 60 minutes of audio.
+
+    python benchmarks/mel_spectrogram.py [--minutes 1,5,60] [--block-secs 10] [--fft-workers 4]
+        [--repeat 3] [--output mel_spectrogram.json]
+
+Each length is run whole and in --block-secs blocks, the way streaming calls it, with:
+
+- reference: the window and mel filterbank rebuilt on every call, in float64, as before
+- cached: the window and filterbank reused between calls
+- float32: cached and computed in float32 (BUGG_MEL_DTYPE=float32)
+- float32-threaded: as float32, with the FFT on --fft-workers threads (BUGG_FFT_WORKERS)
+
+It reports the fastest of --repeat runs, the peak memory numpy allocated, and how far the
+output drifts from the reference.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import harness
+
+sys.path.insert(0, os.path.join(harness.ANALYSES_DIR, "vggish", "app"))
+import mel_features  # noqa: E402
+import vggish_params  # noqa: E402
+
+
+def logMel(data: np.ndarray, dtype: str, fftWorkers: int) -> np.ndarray:
+    return mel_features.log_mel_spectrogram(
+        data,
+        audio_sample_rate=vggish_params.SAMPLE_RATE,
+        log_offset=vggish_params.LOG_OFFSET,
+        window_length_secs=vggish_params.STFT_WINDOW_LENGTH_SECONDS,
+        hop_length_secs=vggish_params.STFT_HOP_LENGTH_SECONDS,
+        num_mel_bins=vggish_params.NUM_MEL_BINS,
+        lower_edge_hertz=vggish_params.MEL_MIN_HZ,
+        upper_edge_hertz=vggish_params.MEL_MAX_HZ,
+        dtype=dtype,
+        fft_workers=fftWorkers)
+
+
+def clearCaches():
+    mel_features._cached_periodic_hann.cache_clear()
+    mel_features._cached_mel_matrix.cache_clear()
+
+
+def run(blocks: list, dtype: str, fftWorkers: int, cached: bool) -> np.ndarray:
+    outputs = []
+    for block in blocks:
+        if not cached:
+            clearCaches()
+        outputs.append(logMel(block, dtype, fftWorkers))
+    return np.concatenate(outputs)
+
+
+def blocksOf(data: np.ndarray, blockSecs: float) -> list:
+    """
+    Blocks that overlap by a window less a hop, so their frames are exactly the whole waveform's
+    """
+    window = int(round(vggish_params.SAMPLE_RATE * vggish_params.STFT_WINDOW_LENGTH_SECONDS))
+    hop = int(round(vggish_params.SAMPLE_RATE * vggish_params.STFT_HOP_LENGTH_SECONDS))
+    framesPerBlock = int(blockSecs * vggish_params.SAMPLE_RATE) // hop
+    numFrames = 1 + (len(data) - window) // hop
+    return [data[start * hop:(min(start + framesPerBlock, numFrames) - 1) * hop + window]
+            for start in range(0, numFrames, framesPerBlock)]
+
+
+def measure(blocks: list, dtype: str, fftWorkers: int, cached: bool, repeat: int):
+    """
+    The output, the fastest of repeat runs in seconds and the peak memory numpy allocated in MB
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = run(blocks, dtype, fftWorkers, cached)
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+        del output
+
+    tracemalloc.start()
+    output = run(blocks, dtype, fftWorkers, cached)
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output, best, peakBytes / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", default="1,5,60", help="Comma separated lengths of audio")
+    parser.add_argument("--block-secs", type=float, default=10, help="Block length for the streamed runs")
+    parser.add_argument("--fft-workers", type=int, default=os.cpu_count() or 1, help="Threads for the threaded FFT")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each, the fastest is reported")
+    parser.add_argument("--output", default="mel_spectrogram.json")
+    args = parser.parse_args()
+
+    variants = [
+        ("reference", "float64", 1, False),
+        ("cached", "float64", 1, True),
+        ("float32", "float32", 1, True),
+        ("float32-threaded", "float32", args.fft_workers, True),
+    ]
+
+    results = []
+    rng = np.random.RandomState(0)
+    for minutes in [float(m) for m in args.minutes.split(",")]:
+        data = (0.1 * rng.randn(int(minutes * 60 * vggish_params.SAMPLE_RATE))).astype(np.float32)
+        for mode, blocks in (("whole", [data]), (f"{args.block_secs:g}s blocks", blocksOf(data, args.block_secs))):
+            print(f"{minutes:g} minutes, {mode}:")
+            reference = None
+            for name, dtype, fftWorkers, cached in variants:
+                output, secs, peakMb = measure(blocks, dtype, fftWorkers, cached, args.repeat)
+                if reference is None:
+                    reference, referenceSecs = output, secs
+                result = {
+                    "minutes": minutes,
+                    "mode": mode,
+                    "variant": name,
+                    "secs": round(secs, 4),
+                    "speedup": round(referenceSecs / secs, 2),
+                    "peakMb": round(peakMb, 1),
+                    "maxAbsDiff": float(np.max(np.abs(output.astype(np.float64) - reference))),
+                }
+                results.append(result)
+                print(f"  {name}: {secs:.3f}s ({result['speedup']:.2f}x), peak {peakMb:.0f}MB, "
+                      f"max abs diff {result['maxAbsDiff']:.2e}")
+                del output
+            del reference
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": harness.environment(), "results": results}, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
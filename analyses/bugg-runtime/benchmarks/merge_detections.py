@@ -0,0 +1,78 @@
+"""
+Times merging detections into a busy audio record, against the old linear scan.
+
+    python benchmarks/merge_detections.py [--existing 10000] [--new 10000] [--repeat 3]
+
+Half of the new detections share an id with an existing one, as they would when an analysis is re-run.
+"""
+import argparse
+import time
+
+from bugg_runtime.records import mergeDetections
+
+
+def scanMergeDetections(prevDetections: list, detections: list) -> list:
+    """
+    The merge as it was done before mergeDetections, kept here to compare against
+    """
+    newDetectionsList = []
+    for d in prevDetections:
+        match = next((x for x in detections if d["id"] == x["id"]), None)
+        if match == None:
+            newDetectionsList.append(d)
+        else:
+            newDetectionsList.append({**d, **match})
+
+    for d in detections:
+        match = next((x for x in newDetectionsList if d["id"] == x["id"]), None)
+        if match == None:
+            newDetectionsList.append(d)
+
+    return newDetectionsList
+
+
+def makeDetections(analysisId: str, ids: range) -> list:
+    return [{
+        "id": f"detection-{i}",
+        "start": i,
+        "end": i + 1,
+        "tags": [analysisId],
+        "analysisId": analysisId,
+    } for i in ids]
+
+
+def best(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--existing", type=int, default=10000)
+    parser.add_argument("--new", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-scan", action="store_true", help="Don't time the old O(n*m) merge")
+    args = parser.parse_args()
+
+    existing = makeDetections("birdnet-lite", range(args.existing))
+    overlap = args.new // 2
+    new = makeDetections("anomaly-detection", range(args.existing - overlap, args.existing - overlap + args.new))
+
+    print(f"Merging {len(new)} detections into a record with {len(existing)}")
+
+    merged = mergeDetections(existing, new)
+    indexed = best(lambda: mergeDetections(existing, new), args.repeat)
+    print(f"  indexed: {indexed * 1000:.1f} ms")
+
+    if not args.skip_scan:
+        assert scanMergeDetections(existing, new) == merged, "indexed merge doesn't match the scan"
+        scan = best(lambda: scanMergeDetections(existing, new), args.repeat)
+        print(f"  scan:    {scan * 1000:.1f} ms ({scan / indexed:.0f}x slower)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Soak tests a worker by replaying audio ids into it through the local Pub/Sub, at a fixed
+rate or as fast as it will take them, for as long as asked.
+
+    python benchmarks/replay.py --worker vggish [--ids captured_ids.txt | --synthetic-ids 200]
+        [--rates 0.5,1,2,4 --step-secs 600 | --rate 0] [--duration 3600] [--output replay.jsonl]
+
+The messages go through subscribe() exactly as in production, so flow control, prefetch
+and write-behind all apply. Every --report-secs it prints and appends to --output one
+line of JSON with the throughput, latency (publish to ack), queue lag (unacked messages
+and the age of the oldest), error rate, RSS and thread count. At the end the RSS growth
+rate is fitted over the run after --warmup-secs, which shows up leaks such as a model or
+session being rebuilt per message.
+
+With --rates each rate runs for --step-secs in turn. The worker is saturated at the rate
+where throughput stops keeping up and the queue lag keeps growing.
+
+The ids are given records pointing at the fixture clips, and are reset and reused as the
+replay cycles through them, so there should be more ids than messages in flight.
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+import harness
+from bugg_runtime import getLocalPubSub, getPublisherClient, subscribe
+
+TOPIC = "replay"
+SUBSCRIPTION = f"{TOPIC}-sub"
+
+
+class ReplayStats():
+    """
+    Tracks every published message until it is acked, and what happened in each reporting window.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Publish times by audio id, which is never in flight twice
+        self._published = {}
+        self.totalPublished = 0
+        self.totalAcked = 0
+        self.totalNacked = 0
+        self._latencies = []
+        self._windowAcked = 0
+        self._windowNacked = 0
+
+    def publishing(self, audioId: str):
+        # Recorded before publishing, as the message can be acked before publish() returns
+        with self._lock:
+            self._published[audioId] = time.monotonic()
+            self.totalPublished += 1
+
+    def settled(self, message, acked: bool):
+        with self._lock:
+            if not acked:
+                # It will be redelivered, so it stays in flight
+                self.totalNacked += 1
+                self._windowNacked += 1
+                return
+
+            publishedAt = self._published.pop(message.data.decode("utf-8"), None)
+            if publishedAt is None:
+                return
+            self.totalAcked += 1
+            self._windowAcked += 1
+            self._latencies.append(time.monotonic() - publishedAt)
+
+    def unacked(self) -> int:
+        return len(self._published)
+
+    def isInFlight(self, audioId: str) -> bool:
+        return audioId in self._published
+
+    def takeWindow(self) -> dict:
+        with self._lock:
+            oldest = min(self._published.values(), default=None)
+            window = {
+                "acked": self._windowAcked,
+                "nacked": self._windowNacked,
+                "latencies": self._latencies,
+                "unacked": len(self._published),
+                "oldestUnackedSecs": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            }
+            self._windowAcked = 0
+            self._windowNacked = 0
+            self._latencies = []
+        return window
+
+
+def rssGrowthMbPerHour(samples: list) -> float:
+    if len(samples) < 2:
+        return None
+    secs, rss = zip(*samples)
+    slope = np.polyfit(secs, rss, 1)[0]
+    return round(slope * 3600 / 2 ** 20, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker", required=True, help=f"One of {', '.join(harness.WORKERS)}")
+    parser.add_argument("--ids", help="File of captured audio ids, one per line")
+    parser.add_argument("--synthetic-ids", type=int, default=100, help="Ids to make up when --ids isn't given")
+    parser.add_argument("--rate", type=float, default=0, help="Messages per second, 0 to keep the worker saturated")
+    parser.add_argument("--rates", help="Comma separated rates to step through, overriding --rate")
+    parser.add_argument("--step-secs", type=float, default=600, help="How long to hold each of --rates")
+    parser.add_argument("--duration", type=float, default=600, help="Seconds to run for, without --rates")
+    parser.add_argument("--max-backlog", type=int, default=16, help="Unacked messages to keep queued at rate 0")
+    parser.add_argument("--report-secs", type=float, default=30)
+    parser.add_argument("--warmup-secs", type=float, default=60, help="Left out of the RSS growth fit")
+    parser.add_argument("--fixture", action="append", help="Audio file to use, repeatable. Defaults to the bundled soundscape")
+    parser.add_argument("--synthetic", type=float, action="append", default=[], help="Also generate a clip this many seconds long")
+    parser.add_argument("--output", default="replay.jsonl")
+    args = parser.parse_args()
+
+    if args.ids:
+        with open(args.ids) as f:
+            audioIds = [line.strip() for line in f if line.strip()]
+    else:
+        audioIds = [f"replay-{i}" for i in range(args.synthetic_ids)]
+
+    if args.rates:
+        schedule = [(float(rate), args.step_secs) for rate in args.rates.split(",")]
+    else:
+        schedule = [(args.rate, args.duration)]
+
+    worker = harness.loadWorker(args.worker)
+    harness.stageClips(harness.fixtureClips(args.fixture, args.synthetic), len(audioIds), audioIds=audioIds)
+
+    stats = ReplayStats()
+    getLocalPubSub().addListener(stats.settled)
+    pipeline = getattr(worker, "audio_pipeline", worker.on_message)
+    threading.Thread(target=subscribe, args=(SUBSCRIPTION, worker.on_message),
+                     kwargs={"maxMessages": getattr(pipeline, "maxMessages", None), "analysisId": args.worker},
+                     daemon=True).start()
+
+    publisher = getPublisherClient()
+    topic = publisher.topic_path(harness.PROJECT, TOPIC)
+    nextId = 0
+
+    def publishNext() -> bool:
+        nonlocal nextId
+        # Skips ids still being worked on, so a record is never reset under a worker
+        for _ in range(len(audioIds)):
+            audioId = audioIds[nextId % len(audioIds)]
+            nextId += 1
+            if not stats.isInFlight(audioId):
+                harness.resetRecord(audioId)
+                stats.publishing(audioId)
+                # Forced, as the worker remembers the ids it has completed and would skip them when reused
+                publisher.publish(topic, audioId.encode(), force="1")
+                return True
+        return False
+
+    start = time.monotonic()
+    rssSamples = []
+    summary = {"environment": harness.environment(), "worker": args.worker, "steps": []}
+
+    with open(args.output, "w") as output:
+        for rate, stepSecs in schedule:
+            print(f"Replaying into {args.worker} at {rate or 'max'} messages/sec for {stepSecs:.0f}s")
+            stepStart = time.monotonic()
+            stepAcked = stats.totalAcked
+            nextPublish = stepStart
+            nextReport = stepStart + args.report_secs
+
+            while time.monotonic() - stepStart < stepSecs:
+                now = time.monotonic()
+                if rate > 0:
+                    if now >= nextPublish:
+                        if not publishNext():
+                            print("WARNING: Every id is in flight, add more ids to replay at this rate")
+                        nextPublish += 1 / rate
+                else:
+                    while stats.unacked() < args.max_backlog and publishNext():
+                        pass
+
+                if now >= nextReport:
+                    window = stats.takeWindow()
+                    rss = harness.rssBytes()
+                    if now - start >= args.warmup_secs:
+                        rssSamples.append((now - start, rss))
+
+                    settled = window["acked"] + window["nacked"]
+                    report = {
+                        "elapsedSecs": round(now - start, 1),
+                        "rate": rate,
+                        "published": stats.totalPublished,
+                        "acked": stats.totalAcked,
+                        "throughput": round(window["acked"] / args.report_secs, 4),
+                        "p50LatencySecs": harness.percentile(window["latencies"], 50),
+                        "p95LatencySecs": harness.percentile(window["latencies"], 95),
+                        "unacked": window["unacked"],
+                        "oldestUnackedSecs": window["oldestUnackedSecs"],
+                        "errorRate": round(window["nacked"] / settled, 4) if settled else 0.0,
+                        "rssMb": round(rss / 2 ** 20, 1),
+                        "threads": threading.active_count(),
+                    }
+                    output.write(json.dumps(report) + "\n")
+                    output.flush()
+                    print(f"{report['elapsedSecs']:.0f}s: {report['throughput']:.3f}/s, p95 {report['p95LatencySecs'] or 0:.2f}s, "
+                          f"{report['unacked']} unacked (oldest {report['oldestUnackedSecs']:.0f}s), "
+                          f"{report['errorRate']:.1%} errors, RSS {report['rssMb']:.0f}MB, {report['threads']} threads")
+                    nextReport += args.report_secs
+
+                time.sleep(min(0.01, 1 / rate) if rate > 0 else 0.01)
+
+            stepSecsTaken = time.monotonic() - stepStart
+            summary["steps"].append({
+                "rate": rate,
+                "secs": round(stepSecsTaken, 1),
+                "throughput": round((stats.totalAcked - stepAcked) / stepSecsTaken, 4),
+                "unackedAtEnd": stats.unacked(),
+            })
+
+        summary.update({
+            "published": stats.totalPublished,
+            "acked": stats.totalAcked,
+            "nacked": stats.totalNacked,
+            "errorRate": round(stats.totalNacked / max(stats.totalAcked + stats.totalNacked, 1), 4),
+            "peakRssMb": round(harness.peakRssBytes() / 2 ** 20, 1),
+            "rssGrowthMbPerHour": rssGrowthMbPerHour(rssSamples),
+        })
+        output.write(json.dumps({"summary": summary}) + "\n")
+
+    print(json.dumps({k: v for k, v in summary.items() if k != "environment"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Measures each worker's throughput end to end against the local backend: fetching the
+record, downloading and decoding the clip, the model and marking the analysis complete.
+
+    python benchmarks/throughput.py [--workers vggish,birdnet-lite] [--clips 20] [--concurrency 1]
+        [--fixture clip.mp3 ...] [--synthetic 60 ...] [--output throughput.json] [--compare old.json]
+
+Each worker runs in its own process, so peak RSS is its own and models aren't shared.
+Clips default to the bundled birdnet-lite soundscape. The results (clips/sec, p50/p95
+latency, peak RSS and the per-stage timings) are written as JSON for comparing commits.
+The workers' own dependencies (TF, tflite, torch, ffmpeg) need to be installed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import harness
+from bugg_runtime import getMetrics
+
+
+def runWorker(name: str, clips: list, count: int, concurrency: int, warmup: int) -> dict:
+    worker = harness.loadWorker(name)
+    audioIds = harness.stageClips(clips, count + warmup)
+
+    # The first clips load the models, which isn't what's being measured
+    for audioId in audioIds[:warmup]:
+        message = harness.BenchMessage(f"warmup-{audioId}", audioId.encode())
+        worker.on_message(message)
+        message.wait()
+
+    getMetrics().reset()
+    rssBefore = harness.rssBytes()
+
+    def handle(message):
+        message.started = time.monotonic()
+        try:
+            worker.on_message(message)
+        except Exception as e:
+            print(f"ERROR: {message.message_id} failed: {e}")
+            message.nack()
+
+    messages = [harness.BenchMessage(audioId, audioId.encode()) for audioId in audioIds[warmup:]]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for message in messages:
+            executor.submit(handle, message)
+    for message in messages:
+        # With write-behind on the last acks wait for the batch to commit
+        message.wait()
+    wallSecs = time.monotonic() - start
+
+    latencies = [m.latency() for m in messages if m.acked]
+    return {
+        "worker": name,
+        "clips": len(messages),
+        "concurrency": concurrency,
+        "fixtures": [os.path.basename(c) for c in clips],
+        "errors": sum(1 for m in messages if not m.acked),
+        "wallSecs": round(wallSecs, 3),
+        "clipsPerSec": round(len(latencies) / wallSecs, 4),
+        "latencySecs": {
+            "p50": harness.percentile(latencies, 50),
+            "p95": harness.percentile(latencies, 95),
+            "max": max(latencies) if latencies else None,
+        },
+        "rssBeforeMb": round(rssBefore / 2 ** 20, 1),
+        "peakRssMb": round(harness.peakRssBytes() / 2 ** 20, 1),
+        "stages": getMetrics().snapshot()["stages"],
+    }
+
+
+def runInSubprocess(name: str, args) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".json") as f:
+        command = [sys.executable, __file__, "--worker", name, "--result", f.name,
+                   "--clips", str(args.clips), "--concurrency", str(args.concurrency), "--warmup", str(args.warmup)]
+        for fixture in args.fixture or []:
+            command += ["--fixture", fixture]
+        for secs in args.synthetic:
+            command += ["--synthetic", str(secs)]
+
+        # BUGG_MAX_MESSAGES sizes the worker's pipeline, so it matches the concurrency unless set
+        env = dict(os.environ)
+        env.setdefault("BUGG_MAX_MESSAGES", str(args.concurrency))
+        if subprocess.run(command, env=env).returncode != 0:
+            return {"worker": name, "failed": True}
+
+        with open(f.name) as result:
+            return json.load(result)
+
+
+def compare(previous: dict, current: dict):
+    before = {r["worker"]: r for r in previous["results"]}
+    print(f"\nCompared with {previous['environment'].get('commit')}:")
+    for result in current["results"]:
+        old = before.get(result["worker"])
+        if old is None or result.get("failed") or old.get("failed"):
+            continue
+        print(f"  {result['worker']}: {old['clipsPerSec']:.3f} -> {result['clipsPerSec']:.3f} clips/sec "
+              f"({result['clipsPerSec'] / old['clipsPerSec'] - 1:+.1%}), "
+              f"p95 {old['latencySecs']['p95']:.2f} -> {result['latencySecs']['p95']:.2f}s, "
+              f"peak RSS {old['peakRssMb']:.0f} -> {result['peakRssMb']:.0f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="vggish,birdnet-lite", help=f"Comma separated, from {', '.join(harness.WORKERS)}")
+    parser.add_argument("--clips", type=int, default=20, help="Clips to time per worker")
+    parser.add_argument("--concurrency", type=int, default=1, help="Messages handled at once")
+    parser.add_argument("--warmup", type=int, default=1, help="Clips run first and not timed")
+    parser.add_argument("--fixture", action="append", help="Audio file to use, repeatable. Defaults to the bundled soundscape")
+    parser.add_argument("--synthetic", type=float, action="append", default=[], help="Also generate a clip this many seconds long")
+    parser.add_argument("--output", default="throughput.json")
+    parser.add_argument("--compare", help="Earlier output to compare against")
+    # Used to run one worker in a child process
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    clips = harness.fixtureClips(args.fixture, args.synthetic)
+
+    if args.worker:
+        result = runWorker(args.worker, clips, args.clips, args.concurrency, args.warmup)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for name in args.workers.split(","):
+        print(f"Benchmarking {name} on {args.clips} clips with {args.concurrency} at once")
+        result = runInSubprocess(name, args)
+        results.append(result)
+        if not result.get("failed"):
+            print(f"  {result['clipsPerSec']:.3f} clips/sec, p50 {result['latencySecs']['p50']:.2f}s, "
+                  f"p95 {result['latencySecs']['p95']:.2f}s, peak RSS {result['peakRssMb']:.0f}MB, {result['errors']} errors")
+
+    output = {"environment": harness.environment(), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
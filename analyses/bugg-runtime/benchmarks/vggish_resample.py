@@ -0,0 +1,122 @@
+"""
+Compares VGGish's input path before and after decoding straight to 16kHz: how long each
+takes, and how far the examples (and with --embeddings, the embeddings) drift from the old ones.
+
+    python benchmarks/vggish_resample.py [--fixture clip.mp3 ...] [--synthetic 60 ...]
+        [--resamplers kaiser_best,kaiser_fast,polyphase] [--embeddings] [--repeat 3] [--output vggish_resample.json]
+
+The old path decoded at librosa's default 22.05kHz and resampled again to 16kHz with
+resampy. The new one decodes at the file's own rate and resamples once with each of
+--resamplers. Needs vggish's own dependencies (librosa, resampy, and TF for --embeddings).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import harness
+
+sys.path.insert(0, os.path.join(harness.ANALYSES_DIR, "vggish", "app"))
+import vggish_input  # noqa: E402
+import vggish_params  # noqa: E402
+
+# librosa.load's default rate, which the old path decoded at
+LEGACY_SAMPLE_RATE = 22050
+
+
+def legacyExamples(path: str) -> np.ndarray:
+    data, sr = vggish_input.aud_f_read(path, sample_rate=LEGACY_SAMPLE_RATE, res_type="kaiser_best")
+    return vggish_input.waveform_to_examples(data, sr, res_type="kaiser_best")
+
+
+def singlePassExamples(path: str, resampler: str) -> np.ndarray:
+    data, sr = vggish_input.aud_f_read(path, sample_rate=vggish_params.SAMPLE_RATE, res_type=resampler)
+    return vggish_input.waveform_to_examples(data, sr)
+
+
+def timed(run, repeat: int):
+    """
+    The result of the last run, and the fastest of repeat runs in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return result, best
+
+
+def drift(reference: np.ndarray, other: np.ndarray) -> dict:
+    """
+    How far other is from reference, over the examples they both have (resampling can change the length by a frame)
+    """
+    n = min(len(reference), len(other))
+    a = reference[:n].reshape(n, -1).astype(np.float64)
+    b = other[:n].reshape(n, -1).astype(np.float64)
+    cosine = np.sum(a * b, axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+    return {
+        "examples": [len(reference), len(other)],
+        "maxAbsDiff": float(np.max(np.abs(a - b))) if n else None,
+        "meanAbsDiff": float(np.mean(np.abs(a - b))) if n else None,
+        "minCosine": float(np.min(cosine)) if n else None,
+        "meanCosine": float(np.mean(cosine)) if n else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixture", action="append", help="Audio file to use, repeatable. Defaults to the bundled soundscape")
+    parser.add_argument("--synthetic", type=float, action="append", default=[], help="Also generate a clip this many seconds long")
+    parser.add_argument("--resamplers", default="kaiser_best,kaiser_fast,polyphase")
+    parser.add_argument("--embeddings", action="store_true", help="Also run VGGish and compare the embeddings")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each path, the fastest is reported")
+    parser.add_argument("--output", default="vggish_resample.json")
+    args = parser.parse_args()
+
+    an = None
+    if args.embeddings:
+        from AudiosetAnalysis import AudiosetAnalysis
+        an = AudiosetAnalysis()
+        an.setup()
+
+    results = []
+    for clip in harness.fixtureClips(args.fixture, args.synthetic):
+        print(f"{os.path.basename(clip)}:")
+        legacy, legacySecs = timed(lambda: legacyExamples(clip), args.repeat)
+        legacyEmbeddings = an.analyse_examples(legacy)["raw_audioset_feats_960ms"] if an is not None else None
+        print(f"  legacy (22.05kHz then 16kHz): {legacySecs:.3f}s for {len(legacy)} examples")
+
+        result = {"clip": os.path.basename(clip), "legacySecs": round(legacySecs, 4), "resamplers": {}}
+        for resampler in args.resamplers.split(","):
+            try:
+                examples, secs = timed(lambda: singlePassExamples(clip, resampler), args.repeat)
+            except Exception as e:
+                print(f"  WARNING: {resampler} failed: {e}")
+                continue
+
+            entry = {
+                "secs": round(secs, 4),
+                "speedup": round(legacySecs / secs, 2),
+                "examplesDrift": drift(legacy, examples),
+            }
+            if an is not None:
+                embeddings = an.analyse_examples(examples)["raw_audioset_feats_960ms"]
+                entry["embeddingDrift"] = drift(legacyEmbeddings, embeddings)
+            result["resamplers"][resampler] = entry
+
+            worst = entry.get("embeddingDrift", entry["examplesDrift"])
+            print(f"  {resampler}: {secs:.3f}s ({entry['speedup']:.1f}x), "
+                  f"min cosine {worst['minCosine']:.5f}, max abs diff {worst['maxAbsDiff']:.4f}")
+        results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": harness.environment(), "results": results}, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
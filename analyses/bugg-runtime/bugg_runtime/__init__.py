@@ -0,0 +1,25 @@
+"""
+Shared runtime for the bugg analysis workers.
+
+Holds the Firestore/Storage helpers every worker needs, backed by a single set of
+pooled clients per process, and the Pub/Sub loop that feeds messages to the worker.
+"""
+from .audio import (AudioFile, decodeAudio, deleteDownloadedAudio,
+                    downloadAudio, downloadAudioUrl, downloadFromCloudStorage,
+                    fetchAudio, getAudioBlob, streamAudio)
+from .audiocache import getAudioCacheStats
+from .clients import (BACKEND, BUCKET_NAME, PROJECT_ID, getBlob, getBucket,
+                      getDb, getLocalPubSub, getPublisherClient,
+                      getStorageClient, getSubscriberClient)
+from .completed import shouldSkip
+from .fused import FusedRunner
+from .jobs import AnalysisJobRequest, unpack
+from .metrics import (getMetrics, inCurrentMessage, incrementCounter,
+                      timeStage)
+from .pipeline import AudioPipeline
+from .profiling import requestProfile
+from .records import (getAnalysisResult, getAudioDBRecord, getDocument,
+                      getRecorder, invalidateDocument, markAnalysisComplete,
+                      mergeDetections, recordDetection, setAnalysisResult,
+                      writeDetections)
+from .subscriber import ackMessage, getStatus, inferenceSlot, subscribe
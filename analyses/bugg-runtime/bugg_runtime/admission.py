@@ -0,0 +1,218 @@
+"""
+Adapting how many messages a worker takes on to the machine it is running on.
+
+With BUGG_ADMISSION=1 the subscriber leases up to BUGG_MAX_MESSAGES messages as usual, but
+only lets the current limit of them start work. Every BUGG_ADMISSION_INTERVAL_SECS the
+limit is adjusted from the process's RSS and CPU use:
+
+- over the hard memory ceiling it is halved, and nothing new starts until RSS drops back under
+- over BUGG_ADMISSION_MEMORY_TARGET of the ceiling, or BUGG_ADMISSION_CPU_TARGET of the CPUs, it drops by one
+- with messages waiting and room on both, it rises by one
+
+AudioPipeline also reserves each clip's decoded size (estimated from the blob's size, before
+downloading it) against the memory left under the ceiling, so one long recording waits for
+room rather than pushing the worker over. A message kept waiting for more than
+BUGG_ADMISSION_MAX_WAIT_SECS is nacked so another worker can take it.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Turns the controller on
+ADMISSION = os.environ.get("BUGG_ADMISSION", "0") == "1"
+# Fewest messages allowed to run at once, however loaded the machine
+ADMISSION_MIN_MESSAGES = int(os.environ.get("BUGG_ADMISSION_MIN_MESSAGES", "1"))
+# How often the limit is adjusted
+ADMISSION_INTERVAL_SECS = float(os.environ.get("BUGG_ADMISSION_INTERVAL_SECS", "2"))
+# RSS the worker must stay under. Defaults to 85% of the container's (or machine's) memory
+MEMORY_CEILING_BYTES = int(os.environ.get("BUGG_MEMORY_CEILING_BYTES", "0"))
+# Fraction of the ceiling above which the limit is lowered
+ADMISSION_MEMORY_TARGET = float(os.environ.get("BUGG_ADMISSION_MEMORY_TARGET", "0.75"))
+# Fraction of the CPUs above which the limit is lowered
+ADMISSION_CPU_TARGET = float(os.environ.get("BUGG_ADMISSION_CPU_TARGET", "0.9"))
+# Longest a message waits to start before it is handed back
+ADMISSION_MAX_WAIT_SECS = float(os.environ.get("BUGG_ADMISSION_MAX_WAIT_SECS", "120"))
+# Bytes of memory a clip takes while it is analysed, per byte of the compressed file. A 128kbps
+# MP3 decodes to ~12x its size as float32 at 48kHz, and the analyses hold a resampled copy and features too
+DECODE_EXPANSION = float(os.environ.get("BUGG_DECODE_EXPANSION", "20"))
+
+
+def rssBytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def memoryLimitBytes() -> int:
+    """
+    The container's memory limit under cgroups v2 or v1, or else the machine's memory
+    """
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroups v1 reports a huge number when there is no limit
+        if value != "max" and int(value) < 1 << 60:
+            return int(value)
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def cpuCount() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class AdmissionController():
+    """
+    A limit on the messages running at once that follows memory and CPU pressure, and a
+    reservation of memory for each clip being analysed.
+    """
+
+    def __init__(self, maxMessages: int, minMessages: int = ADMISSION_MIN_MESSAGES, memoryCeiling: int = None,
+                 memoryTarget: float = ADMISSION_MEMORY_TARGET, cpuTarget: float = ADMISSION_CPU_TARGET,
+                 maxWaitSecs: float = ADMISSION_MAX_WAIT_SECS, backlog=None):
+        self.maxMessages = maxMessages
+        self.minMessages = min(minMessages, maxMessages)
+        self.memoryCeiling = memoryCeiling or MEMORY_CEILING_BYTES or int(memoryLimitBytes() * 0.85)
+        self.memoryTarget = memoryTarget
+        self.cpuTarget = cpuTarget
+        self.maxWaitSecs = maxWaitSecs
+        # Messages waiting before they reach the controller, e.g. in the priority lanes
+        self.backlog = backlog or (lambda: 0)
+
+        # Starts low and rises while there is room, so a small VM isn't swamped while it warms up
+        self.limit = self.minMessages
+        self.running = 0
+        self.waiting = 0
+        self.reservedBytes = 0
+        self.rss = rssBytes()
+        self.cpu = 0.0
+        # RSS with nothing running (the models and runtime), which the reservations are on top of
+        self._idleRss = self.rss
+        self._condition = threading.Condition()
+        self._thread = None
+        self._lastCpu = None
+
+    def start(self, intervalSecs: float = ADMISSION_INTERVAL_SECS):
+        self._thread = threading.Thread(target=self._run, args=(intervalSecs,), daemon=True)
+        self._thread.start()
+        print(f"Admission control on: {self.minMessages}-{self.maxMessages} messages, "
+              f"{self.memoryCeiling / 2 ** 20:.0f}MB memory ceiling")
+
+    def acquire(self) -> bool:
+        """
+        Waits for the message's turn to run. False if it waited too long and should be handed back.
+        """
+        deadline = time.monotonic() + self.maxWaitSecs
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.running >= self.limit or self.rss >= self.memoryCeiling:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.running += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.running -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, blobSize: int):
+        """
+        Holds back the analysis of a clip until its estimated decoded size fits under the ceiling
+        """
+        numBytes = int((blobSize or 0) * DECODE_EXPANSION)
+        with self._condition:
+            # A clip too big for the ceiling on its own still runs, but only by itself
+            while self.reservedBytes > 0 and self.reservedBytes + numBytes > self._memoryAvailable():
+                self._condition.wait()
+            self.reservedBytes += numBytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reservedBytes -= numBytes
+                self._condition.notify_all()
+
+    def _memoryAvailable(self) -> int:
+        return self.memoryCeiling - self._idleRss
+
+    def _cpuUtilisation(self) -> float:
+        times = os.times()
+        now = (time.monotonic(), times.user + times.system)
+        last, self._lastCpu = self._lastCpu, now
+        if last is None or now[0] <= last[0]:
+            return 0.0
+        return (now[1] - last[1]) / (now[0] - last[0]) / cpuCount()
+
+    def adjust(self):
+        rss = rssBytes()
+        cpu = self._cpuUtilisation()
+
+        with self._condition:
+            self.rss = rss
+            self.cpu = cpu
+            if self.running == 0:
+                self._idleRss = rss
+
+            previous = self.limit
+            if rss >= self.memoryCeiling:
+                self.limit = max(self.minMessages, self.limit // 2)
+            elif rss >= self.memoryCeiling * self.memoryTarget or cpu >= self.cpuTarget:
+                self.limit = max(self.minMessages, self.limit - 1)
+            elif (self.waiting > 0 or self.backlog() > 0) and self.running >= self.limit:
+                self.limit = min(self.maxMessages, self.limit + 1)
+
+            self._condition.notify_all()
+
+        if self.limit != previous:
+            print(f"Admission limit {previous} -> {self.limit} (RSS {rss / 2 ** 20:.0f}MB, CPU {cpu:.0%})")
+
+    def _run(self, intervalSecs: float):
+        while True:
+            time.sleep(intervalSecs)
+            try:
+                self.adjust()
+            except Exception as e:
+                print(f"WARNING: Failed to adjust the admission limit: {e}")
+
+
+_controller = None
+
+
+def startAdmission(maxMessages: int, backlog=None):
+    """
+    Creates the controller when BUGG_ADMISSION is on. Called by subscribe()
+    """
+    global _controller
+    if ADMISSION and _controller is None:
+        _controller = AdmissionController(maxMessages, backlog=backlog)
+        _controller.start()
+    return _controller
+
+
+def getAdmission() -> AdmissionController:
+    return _controller
+
+
+@contextmanager
+def reserveMemory(blobSize: int):
+    """
+    Reserves room for a clip of this size before it is downloaded and decoded, when admission control is on
+    """
+    if _controller is None:
+        yield
+        return
+
+    with _controller.reserve(blobSize):
+        yield
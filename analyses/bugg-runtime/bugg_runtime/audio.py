@@ -0,0 +1,399 @@
+"""
+Moving audio and artifacts between Cloud Storage and the local disk.
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from google.cloud import storage
+
+from .audiocache import getAudioCache
+from .clients import getBlob, getStorageClient
+from .metrics import timeStage
+
+# Clips up to this size are held in memory, larger ones are spilled to a temporary file
+SPILL_THRESHOLD_BYTES = int(os.environ.get("BUGG_AUDIO_SPILL_BYTES", str(64 * 1024 * 1024)))
+
+
+class AudioFile():
+    """
+    A downloaded clip, held in memory unless it was larger than SPILL_THRESHOLD_BYTES.
+
+    Decoders get at it through source(), which hands over a file object where they can
+    read one and only writes it to disk for those that need a path.
+    """
+
+    def __init__(self, name: str, data: bytes = None, path: str = None):
+        self.name = name
+        self._data = data
+        self._path = path
+
+    @property
+    def size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        return os.path.getsize(self._path)
+
+    def open(self):
+        """
+        A new binary file object positioned at the start of the clip
+        """
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        return open(self._path, "rb")
+
+    def read(self) -> bytes:
+        if self._data is not None:
+            return self._data
+        with open(self._path, "rb") as f:
+            return f.read()
+
+    @contextmanager
+    def path(self):
+        """
+        A path to the clip on disk, only written out if it is being held in memory
+        """
+        if self._path is not None:
+            yield self._path
+            return
+
+        suffix = os.path.splitext(self.name)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            f.write(self._data)
+        try:
+            yield f.name
+        finally:
+            os.remove(f.name)
+
+    @contextmanager
+    def source(self):
+        """
+        What to hand to librosa/soundfile: a file object if they can decode the clip from memory, else a path
+        """
+        if self._path is None and canDecodeFromMemory():
+            with self.open() as f:
+                yield f
+        else:
+            with self.path() as path:
+                yield path
+
+    def close(self):
+        self._data = None
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_canDecodeFromMemory = None
+
+
+class SpillingBuffer():
+    """
+    A file object to download a clip into. It is held in memory until it grows past
+    SPILL_THRESHOLD_BYTES, then moved to a temporary file, so the size needn't be known up front.
+    """
+
+    def __init__(self, suffix: str, spill: bool = False):
+        self._suffix = suffix
+        self._buffer = io.BytesIO()
+        self._file = None
+        if spill:
+            self._spill()
+
+    def _spill(self):
+        self._file = tempfile.NamedTemporaryFile(suffix=self._suffix, delete=False)
+        self._file.write(self._buffer.getbuffer())
+        self._buffer = None
+
+    def write(self, data) -> int:
+        if self._file is None and self._buffer.tell() + len(data) > SPILL_THRESHOLD_BYTES:
+            self._spill()
+        if self._file is not None:
+            return self._file.write(data)
+        return self._buffer.write(data)
+
+    def audioFile(self, name: str) -> AudioFile:
+        if self._file is None:
+            return AudioFile(name, data=self._buffer.getvalue())
+        self._file.close()
+        return AudioFile(name, path=self._file.name)
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._file.name)
+
+
+def canDecodeFromMemory() -> bool:
+    """
+    Whether soundfile can read MP3 from a file object (needs libsndfile >= 1.1). Otherwise librosa only decodes from a path.
+    """
+    global _canDecodeFromMemory
+    if _canDecodeFromMemory is None:
+        try:
+            import soundfile
+            _canDecodeFromMemory = "MP3" in soundfile.available_formats()
+        except Exception:
+            _canDecodeFromMemory = False
+
+    return _canDecodeFromMemory
+
+
+def fetchAudio(audioRecord: dict, blob: storage.Blob = None) -> AudioFile:
+    """
+    Downloads the record's audio into memory, or into a temporary file if it is larger than SPILL_THRESHOLD_BYTES.
+
+    The host's audio cache is checked first when BUGG_AUDIO_CACHE_DIR is set.
+
+    Use it as a context manager (or call close()) to release it after processing.
+
+    The blob needn't have its metadata (see getAudioBlob) unless the audio cache is on.
+    """
+    if blob is None:
+        blob = getAudioBlob(audioRecord, metadata=False)
+
+    name = f"{audioRecord['id']}{os.path.splitext(blob.name)[1] or '.mp3'}"
+
+    cache = getAudioCache()
+    if cache is not None:
+        # The cache key needs the object's checksum
+        if blob.size is None:
+            blob.reload()
+    # Otherwise a clip of unknown size starts in memory and spills once it passes the threshold
+    spill = blob.size is not None and blob.size > SPILL_THRESHOLD_BYTES
+
+    if cache is not None:
+        cachedPath = cache.get(blob)
+        if cachedPath is not None:
+            print(f"Using cached copy of {audioRecord['uri']}")
+            if spill:
+                return AudioFile(name, path=cachedPath)
+
+            with open(cachedPath, "rb") as f:
+                data = f.read()
+            os.remove(cachedPath)
+            return AudioFile(name, data=data)
+
+    print(f"Downloading {audioRecord['uri']}")
+    start = time.monotonic()
+
+    buffer = SpillingBuffer(os.path.splitext(name)[1], spill=spill)
+    try:
+        blob.download_to_file(buffer)
+    except BaseException:
+        buffer.discard()
+        raise
+    audio = buffer.audioFile(name)
+
+    if cache is not None:
+        cache.recordDownload(audio.size, time.monotonic() - start)
+        try:
+            cache.put(blob, data=audio._data, path=audio._path)
+        except OSError as e:
+            # The cache is only an optimisation, so carry on without it
+            print(f"WARNING: Failed to add {audioRecord['uri']} to the audio cache: {e}")
+
+    return audio
+
+
+def decodeAudio(audio, sampleRate: int) -> np.ndarray:
+    """
+    Decodes an AudioFile (or a path) to mono float32 samples at the given rate with ffmpeg, without writing anything to disk.
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+               "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(sampleRate), "pipe:1"]
+
+    with timeStage("decode"):
+        if isinstance(audio, AudioFile):
+            result = subprocess.run(command, input=audio.read(), stdout=subprocess.PIPE, check=True)
+        else:
+            command[command.index("pipe:0")] = str(audio)
+            result = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def streamAudio(audio, sampleRate: int, blockSamples: int):
+    """
+    Decodes an AudioFile (or a path) like decodeAudio, but yields it blockSamples at a time
+    (the last block may be shorter), so a long recording is never held decoded in full.
+
+    It's one ffmpeg process either way, so the blocks joined up are exactly what decodeAudio returns.
+    """
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+               "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(sampleRate), "pipe:1"]
+    fromMemory = isinstance(audio, AudioFile)
+    if not fromMemory:
+        command[command.index("pipe:0")] = str(audio)
+
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if fromMemory else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            with audio.open() as f:
+                shutil.copyfileobj(f, process.stdin)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg stopped reading, because it failed or the blocks stopped being wanted
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True) if fromMemory else None
+    if feeder is not None:
+        feeder.start()
+
+    blockBytes = blockSamples * 4
+    try:
+        while True:
+            with timeStage("decode"):
+                data = process.stdout.read(blockBytes)
+            if len(data) == 0:
+                break
+            yield np.frombuffer(data, dtype=np.float32)
+
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        if feeder is not None:
+            feeder.join()
+
+
+def getAudioBlob(audioRecord: dict, metadata: bool = True) -> storage.Blob:
+    """
+    Fetches the storage metadata (size, generation, checksums) for the record's audio without downloading it.
+
+    With metadata=False no request is made, and the blob's size is None until it is reloaded.
+    """
+    blob = getBlob(audioRecord["uri"])
+    if metadata:
+        blob.reload()
+    return blob
+
+
+def downloadAudio(analysisId: str, audioRecord: dict, blob: storage.Blob = None) -> str:
+    """
+    Downloads the audio file from cloud storage to a place locally.
+
+    Be sure to delete the file after processing.
+
+    Pass the blob from getAudioBlob() if it has already been fetched.
+
+    The host's audio cache is checked first when BUGG_AUDIO_CACHE_DIR is set.
+
+    Will return the filename once download is complete
+    """
+
+    audio_id = audioRecord["id"]
+    uri = audioRecord["uri"]
+
+    destinationPath = f"tmp/{analysisId}"
+    Path(destinationPath).mkdir(parents=True, exist_ok=True)
+    destinationFile = f"{destinationPath}/{audio_id}.mp3"
+
+    cache = getAudioCache()
+    if cache is not None:
+        # The cache key needs the object's checksum
+        if blob is None:
+            blob = getAudioBlob(audioRecord)
+
+        cachedPath = cache.get(blob)
+        if cachedPath is not None:
+            print(f"Using cached copy of {uri}")
+            shutil.move(cachedPath, destinationFile)
+            return destinationFile
+
+    print(f"Downloading {uri}")
+    start = time.monotonic()
+
+    with timeStage("download"), open(destinationFile, "wb") as file_obj:
+        if blob is not None:
+            blob.download_to_file(file_obj)
+        else:
+            getStorageClient().download_blob_to_file(uri, file_obj)
+
+    if cache is not None:
+        cache.recordDownload(os.path.getsize(destinationFile), time.monotonic() - start)
+        try:
+            cache.put(blob, path=destinationFile)
+        except OSError as e:
+            print(f"WARNING: Failed to add {uri} to the audio cache: {e}")
+
+    return destinationFile
+
+
+def downloadAudioUrl(audioUri: str) -> str:
+    """
+    Downloads the audio file at a gs:// uri to a place locally.
+
+    Be sure to delete the file after processing.
+
+    Will return the filename once download is complete
+    """
+    filename = audioUri.split("/")[-1]
+
+    destinationPath = "tmp/"
+    Path(destinationPath).mkdir(parents=True, exist_ok=True)
+    destinationFile = f"{destinationPath}/{filename}.mp3"
+
+    print(f"Downloading {audioUri}")
+
+    with open(destinationFile, "wb") as file_obj:
+        getStorageClient().download_blob_to_file(audioUri, file_obj)
+
+    return destinationFile
+
+
+def downloadFromCloudStorage(storageUri: str, localPath: str) -> Path:
+    """
+    Downloads any object to the given local path, skipping the download if it is already there.
+
+    The object is downloaded to a temporary file beside the path and renamed into place, so
+    another thread or process checking for the same path never reads a half-written file.
+    """
+    destinationFile = Path(localPath)
+    parent_folder = destinationFile.parent
+
+    # check file hasn't already been downloaded
+    if os.path.exists(localPath):
+        print(f"File {storageUri} already exists locally")
+        return destinationFile
+
+    Path(parent_folder).mkdir(parents=True, exist_ok=True)
+
+    print(f"Downloading {storageUri} to {localPath}")
+
+    fd, tmpPath = tempfile.mkstemp(dir=parent_folder, prefix=f".{destinationFile.name}.")
+    try:
+        with timeStage("download"), os.fdopen(fd, "wb") as file_obj:
+            getStorageClient().download_blob_to_file(storageUri, file_obj)
+        os.replace(tmpPath, destinationFile)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+    return destinationFile
+
+
+def deleteDownloadedAudio(filepath: str):
+    os.remove(filepath)
@@ -0,0 +1,201 @@
+"""
+A host-local cache of downloaded audio, shared by every worker process on the VM.
+
+Entries are keyed by the object's CRC32C and size (falling back to its generation), so
+the same clip is only fetched from Cloud Storage once however many analyses run on
+the host. Entries are evicted least recently used first once the cache is over its
+byte budget.
+
+It is safe for several processes to share one directory: entries are written to a
+temporary name and renamed into place, eviction runs under a file lock, and readers
+take a hard link to an entry so it can be evicted while they are still using it.
+"""
+import base64
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Directory to keep the cache in. The cache is off unless this is set
+AUDIO_CACHE_DIR = os.environ.get("BUGG_AUDIO_CACHE_DIR")
+# Byte budget for the whole cache directory
+AUDIO_CACHE_BYTES = int(os.environ.get("BUGG_AUDIO_CACHE_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Links left behind by processes that died mid-message are cleared up after this long
+STALE_WORK_SECS = 24 * 60 * 60
+
+
+class AudioCache():
+
+    def __init__(self, directory: str, maxBytes: int):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+        self._entriesDir = os.path.join(directory, "entries")
+        self._workDir = os.path.join(directory, "work")
+        os.makedirs(self._entriesDir, exist_ok=True)
+        os.makedirs(self._workDir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "bytesServed": 0,
+            "bytesDownloaded": 0,
+            "downloadSecs": 0.0,
+        }
+
+    @staticmethod
+    def key(blob) -> str:
+        if blob.crc32c:
+            checksum = base64.b64decode(blob.crc32c).hex()
+            return f"crc32c-{checksum}-{blob.size}"
+
+        name = hashlib.sha1(f"{blob.bucket.name}/{blob.name}".encode("utf-8")).hexdigest()
+        return f"gen-{name}-{blob.generation}"
+
+    def _entryPath(self, key: str) -> str:
+        return os.path.join(self._entriesDir, key)
+
+    def get(self, blob):
+        """
+        Returns a private hard link to the cached copy of the blob, or None if it isn't cached.
+
+        The caller owns the link and should delete it when done.
+        """
+        entry = self._entryPath(self.key(blob))
+        # Unique, as pids and thread idents are reused, and a dead process's links stay until they go stale
+        link = os.path.join(self._workDir, f"{uuid.uuid4().hex}-{os.path.basename(entry)}")
+
+        try:
+            os.link(entry, link)
+        except FileNotFoundError:
+            self._count(misses=1)
+            return None
+
+        # Touch the entry so eviction sees it as recently used. Through the link, which is the same
+        # inode and can't be evicted from under us, unlike the entry's own name
+        os.utime(link)
+
+        self._count(hits=1, bytesServed=os.path.getsize(link))
+        return link
+
+    def put(self, blob, data: bytes = None, path: str = None):
+        """
+        Adds a downloaded copy of the blob, from either its bytes or a file holding them.
+        """
+        entry = self._entryPath(self.key(blob))
+        if os.path.exists(entry):
+            return
+
+        fd, tmpPath = tempfile.mkstemp(dir=self._workDir, prefix="incoming-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if data is not None:
+                    f.write(data)
+                else:
+                    with open(path, "rb") as source:
+                        shutil.copyfileobj(source, f)
+            os.replace(tmpPath, entry)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        self.evict()
+
+    def recordDownload(self, numBytes: int, secs: float):
+        self._count(bytesDownloaded=numBytes, downloadSecs=secs)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its budget.
+        """
+        with self._fileLock():
+            entries = []
+            total = 0
+            for name in os.listdir(self._entriesDir):
+                try:
+                    stat = os.stat(os.path.join(self._entriesDir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.maxBytes:
+                    break
+                try:
+                    os.remove(os.path.join(self._entriesDir, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+            staleBefore = time.time() - STALE_WORK_SECS
+            for name in os.listdir(self._workDir):
+                path = os.path.join(self._workDir, name)
+                try:
+                    if os.stat(path).st_ctime < staleBefore:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    @contextmanager
+    def _fileLock(self):
+        with open(os.path.join(self.directory, ".lock"), "w") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters for this process, with an estimate of the download time the hits saved
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        if stats["bytesDownloaded"] > 0:
+            secsPerByte = stats["downloadSecs"] / stats["bytesDownloaded"]
+            stats["downloadSecsSaved"] = stats["bytesServed"] * secsPerByte
+        else:
+            stats["downloadSecsSaved"] = 0.0
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
+
+
+_audioCache = None
+_audioCacheLock = threading.Lock()
+
+
+def getAudioCache():
+    """
+    The process's AudioCache, or None if BUGG_AUDIO_CACHE_DIR isn't set
+    """
+    global _audioCache
+    if AUDIO_CACHE_DIR is None:
+        return None
+
+    with _audioCacheLock:
+        if _audioCache is None:
+            _audioCache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_BYTES)
+
+    return _audioCache
+
+
+def getAudioCacheStats() -> dict:
+    cache = getAudioCache()
+    return cache.stats() if cache is not None else {}
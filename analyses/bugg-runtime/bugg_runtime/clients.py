@@ -0,0 +1,112 @@
+"""
+Process-wide Google Cloud clients shared by every analysis worker.
+
+Building a client opens fresh HTTP/gRPC channels (and pays for the TLS handshakes),
+so each one is created once on first use and then reused by every thread in the process.
+
+With BUGG_BACKEND=local they are the offline stand-ins from local.py instead.
+"""
+import os
+import threading
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import firestore, pubsub_v1, storage
+from requests.adapters import HTTPAdapter
+
+from . import local
+
+PROJECT_ID = "bugg-301712"
+BUCKET_NAME = "bugg-301712.appspot.com"
+
+# Number of keep-alive connections to hold open to Cloud Storage
+HTTP_POOL_SIZE = int(os.environ.get("BUGG_HTTP_POOL_SIZE", "16"))
+# "gcp", or "local" for in-memory Firestore and Pub/Sub and buckets in local directories
+BACKEND = os.environ.get("BUGG_BACKEND", "gcp")
+if BACKEND not in ("gcp", "local"):
+    raise ValueError(f"Unknown backend {BACKEND}")
+
+_lock = threading.RLock()
+_clients = {}
+_pid = None
+
+
+def _getOrCreate(name: str, factory):
+    global _pid
+
+    client = _clients.get(name)
+    if client is not None and _pid == os.getpid():
+        return client
+
+    with _lock:
+        # Channels don't survive a fork, so a child process starts with its own set
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+
+        if name not in _clients:
+            _clients[name] = factory()
+
+        return _clients[name]
+
+
+def _createStorageClient():
+    credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+
+    return storage.Client(project=PROJECT_ID, _http=session)
+
+
+def getDb() -> firestore.Client:
+    if BACKEND == "local":
+        return _getOrCreate("firestore", local.LocalFirestore)
+    return _getOrCreate("firestore", lambda: firestore.Client(project=PROJECT_ID))
+
+
+def transactional(func):
+    """
+    firestore.transactional, for whichever backend getDb() returns
+    """
+    if BACKEND == "local":
+        return local.transactional(func)
+    return firestore.transactional(func)
+
+
+def getStorageClient() -> storage.Client:
+    if BACKEND == "local":
+        return _getOrCreate("storage", local.LocalStorage)
+    return _getOrCreate("storage", _createStorageClient)
+
+
+def getBucket(bucketName: str = BUCKET_NAME) -> storage.Bucket:
+    return getStorageClient().bucket(bucketName)
+
+
+def getBlob(uri: str) -> storage.Blob:
+    """
+    The blob at a gs:// uri, without fetching anything
+    """
+    if BACKEND == "local":
+        return getStorageClient().blobFromUri(uri)
+    return storage.Blob.from_string(uri, client=getStorageClient())
+
+
+def getLocalPubSub() -> local.LocalPubSub:
+    """
+    The in-memory topics behind the local publisher and subscriber, e.g. to wait for a subscription to drain
+    """
+    return _getOrCreate("pubsub", local.LocalPubSub)
+
+
+def getSubscriberClient() -> pubsub_v1.SubscriberClient:
+    if BACKEND == "local":
+        return _getOrCreate("subscriber", lambda: local.LocalSubscriber(getLocalPubSub()))
+    return _getOrCreate("subscriber", pubsub_v1.SubscriberClient)
+
+
+def getPublisherClient() -> pubsub_v1.PublisherClient:
+    if BACKEND == "local":
+        return _getOrCreate("publisher", lambda: local.LocalPublisher(getLocalPubSub()))
+    return _getOrCreate("publisher", pubsub_v1.PublisherClient)
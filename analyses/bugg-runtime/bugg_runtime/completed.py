@@ -0,0 +1,78 @@
+"""
+Skipping clips an analysis has already done, before downloading them.
+
+Pub/Sub redeliveries and repeated resubmissions used to run the whole analysis again, only
+to find at the end that the record already had it in analysesPerformed. Workers now check
+the record they fetch first, and a set of the clips this process has recently completed
+(which catches a redelivery racing the record read), and ack the message straight away.
+
+A message with the attribute force=1, or every message with BUGG_FORCE_REPROCESS=1, is
+processed regardless, e.g. to rerun an analysis after changing its model:
+
+    gcloud pubsub topics publish analyses.vggish --message=<audio id> --attribute=force=1
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# Process every message, even for clips the analysis has already done
+FORCE_REPROCESS = os.environ.get("BUGG_FORCE_REPROCESS", "0") == "1"
+# Completions remembered per process, oldest are forgotten first
+RECENTLY_COMPLETED_SIZE = int(os.environ.get("BUGG_RECENTLY_COMPLETED_SIZE", "10000"))
+
+
+class RecentlyCompleted():
+    """
+    A thread-safe, bounded set of (analysis, clip) pairs whose completions have been committed.
+    """
+
+    def __init__(self, maxEntries: int):
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, analysisId: str, audioId: str):
+        if self.maxEntries <= 0:
+            return
+        with self._lock:
+            self._entries[(analysisId, audioId)] = True
+            self._entries.move_to_end((analysisId, audioId))
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_recentlyCompleted = RecentlyCompleted(RECENTLY_COMPLETED_SIZE)
+
+
+def rememberCompleted(analysisId: str, audioId: str):
+    """
+    Called once a completion has been committed. Until then a redelivered message has to be processed again.
+    """
+    _recentlyCompleted.add(analysisId, audioId)
+
+
+def isForced(message) -> bool:
+    attributes = getattr(message, "attributes", None) or {}
+    return FORCE_REPROCESS or attributes.get("force", "").lower() in ("1", "true")
+
+
+def isAlreadyComplete(analysisIds: list, audioId: str, audioRec: dict) -> bool:
+    """
+    True when every one of the analyses is on the record's analysesPerformed, or was recently completed here
+    """
+    analysesPerformed = (audioRec or {}).get("analysesPerformed") or []
+    return all(a in analysesPerformed or (a, audioId) in _recentlyCompleted for a in analysisIds)
+
+
+def shouldSkip(message, analysisIds: list, audioId: str, audioRec: dict) -> bool:
+    """
+    Whether the message can be acked without processing it, as its analyses are already done and it isn't forced
+    """
+    return not isForced(message) and isAlreadyComplete(analysisIds, audioId, audioRec)
@@ -0,0 +1,156 @@
+"""
+Running several analyses against one decode of each clip.
+
+Each worker decodes the MP3 itself, so co-deployed analyses pay for the decode once per
+analysis. FusedRunner decodes once to mono float32 PCM at CANONICAL_SAMPLE_RATE and
+resamples that for each registered analysis, which then marks itself complete as usual.
+"""
+import os
+from math import gcd
+
+import numpy as np
+
+from .audio import AudioFile, decodeAudio
+from .completed import isAlreadyComplete
+from .records import commitWrites
+from .writebehind import isStaging, stagingWrites, takeStagedWrites
+
+# The rate clips are decoded at. Should be at least the highest rate any registered analysis needs
+CANONICAL_SAMPLE_RATE = int(os.environ.get("BUGG_CANONICAL_SAMPLE_RATE", "48000"))
+
+
+def resample(waveform: np.ndarray, fromRate: int, toRate: int) -> np.ndarray:
+    """
+    Polyphase resampling with scipy, which is exact for the integer ratios between the usual audio rates
+    """
+    if fromRate == toRate:
+        return waveform
+
+    from scipy.signal import resample_poly
+
+    divisor = gcd(fromRate, toRate)
+    resampled = resample_poly(waveform, toRate // divisor, fromRate // divisor)
+    return resampled.astype(np.float32, copy=False)
+
+
+class DecodedAudio():
+    """
+    A clip decoded once, handing out copies at other sample rates on demand.
+    """
+
+    def __init__(self, waveform: np.ndarray, sampleRate: int):
+        self.sampleRate = sampleRate
+        self._byRate = {sampleRate: waveform}
+
+    @property
+    def duration(self) -> float:
+        return len(self._byRate[self.sampleRate]) / self.sampleRate
+
+    def at(self, sampleRate: int) -> np.ndarray:
+        if sampleRate not in self._byRate:
+            self._byRate[sampleRate] = resample(self._byRate[self.sampleRate], self.sampleRate, sampleRate)
+        return self._byRate[sampleRate]
+
+
+class FusedAnalysis():
+
+    def __init__(self, analysisId: str, sampleRate: int, process, after: str = None):
+        self.analysisId = analysisId
+        self.sampleRate = sampleRate
+        self.process = process
+        # The analysis whose output this one takes instead of the audio
+        self.after = after
+
+
+class FusedRunner():
+    """
+    The process function for an AudioPipeline that runs every registered analysis on the clip, e.g.
+
+        runner = FusedRunner()
+        runner.register("vggish", 16000, vggish.process_waveform)
+        runner.chain("anomaly-detection", "vggish", anomaly.process_upstream)
+        on_message = AudioPipeline("fused", runner)
+
+    process(audio_id, audio_rec, waveform) gets mono float32 samples at the analysis's rate and
+    should mark its analysis complete. Whatever it returns is handed to the analyses chained
+    after it as process(audio_id, audio_rec, output), so they don't have to fetch it back from
+    storage. If any analysis fails the rest still run (apart from those chained after it),
+    and the ones that finished are committed. Then the error is raised so the message is redelivered.
+
+    The completions are committed together once every analysis has run, so
+    analysisTriggerCompletedAnalysis sees the chained analyses already done and doesn't
+    dispatch them again.
+    """
+
+    def __init__(self, canonicalSampleRate: int = CANONICAL_SAMPLE_RATE):
+        self.canonicalSampleRate = canonicalSampleRate
+        self.analyses = []
+
+    def register(self, analysisId: str, sampleRate: int, process):
+        if sampleRate > self.canonicalSampleRate:
+            print(f"WARNING: {analysisId} wants {sampleRate}Hz but clips are decoded at {self.canonicalSampleRate}Hz")
+        self.analyses.append(FusedAnalysis(analysisId, sampleRate, process))
+
+    def chain(self, analysisId: str, after: str, process):
+        """
+        Runs the analysis on the output of another registered analysis
+        """
+        if after not in self.analysisIds():
+            raise ValueError(f"{analysisId} is chained after {after}, which has to be registered first")
+        self.analyses.append(FusedAnalysis(analysisId, None, process, after=after))
+
+    def analysisIds(self) -> list:
+        return [a.analysisId for a in self.analyses]
+
+    def __call__(self, audioId: str, audioRec: dict, audio: AudioFile, forced: bool = False):
+        """
+        Analyses that have already completed the clip are skipped unless the message is forced (see completed.py)
+        """
+        analyses = [a for a in self.analyses if forced or not isAlreadyComplete([a.analysisId], audioId, audioRec)]
+        skipped = [a.analysisId for a in self.analyses if a not in analyses]
+        if len(skipped) > 0:
+            print(f"Skipping {', '.join(skipped)} on {audioId} as they already completed it")
+
+        decoded = None
+        # Chained analyses only need their upstream's output, so there is nothing to decode if they're all that's left
+        if any(a.after is None for a in analyses):
+            decoded = DecodedAudio(decodeAudio(audio, self.canonicalSampleRate), self.canonicalSampleRate)
+            print(f"Decoded {audioId} once ({decoded.duration:.1f}s) for {', '.join(a.analysisId for a in analyses)}")
+
+        if isStaging():
+            # Write-behind is already holding this message's writes back
+            failed = self._run(audioId, audioRec, decoded, analyses)
+            if len(failed) > 0:
+                # It drops them when the message fails, so commit the analyses that finished now as happens without it
+                commitWrites(takeStagedWrites())
+        else:
+            with stagingWrites(always=True):
+                failed = self._run(audioId, audioRec, decoded, analyses)
+                writes = takeStagedWrites()
+            commitWrites(writes)
+
+        if len(failed) > 0:
+            raise Exception(f"{', '.join(failed)} failed on {audioId}")
+
+    def _run(self, audioId: str, audioRec: dict, decoded: DecodedAudio, analyses: list) -> list:
+        # Chained analyses always come after the one they depend on, so one pass in order will do
+        outputs = {}
+        failed = []
+        for analysis in analyses:
+            if analysis.after is None:
+                args = (audioId, audioRec, decoded.at(analysis.sampleRate))
+            elif analysis.after in outputs:
+                args = (audioId, audioRec, outputs[analysis.after])
+            else:
+                # Its upstream failed, or had already completed and was skipped, in which case the trigger
+                # for the upstream's completion dispatched this one to its own worker
+                print(f"Skipping {analysis.analysisId} on {audioId} as {analysis.after} didn't run here")
+                continue
+
+            try:
+                outputs[analysis.analysisId] = analysis.process(*args)
+            except Exception as e:
+                print(f"ERROR: {analysis.analysisId} failed on {audioId}: {e}")
+                failed.append(analysis.analysisId)
+
+        return failed
@@ -0,0 +1,39 @@
+"""
+Analysis jobs that arrive as an HTTP request (Cloud Run analyses) rather than through Pub/Sub.
+"""
+import json
+
+
+class AnalysisJobRequest():
+    def __init__(self, data: dict, analysisId: str, audioId: str, path: str, recorder: str, project: str, bucket: str, uri: str):
+        self.data = data
+        self.analysisId = analysisId
+        self.audioId = audioId
+        self.path = path
+        self.recorder = recorder
+        self.project = project
+        self.bucket = bucket
+        self.uri = uri
+
+    def to_json(self):
+        """
+        The original data for the request
+        """
+
+        return json.dumps(self.data)
+
+
+def unpack(request) -> AnalysisJobRequest:
+    # will deseralise the incomming request into something nicer for intellisense
+    # the original data posted will look like this:
+    # {
+    #    analysisId: "hello-world",
+    #    audioId: NusNcygBojyrwyFLb7Ws,
+    #    path: audio/project_123AA/00000000249ae42f/16129620954379.mp3,
+    #    recorder: 00000000249ae42f,
+    #    project: "project_123AA",
+    #    bucket: "bugg-301712.appspot.com",
+    #    uri: https://firebasestorage.googleapis.com/v0/b/bugg-301712.appspot.com/o/audio%2Fproject_123AA%2F00000000249ae42f%2F16129620954379.mp3?alt=media
+    # }
+    data = request.json
+    return AnalysisJobRequest(data=data, analysisId=data["analysisId"], audioId=data["audioId"], path=data["path"], recorder=data["recorder"], project=data["project"], bucket=data["bucket"], uri=data["uri"])
@@ -0,0 +1,131 @@
+"""
+Priority lanes, so fresh uploads don't queue behind a backfill.
+
+Backfills (submitAllAudioForProcessing, anomaly-train-gmm republishing a model's window)
+publish to the analysis's bulk topic, "{topic}.bulk", instead of its usual one. With
+BUGG_BULK_LANE=1 a worker subscribes to both, "{name}-sub" and "{name}.bulk-sub", and
+shares its message slots between them with a LaneScheduler:
+
+- while both lanes have messages waiting, slots go to them in the ratio of BUGG_LANE_WEIGHTS
+- while only one does, it gets every free slot, so a backfill soaks up the spare capacity
+- BUGG_PRIORITY_RESERVED_SLOTS slots are never given to the bulk lane, so an upload never
+  waits for a whole bulk clip to finish
+"""
+import os
+import threading
+
+# Turns on the bulk subscription alongside the usual one
+BULK_LANE = os.environ.get("BUGG_BULK_LANE", "0") == "1"
+# The bulk subscription, if it isn't named after the usual one
+BULK_SUBSCRIPTION = os.environ.get("BUGG_BULK_SUBSCRIPTION")
+# Share of the slots each lane gets while both are busy, as "priority:bulk"
+LANE_WEIGHTS = os.environ.get("BUGG_LANE_WEIGHTS", "4:1")
+# Slots held back for the priority lane
+PRIORITY_RESERVED_SLOTS = int(os.environ.get("BUGG_PRIORITY_RESERVED_SLOTS", "1"))
+
+PRIORITY = "priority"
+BULK = "bulk"
+
+
+def bulkTopic(topic: str) -> str:
+    return f"{topic}.bulk"
+
+
+def bulkSubscription(subscriptionId: str) -> str:
+    """
+    The bulk subscription for a worker's usual one, e.g. analyses.vggish-sub -> analyses.vggish.bulk-sub
+    """
+    if BULK_SUBSCRIPTION:
+        return BULK_SUBSCRIPTION
+    if subscriptionId.endswith("-sub"):
+        return f"{subscriptionId[:-len('-sub')]}.bulk-sub"
+    return f"{subscriptionId}.bulk"
+
+
+def parseWeights(weights: str) -> dict:
+    priority, bulk = weights.split(":")
+    return {PRIORITY: int(priority), BULK: int(bulk)}
+
+
+class LaneScheduler():
+    """
+    Hands out a shared number of slots between the priority and bulk lanes by smooth weighted round robin.
+
+    slots is the number of slots, or a function returning it when it can change (e.g. under admission control).
+    """
+
+    def __init__(self, slots, weights: dict = None, reservedSlots: int = PRIORITY_RESERVED_SLOTS):
+        self._slots = slots
+        self.weights = weights or parseWeights(LANE_WEIGHTS)
+        self.reservedSlots = reservedSlots
+
+        self.running = {PRIORITY: 0, BULK: 0}
+        self.waiting = {PRIORITY: 0, BULK: 0}
+        self._credit = {PRIORITY: 0, BULK: 0}
+        self._turn = None
+        self._condition = threading.Condition()
+
+    def slots(self) -> int:
+        return self._slots() if callable(self._slots) else self._slots
+
+    def acquire(self, lane: str):
+        with self._condition:
+            self.waiting[lane] += 1
+            try:
+                # Woken on every release, and periodically in case the number of slots has grown
+                while not self._canRun(lane):
+                    self._condition.wait(1)
+            finally:
+                self.waiting[lane] -= 1
+
+            self.running[lane] += 1
+            self._turn = None
+            self._condition.notify_all()
+
+    def release(self, lane: str):
+        with self._condition:
+            self.running[lane] -= 1
+            self._condition.notify_all()
+
+    def backlog(self) -> int:
+        return sum(self.waiting.values())
+
+    def _eligible(self, lane: str) -> bool:
+        slots = self.slots()
+        if sum(self.running.values()) >= slots:
+            return False
+        # The bulk lane always leaves room for priority messages, unless that would leave it no slots at all
+        if lane == BULK and self.running[BULK] >= max(1, slots - self.reservedSlots):
+            return False
+        return True
+
+    def _canRun(self, lane: str) -> bool:
+        if not self._eligible(lane):
+            return False
+
+        contenders = [l for l in (PRIORITY, BULK) if l == lane or (self.waiting[l] > 0 and self._eligible(l))]
+        if len(contenders) == 1:
+            return True
+
+        if self._turn is None:
+            # Smooth weighted round robin: each lane earns its weight, and the winner pays back the total
+            for l in contenders:
+                self._credit[l] += self.weights[l]
+            self._turn = max(contenders, key=lambda l: self._credit[l])
+            self._credit[self._turn] -= sum(self.weights[l] for l in contenders)
+
+        return self._turn == lane
+
+
+def inLane(scheduler: LaneScheduler, lane: str, callback):
+    """
+    Wraps a message callback so it only runs once the lane is given a slot
+    """
+    def wrapped(message):
+        scheduler.acquire(lane)
+        try:
+            callback(message)
+        finally:
+            scheduler.release(lane)
+
+    return wrapped
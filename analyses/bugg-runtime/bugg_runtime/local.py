@@ -0,0 +1,679 @@
+"""
+Offline stand-ins for Firestore, Cloud Storage and Pub/Sub.
+
+With BUGG_BACKEND=local the clients in clients.py are swapped for these. Firestore and
+Pub/Sub are held in memory and each bucket is a directory under BUGG_LOCAL_STORAGE_DIR, so
+a worker can be run and load tested with real audio and no GCP project, network or
+credentials. They cover the calls the workers make (documents, transactions, batches,
+blobs, publishing and streaming pull) rather than the whole client libraries.
+
+Transactions hold a lock over the whole database while they run, so they never conflict or retry.
+"""
+import copy
+import datetime
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.transforms import (DELETE_FIELD,
+                                                  SERVER_TIMESTAMP,
+                                                  ArrayRemove, ArrayUnion,
+                                                  Increment)
+
+# Where the local buckets are kept, one directory per bucket
+LOCAL_STORAGE_DIR = os.environ.get("BUGG_LOCAL_STORAGE_DIR", os.path.join(tempfile.gettempdir(), "bugg-local-storage"))
+
+
+# Firestore
+
+def _transform(current, value):
+    """
+    The new value of a field that was current, after writing value (which may be a sentinel) to it
+    """
+    if isinstance(value, ArrayUnion):
+        values = list(current) if isinstance(current, list) else []
+        for v in value.values:
+            if v not in values:
+                values.append(copy.deepcopy(v))
+        return values
+    if isinstance(value, ArrayRemove):
+        return [v for v in current if v not in value.values] if isinstance(current, list) else []
+    if isinstance(value, Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if value is SERVER_TIMESTAMP:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, dict):
+        return {k: _transform(None, v) for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _merge(data: dict, changes: dict):
+    for key, value in changes.items():
+        if value is DELETE_FIELD:
+            data.pop(key, None)
+        elif isinstance(value, dict) and isinstance(data.get(key), dict):
+            _merge(data[key], value)
+        else:
+            data[key] = _transform(data.get(key), value)
+
+
+def _updateField(data: dict, key: str, value):
+    parts = FieldPath.from_string(key).parts
+    for part in parts[:-1]:
+        if not isinstance(data.get(part), dict):
+            data[part] = {}
+        data = data[part]
+
+    if value is DELETE_FIELD:
+        data.pop(parts[-1], None)
+    else:
+        data[parts[-1]] = _transform(data.get(parts[-1]), value)
+
+
+def _getField(data: dict, key: str):
+    for part in key.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+class LocalSnapshot():
+
+    def __init__(self, reference, data: dict):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        return copy.deepcopy(_getField(self._data or {}, field))
+
+
+class LocalDocument():
+
+    def __init__(self, db, path: str):
+        self._db = db
+        self.path = path
+        self.id = path.split("/")[-1]
+
+    @property
+    def parent(self):
+        return LocalCollection(self._db, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collectionId: str):
+        return LocalCollection(self._db, f"{self.path}/{collectionId}")
+
+    def get(self, transaction=None, field_paths=None):
+        return LocalSnapshot(self, self._db._read(self.path))
+
+    def create(self, data: dict):
+        self._db._commit([("create", self.path, data)])
+
+    def set(self, data: dict, merge: bool = False):
+        self._db._commit([("merge" if merge else "set", self.path, data)])
+
+    def update(self, data: dict):
+        self._db._commit([("update", self.path, data)])
+
+    def delete(self):
+        self._db._commit([("delete", self.path, None)])
+
+
+class LocalQuery():
+
+    _operators = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a is not None and a < b,
+        "<=": lambda a, b: a is not None and a <= b,
+        ">": lambda a, b: a is not None and a > b,
+        ">=": lambda a, b: a is not None and a >= b,
+        "in": lambda a, b: a in b,
+        "not-in": lambda a, b: a not in b,
+        "array_contains": lambda a, b: isinstance(a, list) and b in a,
+        "array_contains_any": lambda a, b: isinstance(a, list) and any(v in a for v in b),
+    }
+
+    def __init__(self, db, path: str, filters=(), orders=(), limitTo: int = None):
+        self._db = db
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limitTo
+
+    def where(self, field: str, op: str, value):
+        return LocalQuery(self._db, self._path, self._filters + ((field, self._operators[op], value),), self._orders, self._limit)
+
+    def order_by(self, field: str, direction: str = "ASCENDING"):
+        return LocalQuery(self._db, self._path, self._filters, self._orders + ((field, direction == "DESCENDING"),), self._limit)
+
+    def limit(self, count: int):
+        return LocalQuery(self._db, self._path, self._filters, self._orders, count)
+
+    def stream(self, transaction=None):
+        snapshots = [s for s in self._db._list(self._path)
+                     if all(op(_getField(s._data, field), value) for field, op, value in self._filters)]
+
+        # Sorted by the last ordering first so the earlier ones take precedence
+        for field, descending in reversed(self._orders):
+            snapshots.sort(key=lambda s: _getField(s._data, field), reverse=descending)
+
+        return iter(snapshots[:self._limit] if self._limit is not None else snapshots)
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class LocalCollection(LocalQuery):
+
+    def __init__(self, db, path: str):
+        super().__init__(db, path)
+        self.id = path.split("/")[-1]
+
+    def document(self, documentId: str = None):
+        return LocalDocument(self._db, f"{self._path}/{documentId or uuid.uuid4().hex[:20]}")
+
+    def add(self, data: dict, document_id: str = None):
+        ref = self.document(document_id)
+        ref.create(data)
+        return datetime.datetime.now(datetime.timezone.utc), ref
+
+
+class LocalWriteBatch():
+    """
+    Writes applied together on commit(), as a Firestore WriteBatch.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def create(self, reference, data: dict):
+        self._writes.append(("create", reference.path, data))
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self._writes.append(("merge" if merge else "set", reference.path, data))
+
+    def update(self, reference, data: dict):
+        self._writes.append(("update", reference.path, data))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference.path, None))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._db._commit(writes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.commit()
+
+
+class LocalTransaction(LocalWriteBatch):
+
+    def get_all(self, references: list):
+        return [reference.get() for reference in references]
+
+    def get(self, referenceOrQuery):
+        if isinstance(referenceOrQuery, LocalDocument):
+            return iter([referenceOrQuery.get()])
+        return referenceOrQuery.stream()
+
+    def run(self, func, *args, **kwargs):
+        # Holding the lock throughout is what makes the reads and the commit atomic
+        with self._db._lock:
+            self._writes = []
+            result = func(self, *args, **kwargs)
+            self.commit()
+            return result
+
+
+def transactional(func):
+    """
+    The local version of firestore.transactional
+    """
+    def run(transaction, *args, **kwargs):
+        return transaction.run(func, *args, **kwargs)
+
+    return run
+
+
+class LocalFirestore():
+    """
+    An in-memory Firestore database.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.RLock()
+
+    def collection(self, *path: str):
+        return LocalCollection(self, "/".join(path))
+
+    def document(self, *path: str):
+        return LocalDocument(self, "/".join(path))
+
+    def batch(self):
+        return LocalWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return LocalTransaction(self)
+
+    def load(self, documents: dict):
+        """
+        Adds documents by path, e.g. {"audio/abc": {...}}
+        """
+        with self._lock:
+            for path, data in documents.items():
+                self._documents[path] = copy.deepcopy(data)
+
+    def dump(self) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._documents)
+
+    def _read(self, path: str) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._documents.get(path))
+
+    def _list(self, collectionPath: str) -> list:
+        depth = collectionPath.count("/") + 1
+        with self._lock:
+            return [LocalSnapshot(LocalDocument(self, path), copy.deepcopy(data)) for path, data in self._documents.items()
+                    if path.startswith(collectionPath + "/") and path.count("/") == depth]
+
+    def _commit(self, writes: list):
+        with self._lock:
+            # Applied to copies so a failing write leaves every document as it was
+            changed = {}
+            for kind, path, data in writes:
+                current = changed[path] if path in changed else self._documents.get(path)
+
+                if kind == "delete":
+                    changed[path] = None
+                elif kind == "create" and current is not None:
+                    raise ValueError(f"Document {path} already exists")
+                elif kind == "update" and current is None:
+                    raise NotFound(f"No document to update: {path}")
+                elif kind in ("create", "set"):
+                    changed[path] = _transform(None, data)
+                else:
+                    document = copy.deepcopy(current) if current is not None else {}
+                    if kind == "merge":
+                        _merge(document, data)
+                    else:
+                        for key, value in data.items():
+                            _updateField(document, key, value)
+                    changed[path] = document
+
+            for path, document in changed.items():
+                if document is None:
+                    self._documents.pop(path, None)
+                else:
+                    self._documents[path] = document
+
+
+# Cloud Storage
+
+class LocalBlob():
+
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self.size = None
+        self.generation = None
+        self.updated = None
+        # Not calculated, so the audio cache keys local blobs by generation
+        self.crc32c = None
+        self.md5_hash = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.path, self.name)
+
+    @property
+    def public_url(self) -> str:
+        return f"file://{self.path}"
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+        self.updated = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)
+        self.metadata = self.bucket.client._metadata.get((self.bucket.name, self.name))
+
+    def download_to_file(self, fileObj):
+        try:
+            with open(self.path, "rb") as f:
+                shutil.copyfileobj(f, fileObj, 1024 * 1024)
+        except FileNotFoundError:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+    def download_to_filename(self, filename: str):
+        with open(filename, "wb") as f:
+            self.download_to_file(f)
+
+    def download_as_bytes(self) -> bytes:
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+    download_as_string = download_as_bytes
+
+    def upload_from_file(self, fileObj, content_type: str = None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Written beside the object and renamed over it so readers never see half of it
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".upload-")
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(fileObj, f, 1024 * 1024)
+        os.replace(tmpPath, self.path)
+        self.content_type = content_type
+        self._uploaded()
+
+    def upload_from_filename(self, filename: str, content_type: str = None):
+        with open(filename, "rb") as f:
+            self.upload_from_file(f, content_type=content_type)
+
+    def upload_from_string(self, data, content_type: str = "text/plain"):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".upload-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmpPath, self.path)
+        self.content_type = content_type
+        self._uploaded()
+
+    def _uploaded(self):
+        # A new upload replaces the object's metadata with whatever was set on the blob beforehand
+        metadata = self.bucket.client._metadata
+        if self.metadata is not None:
+            metadata[(self.bucket.name, self.name)] = dict(self.metadata)
+        else:
+            metadata.pop((self.bucket.name, self.name), None)
+        self.reload()
+
+    def patch(self):
+        if self.metadata is not None:
+            self.bucket.client._metadata[(self.bucket.name, self.name)] = dict(self.metadata)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        self.bucket.client._metadata.pop((self.bucket.name, self.name), None)
+
+
+class LocalBucket():
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.client.root, self.name)
+
+    def blob(self, name: str):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name: str):
+        blob = LocalBlob(self, name)
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+        return blob
+
+    def list_blobs(self, prefix: str = ""):
+        for directory, _, files in os.walk(self.path):
+            for file in sorted(files):
+                if file.startswith(".upload-"):
+                    continue
+                name = os.path.relpath(os.path.join(directory, file), self.path).replace(os.sep, "/")
+                if name.startswith(prefix or ""):
+                    yield self.get_blob(name)
+
+
+class LocalStorage():
+    """
+    Cloud Storage in a local directory, with a subdirectory per bucket.
+    """
+
+    def __init__(self, root: str = LOCAL_STORAGE_DIR):
+        self.root = root
+        # Custom metadata by (bucket, name), which the workers only ever write
+        self._metadata = {}
+
+    def bucket(self, bucketName: str):
+        return LocalBucket(self, bucketName)
+
+    get_bucket = bucket
+
+    def blobFromUri(self, uri: str):
+        if not uri.startswith("gs://"):
+            raise ValueError(f"Expected a gs:// uri, got {uri}")
+        bucketName, name = uri[len("gs://"):].split("/", 1)
+        return LocalBlob(self.bucket(bucketName), name)
+
+    def download_blob_to_file(self, blobOrUri, fileObj):
+        blob = blobOrUri if isinstance(blobOrUri, LocalBlob) else self.blobFromUri(blobOrUri)
+        blob.download_to_file(fileObj)
+
+
+# Pub/Sub
+
+class LocalMessage():
+
+    def __init__(self, broker, subscription: str, messageId: str, data: bytes, attributes: dict):
+        self._broker = broker
+        self._subscription = subscription
+        self._settled = False
+        self.message_id = messageId
+        self.data = data
+        self.attributes = attributes
+        self.publish_time = datetime.datetime.now(datetime.timezone.utc)
+        self.delivery_attempt = 0
+
+    def ack(self):
+        self._broker._settle(self, redeliver=False)
+
+    def nack(self):
+        self._broker._settle(self, redeliver=True)
+
+    def modify_ack_deadline(self, seconds: int):
+        # Leases never expire locally
+        pass
+
+
+class LocalPubSub():
+    """
+    The in-memory topics and subscriptions shared by the local publisher and subscriber.
+
+    A message published to a topic goes to each of its subscriptions, which are
+    "{topic}-sub" (the naming the workers' subscriptions use) and any added with createSubscription().
+    """
+
+    def __init__(self):
+        self._topics = {}
+        self._queues = {}
+        self._outstanding = {}
+        self._listeners = []
+        self._condition = threading.Condition()
+        self._ids = itertools.count(1)
+
+    def addListener(self, listener):
+        """
+        Calls listener(message, acked) as each delivered message is acked or nacked
+        """
+        self._listeners.append(listener)
+
+    def createSubscription(self, topic: str, subscription: str):
+        with self._condition:
+            self._topics.setdefault(topic, {f"{topic}-sub"}).add(subscription)
+            self._queues.setdefault(subscription, queue.Queue())
+
+    def publish(self, topic: str, data: bytes, attributes: dict) -> str:
+        messageId = str(next(self._ids))
+        with self._condition:
+            for subscription in self._topics.setdefault(topic, {f"{topic}-sub"}):
+                message = LocalMessage(self, subscription, messageId, data, dict(attributes))
+                self._outstanding[subscription] = self._outstanding.get(subscription, 0) + 1
+                self._queues.setdefault(subscription, queue.Queue()).put(message)
+            self._condition.notify_all()
+        return messageId
+
+    def pending(self, subscription: str) -> int:
+        """
+        Messages published to the subscription that haven't been acked yet
+        """
+        return self._outstanding.get(subscription, 0)
+
+    def waitUntilDrained(self, subscription: str, timeout: float = None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: self.pending(subscription) == 0, timeout)
+
+    def _queue(self, subscription: str) -> queue.Queue:
+        with self._condition:
+            return self._queues.setdefault(subscription, queue.Queue())
+
+    def _settle(self, message: LocalMessage, redeliver: bool):
+        with self._condition:
+            if message._settled:
+                return
+            message._settled = True
+
+            if redeliver:
+                retry = LocalMessage(self, message._subscription, message.message_id, message.data, message.attributes)
+                retry.delivery_attempt = message.delivery_attempt
+                self._queues[message._subscription].put(retry)
+            else:
+                self._outstanding[message._subscription] -= 1
+            self._condition.notify_all()
+
+        onSettled = getattr(message, "_onSettled", None)
+        if onSettled is not None:
+            onSettled()
+        for listener in self._listeners:
+            listener(message, not redeliver)
+
+
+class LocalPublisher():
+
+    def __init__(self, broker: LocalPubSub):
+        self._broker = broker
+
+    def topic_path(self, project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic: str, data: bytes, **attributes) -> Future:
+        future = Future()
+        future.set_result(self._broker.publish(topic.split("/")[-1], data, attributes))
+        return future
+
+
+class LocalStreamingPullFuture(Future):
+
+    def __init__(self):
+        super().__init__()
+        self._stopped = threading.Event()
+
+    def cancel(self) -> bool:
+        self._stopped.set()
+        if not self.done():
+            self.set_result(None)
+        return True
+
+    def cancelled(self) -> bool:
+        return self._stopped.is_set()
+
+
+class LocalSubscriber():
+
+    def __init__(self, broker: LocalPubSub):
+        self._broker = broker
+        self._futures = []
+
+    def subscription_path(self, project: str, subscription: str) -> str:
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def subscribe(self, subscription: str, callback, flow_control=None, scheduler=None) -> LocalStreamingPullFuture:
+        """
+        Delivers the subscription's messages to the callback on the scheduler's threads, with
+        no more than flow_control.max_messages unsettled at once. A callback that raises nacks its message.
+        """
+        subscription = subscription.split("/")[-1]
+        maxMessages = getattr(flow_control, "max_messages", None) or 1000
+        if scheduler is None:
+            executor = ThreadPoolExecutor(max_workers=min(maxMessages, 32))
+            schedule = executor.submit
+        else:
+            schedule = scheduler.schedule
+
+        future = LocalStreamingPullFuture()
+        self._futures.append(future)
+        threading.Thread(target=self._deliver, args=(subscription, callback, maxMessages, schedule, future),
+                         daemon=True).start()
+        return future
+
+    def _deliver(self, subscription: str, callback, maxMessages: int, schedule, future):
+        messages = self._broker._queue(subscription)
+        slots = threading.BoundedSemaphore(maxMessages)
+
+        def run(message):
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"ERROR: Callback failed on message {message.message_id}: {e}")
+                message.nack()
+
+        while not future.cancelled():
+            slots.acquire()
+            try:
+                message = messages.get(timeout=0.1)
+            except queue.Empty:
+                slots.release()
+                continue
+
+            message.delivery_attempt += 1
+            message._onSettled = slots.release
+            schedule(run, message)
+
+    def close(self):
+        for future in self._futures:
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
@@ -0,0 +1,253 @@
+"""
+Per-stage timings and counters for the workers.
+
+Wrap each stage of the work in timeStage(name) and count things with incrementCounter().
+The totals are served in the Prometheus text format on BUGG_METRICS_PORT and/or printed as
+one line of JSON every BUGG_METRICS_DUMP_SECS. Each message's own timings are printed when
+it finishes, so a slow clip can be pinned on the network, decoding or the model.
+
+The usual stages are fetch_record, download, decode, features, inference, upload and commit.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Port to serve /metrics on, 0 to not serve them
+METRICS_PORT = int(os.environ.get("BUGG_METRICS_PORT", "0"))
+# How often to print the totals as JSON, 0 to not print them
+METRICS_DUMP_SECS = float(os.environ.get("BUGG_METRICS_DUMP_SECS", "0"))
+# Also write the JSON to this file, e.g. on a mounted volume
+METRICS_DUMP_PATH = os.environ.get("BUGG_METRICS_DUMP_PATH")
+
+# Upper bounds of the stage duration histogram buckets, in seconds
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class StageTimer():
+    """
+    Running totals and a histogram of how long one stage takes.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.totalSecs = 0.0
+        self.maxSecs = 0.0
+        self.buckets = [0] * len(STAGE_BUCKETS)
+
+    def observe(self, secs: float):
+        self.count += 1
+        self.totalSecs += secs
+        self.maxSecs = max(self.maxSecs, secs)
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if secs <= bound:
+                self.buckets[i] += 1
+
+    def toDict(self) -> dict:
+        return {
+            "count": self.count,
+            "totalSecs": round(self.totalSecs, 6),
+            "meanSecs": round(self.totalSecs / self.count, 6) if self.count > 0 else 0.0,
+            "maxSecs": round(self.maxSecs, 6),
+        }
+
+
+class Metrics():
+    """
+    The process's stage timers, counters and gauges.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+        self._message = threading.local()
+
+    def reset(self):
+        """
+        Clears the stage timers and counters, e.g. after warming up
+        """
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    def observeStage(self, name: str, secs: float):
+        timings = getattr(self._message, "timings", None)
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = StageTimer()
+            self._stages[name].observe(secs)
+
+            # Under the lock, as a helper thread can be adding to the same message (see inCurrentMessage)
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + secs
+
+    def increment(self, name: str, amount: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def registerGauge(self, name: str, read):
+        """
+        A value read when the metrics are collected, e.g. how many messages are in flight
+        """
+        self._gauges[name] = read
+
+    @contextmanager
+    def message(self, messageId: str):
+        """
+        Collects the timings of the stages run on this thread for one message, and prints them when it is done
+        """
+        self._message.timings = {}
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            timings = self._message.timings
+            self._message.timings = None
+            timings["total"] = time.monotonic() - start
+            print(f"Timings for message {messageId}: " + json.dumps({k: round(v, 3) for k, v in timings.items()}))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {name: timer.toDict() for name, timer in self._stages.items()}
+            counters = dict(self._counters)
+
+        gauges = {}
+        for name, read in self._gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:
+                pass
+
+        return {"stages": stages, "counters": counters, "gauges": gauges}
+
+    def prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            stages = list(self._stages.items())
+            counters = list(self._counters.items())
+
+        if stages:
+            lines.append("# TYPE bugg_stage_seconds histogram")
+            for name, timer in stages:
+                for bound, count in zip(STAGE_BUCKETS, timer.buckets):
+                    lines.append(f'bugg_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'bugg_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {timer.count}')
+                lines.append(f'bugg_stage_seconds_sum{{stage="{name}"}} {timer.totalSecs}')
+                lines.append(f'bugg_stage_seconds_count{{stage="{name}"}} {timer.count}')
+
+        for name, value in counters:
+            lines.append(f"# TYPE bugg_{name}_total counter")
+            lines.append(f"bugg_{name}_total {value}")
+
+        for name, value in self.snapshot()["gauges"].items():
+            lines.append(f"# TYPE bugg_{name} gauge")
+            lines.append(f"bugg_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def getMetrics() -> Metrics:
+    return _metrics
+
+
+@contextmanager
+def timeStage(name: str):
+    """
+    Times the block as one run of the named stage, e.g.
+
+        with timeStage("inference"):
+            results = an.analyse_audio(source)
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        _metrics.observeStage(name, time.monotonic() - start)
+
+
+def inCurrentMessage(func):
+    """
+    Wraps func so the stages it times on another thread, e.g. a helper computing features,
+    count towards the message this thread is handling
+    """
+    timings = getattr(_metrics._message, "timings", None)
+
+    def wrapped(*args, **kwargs):
+        _metrics._message.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _metrics._message.timings = None
+
+    return wrapped
+
+
+def incrementCounter(name: str, amount: float = 1):
+    _metrics.increment(name, amount)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(_metrics.snapshot()).encode("utf-8")
+            contentType = "application/json"
+        elif self.path.startswith("/metrics"):
+            body = _metrics.prometheus().encode("utf-8")
+            contentType = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise fill the worker's logs
+        pass
+
+
+def _dumpMetrics(interval: float, path: str):
+    while True:
+        time.sleep(interval)
+        dump = json.dumps(_metrics.snapshot())
+        print(f"Metrics: {dump}")
+        if path:
+            with open(path, "w") as f:
+                f.write(dump)
+
+
+_started = False
+
+
+def startMetrics(port: int = METRICS_PORT, dumpSecs: float = METRICS_DUMP_SECS, dumpPath: str = METRICS_DUMP_PATH):
+    """
+    Starts the /metrics endpoint and the periodic dump, if they are configured. Called by subscribe().
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+
+    if port > 0:
+        server = _ThreadingHTTPServer(("", port), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on port {port}")
+
+    if dumpSecs > 0:
+        threading.Thread(target=_dumpMetrics, args=(dumpSecs, dumpPath), daemon=True).start()
@@ -0,0 +1,126 @@
+"""
+The fetch record -> download -> analyse -> ack flow shared by the workers that analyse audio clips.
+
+With BUGG_PREFETCH set to K the subscriber leases K more messages than there are
+inference slots. Those messages fetch their record and download their audio while
+the current clips are being analysed, then wait for a slot, so the next clip is
+usually downloaded by the time the model is free. The Pub/Sub client keeps their
+leases extended while they wait.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from .admission import getAdmission, reserveMemory
+from .audio import fetchAudio, getAudioBlob
+from .audiocache import getAudioCache
+from .completed import isForced, shouldSkip
+from .metrics import incrementCounter, timeStage
+from .records import getAudioDBRecord
+from .subscriber import INFERENCE_WORKERS, MAX_MESSAGES, ackMessage
+from .writebehind import COMPLETION_BATCH_SIZE, isEnabled
+
+# Messages to fetch ahead of the ones being analysed
+PREFETCH = int(os.environ.get("BUGG_PREFETCH", "0"))
+# Upper bound on the audio being downloaded at once by in-flight messages
+PREFETCH_MAX_BYTES = int(os.environ.get("BUGG_PREFETCH_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class ByteBudget():
+    """
+    Blocks downloads once the audio being downloaded reaches the budget.
+    """
+
+    def __init__(self, maxBytes: int):
+        self.maxBytes = maxBytes
+        self._used = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, numBytes: int):
+        with self._condition:
+            # A single clip larger than the whole budget is let through on its own rather than waiting forever
+            while self._used > 0 and self._used + numBytes > self.maxBytes:
+                self._condition.wait()
+            self._used += numBytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._used -= numBytes
+                self._condition.notify_all()
+
+    def used(self) -> int:
+        return self._used
+
+
+class AudioPipeline():
+    """
+    Message callback for analyses that work on the audio clip named by the message, e.g.
+
+        on_message = AudioPipeline(analysis_id, on_process_audio)
+        subscribe(subscription_id, on_message, maxMessages=on_message.maxMessages)
+
+    process(audio_id, audio_rec, audio) should run the analysis (holding an inferenceSlot()
+    for the model) and mark it complete. audio is an AudioFile held in memory, its source()
+    can be handed straight to librosa. The message is acked once process returns (or once its
+    completion is committed, with write-behind on).
+
+    A clip the analysis has already done is acked without downloading it, unless the message
+    is forced (see completed.py). For a FusedRunner that means every analysis it runs, and
+    otherwise it is handed whether the message is forced so it can skip the ones that are done.
+    """
+
+    def __init__(self, analysisId: str, process, prefetch: int = PREFETCH, maxPrefetchBytes: int = PREFETCH_MAX_BYTES):
+        self.analysisId = analysisId
+        self.process = process
+        # The analyses process marks complete, which for a FusedRunner are its own
+        self.analysisIds = process.analysisIds() if hasattr(process, "analysisIds") else [analysisId]
+        self.prefetch = prefetch
+        # Messages waiting on write-behind still count against the subscriber's flow control
+        batched = COMPLETION_BATCH_SIZE if isEnabled() else 0
+        self.maxMessages = max(MAX_MESSAGES, INFERENCE_WORKERS + prefetch + batched)
+
+        self._budget = ByteBudget(maxPrefetchBytes) if prefetch > 0 else None
+
+    def __call__(self, message):
+        audioId = message.data.decode("utf-8")
+
+        # Fetch the database record we have for this audio clip
+        with timeStage("fetch_record"):
+            audioRec = getAudioDBRecord(audioId)
+
+        if shouldSkip(message, self.analysisIds, audioId, audioRec):
+            incrementCounter("messages_skipped")
+            ackMessage(message)
+            print(f"Skipping {audioId} as {', '.join(self.analysisIds)} already completed it")
+            return
+
+        # The size is only worth a metadata request before downloading when room has to be reserved
+        # for the clip, or the audio cache needs its checksum. Otherwise the download is all there is
+        needsMetadata = self._budget is not None or getAdmission() is not None or getAudioCache() is not None
+        with timeStage("download"):
+            blob = getAudioBlob(audioRec, metadata=needsMetadata)
+
+        with reserveMemory(blob.size):
+            self._analyse(audioId, audioRec, blob, isForced(message))
+
+        ackMessage(message)
+        print(f"Processing complete for {audioId}")
+
+    def _analyse(self, audioId: str, audioRec: dict, blob, forced: bool):
+        # The prefetch budget only covers the download, so one message's audio waiting on the model
+        # doesn't hold up the next message's download
+        with timeStage("download"):
+            if self._budget is None:
+                audio = fetchAudio(audioRec, blob)
+            else:
+                with self._budget.reserve(blob.size or 0):
+                    audio = fetchAudio(audioRec, blob)
+        incrementCounter("audio_bytes", audio.size)
+
+        with audio:
+            if hasattr(self.process, "analysisIds"):
+                self.process(audioId, audioRec, audio, forced=forced)
+            else:
+                self.process(audioId, audioRec, audio)
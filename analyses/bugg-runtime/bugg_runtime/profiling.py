@@ -0,0 +1,168 @@
+"""
+Profiling a live worker on demand.
+
+Nothing is profiled unless it is asked for, either with BUGG_PROFILE_MESSAGES at startup
+or by publishing a control message to the worker's topic:
+
+    gcloud pubsub topics publish analyses.vggish --attribute=control=profile,messages=20
+
+The next N messages are then sampled every BUGG_PROFILE_INTERVAL_SECS by a background
+thread reading the stack of the thread handling each one, which covers the model calls
+(analyse_audio, analyzeAudioData, detect_speech, ...) without touching them. Each
+message's samples are written in the collapsed stack format that flamegraph.pl and
+speedscope read, to artifacts/profiles/{analysisId}/{messageId}.folded in the bucket.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from .clients import getBucket
+
+# Messages to profile once the worker starts
+PROFILE_MESSAGES = int(os.environ.get("BUGG_PROFILE_MESSAGES", "0"))
+# Time between samples of a profiled message's stack
+PROFILE_INTERVAL_SECS = float(os.environ.get("BUGG_PROFILE_INTERVAL_SECS", "0.01"))
+# Write the profiles to this directory rather than the bucket
+PROFILE_DIR = os.environ.get("BUGG_PROFILE_DIR")
+
+# Messages asked for by a control message that doesn't say how many
+DEFAULT_PROFILE_MESSAGES = 10
+
+
+class StackSampler():
+    """
+    Counts the stacks seen on the threads it is watching, sampling from its own thread while there are any.
+    """
+
+    def __init__(self, intervalSecs: float = PROFILE_INTERVAL_SECS):
+        self.intervalSecs = intervalSecs
+        self._watched = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @contextmanager
+    def watch(self, threadId: int):
+        """
+        Samples the thread until the block exits, yielding the Counter of collapsed stacks
+        """
+        counts = Counter()
+        with self._condition:
+            self._watched[threadId] = counts
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        try:
+            yield counts
+        finally:
+            with self._condition:
+                self._watched.pop(threadId, None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._watched) == 0:
+                    self._condition.wait()
+                watched = list(self._watched.items())
+
+            frames = sys._current_frames()
+            for threadId, counts in watched:
+                frame = frames.get(threadId)
+                if frame is not None:
+                    counts[collapseStack(frame)] += 1
+
+            time.sleep(self.intervalSecs)
+
+
+def collapseStack(frame) -> str:
+    """
+    The stack from the outermost call in, as "func (file.py:line);func (file.py:line);..."
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+_sampler = StackSampler()
+_lock = threading.Lock()
+_remaining = PROFILE_MESSAGES
+
+
+def requestProfile(numMessages: int):
+    """
+    Profiles the next numMessages messages this process handles
+    """
+    global _remaining
+    with _lock:
+        _remaining = numMessages
+    print(f"Profiling the next {numMessages} messages")
+
+
+def _claimProfile() -> bool:
+    global _remaining
+    with _lock:
+        if _remaining <= 0:
+            return False
+        _remaining -= 1
+        return True
+
+
+def isControlMessage(message) -> bool:
+    return bool(message.attributes) and message.attributes.get("control") == "profile"
+
+
+def handleControlMessage(message):
+    requestProfile(int(message.attributes.get("messages", DEFAULT_PROFILE_MESSAGES)))
+    message.ack()
+
+
+def withProfiling(callback, analysisId: str):
+    """
+    Wraps a message callback so that control messages turn profiling on, and profiled messages are sampled
+    """
+    def wrapped(message):
+        if isControlMessage(message):
+            handleControlMessage(message)
+            return
+
+        # Checked without the lock so messages that aren't profiled don't contend on it
+        if _remaining <= 0 or not _claimProfile():
+            callback(message)
+            return
+
+        start = time.monotonic()
+        with _sampler.watch(threading.get_ident()) as counts:
+            try:
+                callback(message)
+            finally:
+                saveProfile(analysisId, message, counts, time.monotonic() - start)
+
+    return wrapped
+
+
+def saveProfile(analysisId: str, message, counts: Counter, secs: float):
+    folded = "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    name = f"{analysisId}/{message.message_id}.folded"
+
+    try:
+        if PROFILE_DIR:
+            path = os.path.join(PROFILE_DIR, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(folded)
+        else:
+            blob = getBucket().blob(f"artifacts/profiles/{name}")
+            blob.metadata = {"analysisId": analysisId, "messageId": message.message_id, "data": message.data.decode("utf-8")}
+            blob.upload_from_string(folded, content_type="text/plain")
+            path = f"gs://{blob.bucket.name}/{blob.name}"
+    except Exception as e:
+        print(f"WARNING: Failed to save the profile of message {message.message_id}: {e}")
+        return
+
+    print(f"Saved profile of message {message.message_id} ({sum(counts.values())} samples over {secs:.1f}s) to {path}")
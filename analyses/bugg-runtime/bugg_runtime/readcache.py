@@ -0,0 +1,71 @@
+"""
+A small in-process cache for Firestore documents that change slowly, e.g. recorders and models.
+
+Thousands of consecutive clips from one recorder read the same handful of documents, so
+caching them for even a second saves most of those reads.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# How long a document may be served from the cache before it is read again
+DOC_CACHE_SECS = float(os.environ.get("BUGG_DOC_CACHE_SECS", "1"))
+# Documents kept per process, least recently used are dropped first
+DOC_CACHE_SIZE = int(os.environ.get("BUGG_DOC_CACHE_SIZE", "1024"))
+
+
+class TTLCache():
+    """
+    A thread-safe LRU cache whose entries expire after their own TTL.
+    """
+
+    def __init__(self, maxEntries: int, ttlSecs: float):
+        self.maxEntries = maxEntries
+        self.ttlSecs = ttlSecs
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load, ttlSecs=None):
+        """
+        Returns the cached value for key, or calls load() and caches what it returns.
+
+        ttlSecs is the number of seconds to keep it, or a function of the value returning it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Loaded outside the lock so a slow read doesn't hold up other keys. Two threads
+        # missing on the same key at once will both load it, which is harmless.
+        value = load()
+
+        if ttlSecs is None:
+            ttlSecs = self.ttlSecs
+        elif callable(ttlSecs):
+            ttlSecs = ttlSecs(value)
+
+        if ttlSecs > 0:
+            with self._lock:
+                self._entries[key] = (time.monotonic() + ttlSecs, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxEntries:
+                    self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
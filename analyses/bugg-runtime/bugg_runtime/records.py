@@ -0,0 +1,394 @@
+"""
+Reading and updating the audio records the analyses work against.
+"""
+import copy
+import hashlib
+import os
+from typing import List
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from .clients import getDb, transactional
+from .completed import rememberCompleted
+from .metrics import incrementCounter, timeStage
+from .readcache import DOC_CACHE_SECS, DOC_CACHE_SIZE, TTLCache
+from .writebehind import CompletionWrite, ResultWrite, stageWrite
+
+# How markAnalysisComplete writes to the audio record, "transaction" or "union" (see markAnalysisComplete)
+COMPLETION_MODE = os.environ.get("BUGG_COMPLETION_MODE", "transaction")
+# Where markAnalysisComplete puts detections, "record" (the detections array) or "subcollection" (audio/{id}/detections)
+DETECTION_STORAGE = os.environ.get("BUGG_DETECTION_STORAGE", "record")
+# Firestore's limit on writes in one batch
+MAX_BATCH_WRITES = 500
+
+_documentCache = TTLCache(DOC_CACHE_SIZE, DOC_CACHE_SECS)
+
+
+def getAudioDBRecord(audioId: str):
+    # fetches the record we have for this audio file from the database
+    audio_ref = getDb().collection(u'audio').document(audioId)
+    doc = audio_ref.get()
+    if doc.exists:
+        return doc.to_dict()
+
+    return None
+
+
+def getRecorder(projectId: str, recorderId: str):
+    """
+    Returns the recorder record from firestore, up to BUGG_DOC_CACHE_SECS old.
+    """
+    return getDocument(f"projects/{projectId}/recorders/{recorderId}")
+
+
+def getDocument(path: str, ttlSecs=None):
+    """
+    Reads a slow-changing document (recorder, model, analysis config) through the process's
+    read cache. Returns its data, or None if it doesn't exist.
+
+    ttlSecs overrides BUGG_DOC_CACHE_SECS, and can be a function of the data (None when missing).
+    """
+    def load():
+        doc = getDb().document(path).get()
+        return doc.to_dict() if doc.exists else None
+
+    # Copied so callers can't change what the next message gets
+    return copy.deepcopy(_documentCache.get(path, load, ttlSecs))
+
+
+def invalidateDocument(path: str):
+    """
+    Drops a document from the read cache, e.g. after writing to it.
+    """
+    _documentCache.invalidate(path)
+
+
+def getAnalysisResult(analysisId: str, audioId: str):
+    """
+    Will return the result from firestore if there is one or None if not.
+
+    Note that storing results in the palce is optional (and subject to 1mb limit). This method is just for convenience
+    """
+    results_ref = getDb().collection(u'audio').document(audioId).collection(analysisId).document(u'result')
+    doc = results_ref.get()
+    if doc.exists:
+        return doc.to_dict()
+
+    return None
+
+
+def setAnalysisResult(analysisId: str, audioId: str, result: dict):
+    """
+    Store a result in the common place in firestore. Will merge into any existing result.
+
+    (Storing in this spot is optional.)
+
+    Note no transactions are used, you may want to explore them if writing multiple entries.
+    """
+    if stageWrite(ResultWrite(analysisId, audioId, result)):
+        return
+
+    with timeStage("commit"):
+        _resultRef(analysisId, audioId).set(result, merge=True)
+
+
+def _resultRef(analysisId: str, audioId: str):
+    return getDb().collection(u'audio').document(audioId).collection(analysisId).document(u'result')
+
+
+def recordDetection(analysisId: str, audioId: str, startTimeSecs: int, endTimeSecs: int, tags: List[str]):
+    """
+    Record a detection discovered within this audio
+    """
+
+    # To prevent duplicates we need some stable ID. Attempt to derive one from the timestamps
+    idStr = f"{analysisId}-{startTimeSecs}-{endTimeSecs}"
+    id = hashlib.md5(idStr.encode()).hexdigest()
+
+    results_ref = getDb().collection(u'audio').document(audioId).collection("detections").document(id)
+    results_ref.set({
+        u'id': id,
+        # The timestamp in seconds the detection occured in the sample
+        u'start': startTimeSecs,
+        # The timestamp in seconds the detection finished in the sample
+        u'end': endTimeSecs,
+        # Supplied tags to help classify the audio. Usually user supplied
+        u'tags': tags,
+        # The analysis that produced this detection
+        u'analysisId': analysisId
+    }, merge=True)
+
+
+def mergeDetections(prevDetections: list, detections: list) -> list:
+    """
+    Merges newly found detections into the ones already on the audio record.
+
+    Existing detections keep their place, with any new detection of the same id merged over
+    the top (the analysis may be re-run after an update). Detections with new ids are
+    appended in order. Where the new list repeats an id the first one wins.
+    """
+    newById = {}
+    for d in detections:
+        newById.setdefault(d["id"], d)
+
+    newDetectionsList = []
+    for d in prevDetections:
+        match = newById.get(d["id"])
+        if match is None:
+            newDetectionsList.append(d)
+        else:
+            # Merge the two, letting the newer one overrite the old
+            newDetectionsList.append({**d, **match})
+
+    seen = {d["id"] for d in prevDetections}
+    for d in detections:
+        if d["id"] not in seen:
+            seen.add(d["id"])
+            newDetectionsList.append(d)
+
+    return newDetectionsList
+
+
+def writeDetections(audioId: str, detections: list):
+    """
+    Writes each detection to its own document in audio/{audioId}/detections, merging into any with the same id.
+    """
+    db = getDb()
+    detectionsRef = db.collection(u'audio').document(audioId).collection(u'detections')
+
+    # In batches rather than a BulkWriter, as a batch that fails raises, so the message is nacked and redelivered
+    for i in range(0, len(detections), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for d in detections[i:i + MAX_BATCH_WRITES]:
+            batch.set(detectionsRef.document(d["id"]), d, merge=True)
+        batch.commit()
+
+
+def markAnalysisComplete(analysisId: str, audioId: str, detections: list = None, mode: str = None, storage: str = None):
+    """
+    Updates the audio record to show that analysis is done (which will kick off other analyses)
+
+    In "transaction" mode the record is read and its detections merged in a transaction, so a
+    re-run's detections replace the ones with the same id. In "union" mode the analysis and
+    its detections are added with ArrayUnion in one blind write, so analyses finishing on the
+    same clip never retry against each other. A re-run that produces different detections
+    with the same ids will then leave both versions on the record.
+
+    With storage="subcollection" the detections are written to audio/{audioId}/detections
+    first and the record only gets a summary of them (see _summaryUpdate).
+
+    When write-behind is on the write is held back and committed with other messages' (see writebehind).
+    """
+    mode = mode or COMPLETION_MODE
+    storage = storage or DETECTION_STORAGE
+    if mode not in ("transaction", "union"):
+        raise ValueError(f"Unknown completion mode {mode}")
+    if storage not in ("record", "subcollection"):
+        raise ValueError(f"Unknown detection storage {storage}")
+
+    incrementCounter("completions")
+    incrementCounter("detections", len(detections or []))
+
+    write = CompletionWrite(analysisId, audioId, detections or [], mode, storage)
+    if stageWrite(write):
+        return
+
+    with timeStage("commit"):
+        _writeCompletion(write)
+
+
+def _rememberCompletions(writes: list):
+    for write in writes:
+        if isinstance(write, CompletionWrite):
+            rememberCompleted(write.analysisId, write.audioId)
+
+
+def _writeCompletion(write: CompletionWrite):
+    if write.storage == "subcollection":
+        # Detections go in before analysesPerformed changes, so whatever gets triggered can see them
+        writeDetections(write.audioId, write.detections)
+
+    if write.mode == "union":
+        _audioRef(write.audioId).update(_unionUpdate(write))
+    else:
+        transaction = getDb().transaction()
+        _markCompleteInTransaction(transaction, write)
+
+    _rememberCompletions([write])
+
+
+@transactional
+def _markCompleteInTransaction(transaction, write: CompletionWrite):
+    audioRef = _audioRef(write.audioId)
+    snapshot = audioRef.get(transaction=transaction)
+    transaction.update(audioRef, _transactionUpdate(snapshot.to_dict(), write))
+
+
+def _transactionUpdate(audioRecord: dict, write: CompletionWrite) -> dict:
+    """
+    The update that marks the analysis complete on a record that has just been read
+    """
+    analysesPerformed = audioRecord[u'analysesPerformed']
+
+    if write.analysisId in analysesPerformed:
+        print(f"WARNING: Analysis {write.analysisId} was already completed for {write.audioId}")
+    else:
+        analysesPerformed.append(write.analysisId)
+
+    if write.storage == "subcollection":
+        update = _summaryUpdate(audioRecord, write)
+    else:
+        newDetectionsList = mergeDetections(audioRecord.get("detections") or [], write.detections)
+        update = {
+            u'detections': newDetectionsList,
+            u'hasDetections': len(newDetectionsList) > 0
+        }
+
+    update[u'analysesPerformed'] = analysesPerformed
+    return update
+
+
+def _summaryUpdate(audioRecord: dict, write: CompletionWrite) -> dict:
+    """
+    Keeps detectionCount, detectionCounts (per analysis) and hasDetections on the record in
+    step with the subcollection. The counts are from each analysis's latest run.
+    """
+    detectionCounts = audioRecord.get(u'detectionCounts') or {}
+    detectionCounts[write.analysisId] = len(write.detections)
+    # Detections written to the record before switching to the subcollection still count, unless their
+    # analysis has run again since, in which case its count already covers them
+    onRecord = [d for d in audioRecord.get(u'detections') or [] if d.get(u'analysisId') not in detectionCounts]
+    detectionCount = sum(detectionCounts.values()) + len(onRecord)
+
+    return {
+        u'detectionCounts': detectionCounts,
+        u'detectionCount': detectionCount,
+        u'hasDetections': detectionCount > 0
+    }
+
+
+def _unionUpdate(write: CompletionWrite) -> dict:
+    """
+    The blind-write version of _transactionUpdate. With subcollection storage it can't total
+    the counts without a read, so it sets this analysis's entry in detectionCounts and removes
+    detectionCount rather than leave a stale total. The next transaction mode completion puts it back.
+    """
+    # analysesPerformed only changes the first time the analysis completes, so the
+    # analysisTriggerCompletedAnalysis function still fires exactly once per analysis
+    update = {
+        u'analysesPerformed': firestore.ArrayUnion([write.analysisId]),
+    }
+
+    if write.storage == "subcollection":
+        update[FieldPath(u'detectionCounts', write.analysisId).to_api_repr()] = len(write.detections)
+        update[u'detectionCount'] = firestore.DELETE_FIELD
+    elif len(write.detections) > 0:
+        update[u'detections'] = firestore.ArrayUnion(write.detections)
+
+    if len(write.detections) > 0:
+        update[u'hasDetections'] = True
+
+    return update
+
+
+def _audioRef(audioId: str):
+    return getDb().collection(u'audio').document(audioId)
+
+
+def _writeCount(write) -> int:
+    if isinstance(write, CompletionWrite) and write.storage == "subcollection":
+        return 1 + len(write.detections)
+    return 1
+
+
+def commitWrites(writes: list):
+    """
+    Commits writes held back by write-behind, up to MAX_BATCH_WRITES to a commit.
+
+    Completions in transaction mode are read and merged inside the commit's transaction, so
+    several completions for the same clip fold into one update exactly as if made one by one.
+    """
+    with timeStage("commit"):
+        _commitInChunks(writes)
+    _rememberCompletions(writes)
+
+
+def _commitInChunks(writes: list):
+    chunk = []
+    chunkWrites = 0
+    for write in writes:
+        count = _writeCount(write)
+        if count > MAX_BATCH_WRITES:
+            # Too many detections to share a commit, so it is written on its own
+            _writeNow(write)
+            continue
+
+        if chunkWrites + count > MAX_BATCH_WRITES:
+            _commitChunk(chunk)
+            chunk = []
+            chunkWrites = 0
+
+        chunk.append(write)
+        chunkWrites += count
+
+    if len(chunk) > 0:
+        _commitChunk(chunk)
+
+
+def _writeNow(write):
+    if isinstance(write, CompletionWrite):
+        _writeCompletion(write)
+    else:
+        _resultRef(write.analysisId, write.audioId).set(write.result, merge=True)
+
+
+def _commitChunk(writes: list):
+    if any(isinstance(w, CompletionWrite) and w.mode == "transaction" for w in writes):
+        transaction = getDb().transaction()
+        _commitInTransaction(transaction, writes)
+    else:
+        batch = getDb().batch()
+        _applyWrites(batch, writes, {})
+        batch.commit()
+
+
+@transactional
+def _commitInTransaction(transaction, writes: list):
+    audioIds = sorted({w.audioId for w in writes if isinstance(w, CompletionWrite) and w.mode == "transaction"})
+    snapshots = transaction.get_all([_audioRef(audioId) for audioId in audioIds])
+    audioRecords = {snapshot.id: snapshot.to_dict() for snapshot in snapshots}
+
+    _applyWrites(transaction, writes, audioRecords)
+
+
+def _applyWrites(writer, writes: list, audioRecords: dict):
+    """
+    Adds the writes to a WriteBatch or Transaction. audioRecords holds the records read for
+    transaction mode completions, and is updated as each one is applied.
+    """
+    folded = {}
+    unions = []
+    for write in writes:
+        if isinstance(write, ResultWrite):
+            writer.set(_resultRef(write.analysisId, write.audioId), write.result, merge=True)
+            continue
+
+        if write.storage == "subcollection":
+            detectionsRef = _audioRef(write.audioId).collection(u'detections')
+            for d in write.detections:
+                writer.set(detectionsRef.document(d["id"]), d, merge=True)
+
+        if write.mode == "union":
+            unions.append(write)
+        else:
+            update = _transactionUpdate(audioRecords[write.audioId], write)
+            audioRecords[write.audioId].update(update)
+            folded.setdefault(write.audioId, {}).update(update)
+
+    for audioId, update in folded.items():
+        writer.update(_audioRef(audioId), update)
+
+    # After the folded updates, which would otherwise overwrite analysesPerformed without them
+    for write in unions:
+        writer.update(_audioRef(write.audioId), _unionUpdate(write))
@@ -0,0 +1,255 @@
+"""
+Pulling analysis jobs off Pub/Sub.
+
+By default a worker handles one message at a time, exactly as before. Setting
+BUGG_MAX_MESSAGES lets it hold several messages in flight so downloads and Firestore
+round-trips overlap, while BUGG_INFERENCE_WORKERS bounds how many of them can be
+running the model at once.
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from contextlib import contextmanager
+
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+from .admission import getAdmission, startAdmission
+from .audiocache import getAudioCacheStats
+from .clients import PROJECT_ID, getSubscriberClient
+from .lanes import (BULK, BULK_LANE, PRIORITY, LaneScheduler, bulkSubscription,
+                    inLane)
+from .metrics import getMetrics, incrementCounter, startMetrics
+from .profiling import withProfiling
+from .records import commitWrites
+from .writebehind import (COMPLETION_BATCH_SIZE, WriteBehindBuffer, isEnabled,
+                          stagingWrites, takeStagedWrites)
+
+# Messages leased and worked on at the same time
+MAX_MESSAGES = int(os.environ.get("BUGG_MAX_MESSAGES", "1"))
+# How many of the in-flight messages may be doing inference at the same time
+INFERENCE_WORKERS = int(os.environ.get("BUGG_INFERENCE_WORKERS", "1"))
+# How often to print how busy the worker is. 0 turns it off
+STATUS_INTERVAL_SECS = float(os.environ.get("BUGG_STATUS_INTERVAL_SECS", "60"))
+# Longest the client keeps extending a message's lease while it is held, e.g. waiting for a prefetched clip's turn
+MAX_LEASE_SECS = int(os.environ.get("BUGG_MAX_LEASE_SECS", "3600"))
+
+
+class InferencePool():
+    """
+    A fixed number of slots for CPU-heavy work, shared by every message thread.
+
+    The model is loaded once per process and used from whichever thread holds a slot.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._busy = 0
+
+    @contextmanager
+    def slot(self):
+        self._semaphore.acquire()
+        with self._lock:
+            self._busy += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._busy -= 1
+            self._semaphore.release()
+
+    def busy(self) -> int:
+        return self._busy
+
+
+_inferencePool = InferencePool(INFERENCE_WORKERS)
+_inFlightLock = threading.Lock()
+_inFlight = 0
+_maxMessages = MAX_MESSAGES
+_writeBehind = WriteBehindBuffer(commitWrites) if isEnabled() else None
+_lanes = None
+
+
+def inferenceSlot():
+    """
+    Hold one of the process's inference slots while running the model, e.g.
+
+        with inferenceSlot():
+            results = an.analyse_audio(audio_file_path)
+    """
+    return _inferencePool.slot()
+
+
+def _slots() -> int:
+    """
+    How many messages may run at once, which admission control can lower
+    """
+    admission = getAdmission()
+    return admission.limit if admission is not None else _maxMessages
+
+
+def getStatus() -> dict:
+    """
+    How many of the in-flight and inference slots are currently busy
+    """
+    return {
+        "inFlight": _inFlight,
+        "maxMessages": _maxMessages,
+        "inferenceBusy": _inferencePool.busy(),
+        "inferenceWorkers": _inferencePool.size,
+        "writeBehindPending": _writeBehind.pending() if _writeBehind is not None else 0,
+        "admissionLimit": _slots(),
+        "bulkRunning": _lanes.running[BULK] if _lanes is not None else 0,
+        "bulkWaiting": _lanes.waiting[BULK] if _lanes is not None else 0,
+    }
+
+
+def ackMessage(message):
+    """
+    Acks the message once its writes are in. Use it instead of message.ack() so write-behind
+    can hold the ack until the batch holding the message's completion has committed.
+    """
+    writes = takeStagedWrites()
+    if _writeBehind is not None and len(writes) > 0:
+        _writeBehind.submit(message, writes)
+    else:
+        message.ack()
+
+
+def _trackInFlight(callback):
+    def wrapped(message):
+        global _inFlight
+        with _inFlightLock:
+            _inFlight += 1
+        incrementCounter("messages_received")
+
+        admission = getAdmission()
+        if admission is not None and not admission.acquire():
+            print(f"Handing back message {message.message_id} after waiting {admission.maxWaitSecs:.0f}s to start")
+            incrementCounter("messages_handed_back")
+            message.nack()
+            with _inFlightLock:
+                _inFlight -= 1
+            return
+
+        try:
+            with getMetrics().message(message.message_id), stagingWrites():
+                callback(message)
+                # Writes made after the callback acked the message itself can't be held back
+                leftover = takeStagedWrites()
+                if len(leftover) > 0:
+                    commitWrites(leftover)
+        except Exception:
+            incrementCounter("messages_failed")
+            raise
+        finally:
+            if admission is not None:
+                admission.release()
+            with _inFlightLock:
+                _inFlight -= 1
+
+    return wrapped
+
+
+def _reportStatus(interval: float):
+    while True:
+        time.sleep(interval)
+        status = getStatus()
+        print(f"Status: {status['inFlight']}/{status['maxMessages']} messages in flight "
+              f"({status['admissionLimit']} allowed to run), "
+              f"{status['inferenceBusy']}/{status['inferenceWorkers']} inference slots busy")
+        if _lanes is not None:
+            print(f"Lanes: {_lanes.running[PRIORITY]} priority and {status['bulkRunning']} bulk messages running, "
+                  f"{_lanes.waiting[PRIORITY]} priority and {status['bulkWaiting']} bulk waiting")
+
+        cacheStats = getAudioCacheStats()
+        if cacheStats:
+            print(f"Audio cache: {cacheStats['hits']} hits, {cacheStats['misses']} misses "
+                  f"({cacheStats['hitRate']:.0%}), {cacheStats['bytesServed']} bytes served from cache, "
+                  f"~{cacheStats['downloadSecsSaved']:.1f}s of downloading saved")
+
+
+def subscribe(subscriptionId: str, callback, maxMessages: int = None, analysisId: str = None):
+    """
+    Streams messages from the subscription into the callback until the process is stopped.
+
+    Each in-flight message is handled on its own thread. Exceptions raised by the callback nack the message.
+    analysisId tags the worker's profiles, and defaults to the callback's (for an AudioPipeline) or the subscription.
+    With BUGG_BULK_LANE=1 the subscription's bulk lane is streamed into the same callback too, see lanes.py.
+
+    With write-behind completions, acked messages stay leased until their batch commits, so the lease is
+    raised to hold a full batch as well as the messages being worked on. Otherwise a batch could never fill
+    and every message would wait out BUGG_COMPLETION_BATCH_SECS.
+    """
+    global _maxMessages, _lanes
+    _maxMessages = maxMessages or MAX_MESSAGES
+    if isEnabled():
+        _maxMessages = max(_maxMessages, COMPLETION_BATCH_SIZE + INFERENCE_WORKERS)
+    analysisId = analysisId or getattr(callback, "analysisId", subscriptionId)
+
+    subscriber = getSubscriberClient()
+    subscription_path = subscriber.subscription_path(PROJECT_ID, subscriptionId)
+    handler = _trackInFlight(withProfiling(callback, analysisId))
+
+    if BULK_LANE:
+        # The lanes share the admission limit, and take their turn before the controller sees the message
+        _lanes = LaneScheduler(_slots)
+        lanes = [(subscriptionId, inLane(_lanes, PRIORITY, handler), _maxMessages),
+                 # Bulk messages beyond the slots they can have would only sit on a lease
+                 (bulkSubscription(subscriptionId), inLane(_lanes, BULK, handler),
+                  max(1, _maxMessages - _lanes.reservedSlots))]
+    else:
+        lanes = [(subscriptionId, handler, _maxMessages)]
+
+    streaming_pull_futures = []
+    for laneSubscriptionId, laneCallback, laneMessages in lanes:
+        # The streaming pull keeps every unacked message leased, up to max_lease_duration
+        flow_control = pubsub_v1.types.FlowControl(max_messages=laneMessages, max_lease_duration=MAX_LEASE_SECS)
+        executor = ThreadPoolExecutor(max_workers=laneMessages, thread_name_prefix="bugg-message")
+        streaming_pull_futures.append(subscriber.subscribe(
+            subscriber.subscription_path(PROJECT_ID, laneSubscriptionId), callback=laneCallback,
+            flow_control=flow_control, scheduler=ThreadScheduler(executor)
+        ))
+
+    print(f"Listening for messages on {subscription_path} with {_maxMessages} in flight "
+          f"and {_inferencePool.size} inference slots..\n")
+    if _lanes is not None:
+        print(f"Sharing them with the bulk lane {bulkSubscription(subscriptionId)}, weighted "
+              f"{_lanes.weights[PRIORITY]}:{_lanes.weights[BULK]} with {_lanes.reservedSlots} kept for priority messages")
+
+    if STATUS_INTERVAL_SECS > 0:
+        threading.Thread(target=_reportStatus, args=(STATUS_INTERVAL_SECS,), daemon=True).start()
+
+    metrics = getMetrics()
+    metrics.registerGauge("messages_in_flight", lambda: _inFlight)
+    metrics.registerGauge("inference_busy", _inferencePool.busy)
+    if _writeBehind is not None:
+        metrics.registerGauge("write_behind_pending", _writeBehind.pending)
+    if _lanes is not None:
+        for lane in (PRIORITY, BULK):
+            metrics.registerGauge(f"lane_{lane}_running", lambda lane=lane: _lanes.running[lane])
+            metrics.registerGauge(f"lane_{lane}_waiting", lambda lane=lane: _lanes.waiting[lane])
+
+    admission = startAdmission(_maxMessages, backlog=_lanes.backlog if _lanes is not None else None)
+    if admission is not None:
+        metrics.registerGauge("admission_limit", lambda: admission.limit)
+        metrics.registerGauge("admission_waiting", lambda: admission.waiting)
+        metrics.registerGauge("admission_reserved_bytes", lambda: admission.reservedBytes)
+    startMetrics()
+
+    # Wrap subscriber in a 'with' block to automatically call close() when done.
+    with subscriber:
+        try:
+            # Blocks until either stream stops, which then stops the other too
+            wait(streaming_pull_futures, return_when=FIRST_COMPLETED)
+            for streaming_pull_future in streaming_pull_futures:
+                streaming_pull_future.cancel()
+            for streaming_pull_future in streaming_pull_futures:
+                streaming_pull_future.result()
+        except TimeoutError:
+            for streaming_pull_future in streaming_pull_futures:
+                streaming_pull_future.cancel()  # Trigger the shutdown.
+                streaming_pull_future.result()  # Block until the shutdown is complete.
@@ -0,0 +1,127 @@
+"""
+Holding back Firestore writes so several messages' completions go in one commit.
+
+With BUGG_COMPLETION_BATCH_SIZE set above 1, markAnalysisComplete and setAnalysisResult
+don't write straight away while a message is being handled. Their writes are staged
+against the message, and ackMessage() hands them to a WriteBehindBuffer instead of acking.
+The buffer commits a batch once it holds BUGG_COMPLETION_BATCH_SIZE messages or its oldest
+has waited BUGG_COMPLETION_BATCH_SECS, then acks every message in the batch. If the commit
+fails they are all nacked and redelivered, and the writes are as safe to repeat as they
+were when made one at a time.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Messages whose writes are committed together, 0 or 1 to write as each message goes
+COMPLETION_BATCH_SIZE = int(os.environ.get("BUGG_COMPLETION_BATCH_SIZE", "0"))
+# Longest a message's writes are held back waiting for the batch to fill
+COMPLETION_BATCH_SECS = float(os.environ.get("BUGG_COMPLETION_BATCH_SECS", "1"))
+
+CompletionWrite = namedtuple("CompletionWrite", ["analysisId", "audioId", "detections", "mode", "storage"])
+ResultWrite = namedtuple("ResultWrite", ["analysisId", "audioId", "result"])
+
+_staged = threading.local()
+
+
+def isEnabled() -> bool:
+    return COMPLETION_BATCH_SIZE > 1
+
+
+def isStaging() -> bool:
+    return getattr(_staged, "writes", None) is not None
+
+
+@contextmanager
+def stagingWrites(always: bool = False):
+    """
+    Stages the writes made on this thread until takeStagedWrites(). Used around each message's
+    callback when write-behind is on, and by anything else that wants to commit several writes together.
+    """
+    if not (always or isEnabled()):
+        yield
+        return
+
+    _staged.writes = []
+    try:
+        yield
+    finally:
+        _staged.writes = None
+
+
+def stageWrite(write) -> bool:
+    """
+    Holds the write back if the current message's writes are being staged, otherwise returns False so it is made now
+    """
+    writes = getattr(_staged, "writes", None)
+    if writes is None:
+        return False
+
+    writes.append(write)
+    return True
+
+
+def takeStagedWrites() -> list:
+    writes = getattr(_staged, "writes", None) or []
+    if writes:
+        _staged.writes = []
+    return writes
+
+
+class WriteBehindBuffer():
+    """
+    Collects messages with their staged writes and commits them in batches, acking each message once its batch is in.
+    """
+
+    def __init__(self, commit, maxMessages: int = COMPLETION_BATCH_SIZE, maxDelaySecs: float = COMPLETION_BATCH_SECS):
+        self.commit = commit
+        self.maxMessages = maxMessages
+        self.maxDelaySecs = maxDelaySecs
+
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, message, writes: list):
+        with self._condition:
+            self._pending.append((message, writes, time.monotonic()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+
+                while len(self._pending) < self.maxMessages:
+                    remaining = self.maxDelaySecs - (time.monotonic() - self._pending[0][2])
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = self._pending[:self.maxMessages]
+                self._pending = self._pending[self.maxMessages:]
+
+            self.flush(batch)
+
+    def flush(self, batch: list):
+        writes = [w for _, messageWrites, _ in batch for w in messageWrites]
+        try:
+            self.commit(writes)
+        except Exception as e:
+            print(f"WARNING: Failed to commit writes for {len(batch)} messages, they will be redelivered: {e}")
+            for message, _, _ in batch:
+                message.nack()
+            return
+
+        for message, _, _ in batch:
+            message.ack()
+        print(f"Committed {len(writes)} writes for {len(batch)} messages")
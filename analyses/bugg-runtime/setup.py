@@ -0,0 +1,15 @@
+from setuptools import find_packages, setup
+
+setup(
+    name='bugg-runtime',
+    version='0.1.0',
+    description='Shared runtime for the bugg analysis workers',
+    packages=find_packages(),
+    install_requires=[
+        'google-cloud-firestore',
+        'google-cloud-pubsub',
+        'google-cloud-storage',
+        'numpy',
+        'requests',
+    ],
+)
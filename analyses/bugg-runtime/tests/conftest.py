@@ -0,0 +1,11 @@
+"""
+Runs the tests against the local backend, which has to be chosen before bugg_runtime is imported.
+"""
+import os
+import sys
+import tempfile
+
+os.environ["BUGG_BACKEND"] = "local"
+os.environ.setdefault("BUGG_LOCAL_STORAGE_DIR", tempfile.mkdtemp(prefix="bugg-tests-"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,178 @@
+import threading
+
+import pytest
+
+from bugg_runtime import admission, subscriber
+from bugg_runtime.admission import AdmissionController, reserveMemory
+
+MB = 2 ** 20
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    """
+    The RSS and CPU use the controller sees, set by each test
+    """
+    state = {"rss": 100 * MB, "cpu": 0.0}
+    monkeypatch.setattr(admission, "rssBytes", lambda: state["rss"])
+    monkeypatch.setattr(AdmissionController, "_cpuUtilisation", lambda self: state["cpu"])
+    return state
+
+
+def controller(**kwargs) -> AdmissionController:
+    options = {"maxMessages": 8, "minMessages": 1, "memoryCeiling": 1000 * MB, "maxWaitSecs": 5}
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test_limit_rises_while_messages_wait_and_there_is_room(machine):
+    c = controller(maxMessages=3)
+    c.running = 1
+    c.waiting = 1
+
+    for _ in range(5):
+        c.adjust()
+        c.running = c.limit
+
+    assert c.limit == 3
+
+
+def test_limit_stays_put_with_nothing_waiting(machine):
+    c = controller()
+    c.running = 1
+
+    c.adjust()
+
+    assert c.limit == 1
+
+
+def test_a_backlog_outside_the_controller_counts_as_waiting(machine):
+    c = controller(backlog=lambda: 4)
+    c.running = 1
+
+    c.adjust()
+
+    assert c.limit == 2
+
+
+def test_limit_drops_by_one_over_the_memory_or_cpu_target(machine):
+    c = controller()
+    c.limit = 6
+
+    machine["rss"] = 800 * MB
+    c.adjust()
+    assert c.limit == 5
+
+    machine["rss"] = 100 * MB
+    machine["cpu"] = 0.95
+    c.adjust()
+    assert c.limit == 4
+
+
+def test_limit_halves_over_the_ceiling_but_not_below_the_minimum(machine):
+    c = controller(minMessages=2)
+    c.limit = 8
+    machine["rss"] = 1200 * MB
+
+    c.adjust()
+    assert c.limit == 4
+    c.adjust()
+    c.adjust()
+    assert c.limit == 2
+
+
+def test_acquire_waits_for_a_slot(machine):
+    c = controller()
+    assert c.acquire()
+    started = threading.Event()
+
+    def second():
+        if c.acquire():
+            started.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not started.wait(0.05)
+    assert c.waiting == 1
+
+    c.release()
+    thread.join(5)
+    assert started.is_set()
+    assert c.running == 1
+
+
+def test_acquire_gives_up_after_the_max_wait(machine):
+    c = controller(maxWaitSecs=0.05)
+    c.running = 1
+
+    assert not c.acquire()
+    assert c.waiting == 0
+
+
+def test_nothing_starts_while_over_the_ceiling(machine):
+    c = controller(maxWaitSecs=0.05)
+    c.limit = 4
+    machine["rss"] = 1200 * MB
+    c.adjust()
+
+    assert not c.acquire()
+
+
+def test_reserve_waits_for_room_under_the_ceiling(machine, monkeypatch):
+    monkeypatch.setattr(admission, "DECODE_EXPANSION", 10)
+    # 900MB free above the idle RSS
+    c = controller()
+    entered = threading.Event()
+
+    def second():
+        with c.reserve(50 * MB):
+            entered.set()
+
+    with c.reserve(50 * MB):
+        assert c.reservedBytes == 500 * MB
+        thread = threading.Thread(target=second)
+        thread.start()
+        assert not entered.wait(0.05)
+    thread.join(5)
+
+    assert entered.is_set()
+    assert c.reservedBytes == 0
+
+
+def test_a_clip_too_big_for_the_ceiling_runs_on_its_own(machine):
+    c = controller()
+
+    with c.reserve(10 ** 12):
+        assert c.reservedBytes > c.memoryCeiling
+    assert c.reservedBytes == 0
+
+
+def test_reserve_memory_does_nothing_without_admission():
+    assert admission.getAdmission() is None
+
+    with reserveMemory(10 ** 12):
+        pass
+
+
+def test_a_message_kept_waiting_too_long_is_handed_back(machine, monkeypatch):
+    c = controller(maxWaitSecs=0.01)
+    c.running = 1
+    monkeypatch.setattr(subscriber, "getAdmission", lambda: c)
+
+    class Message():
+        message_id = "m1"
+        nacked = 0
+
+        def nack(self):
+            self.nacked += 1
+
+    message = Message()
+    subscriber._trackInFlight(lambda m: pytest.fail("shouldn't run"))(message)
+
+    assert message.nacked == 1
+    assert subscriber.getStatus()["inFlight"] == 0
+
+
+def test_memory_limit_is_found():
+    assert admission.memoryLimitBytes() > 0
+    assert admission.rssBytes() > 0
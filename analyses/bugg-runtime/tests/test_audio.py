@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from bugg_runtime import audio
+from bugg_runtime.clients import getBucket
+
+
+def test_download_from_cloud_storage_writes_the_whole_object(tmp_path):
+    getBucket().blob("models/model.pkl").upload_from_string(b"model" * 1000)
+    path = tmp_path / "model.pkl"
+
+    audio.downloadFromCloudStorage("gs://bugg-301712.appspot.com/models/model.pkl", str(path))
+
+    assert path.read_bytes() == b"model" * 1000
+    assert os.listdir(tmp_path) == ["model.pkl"]
+
+
+def test_download_from_cloud_storage_never_leaves_a_partial_file(tmp_path, monkeypatch):
+    path = tmp_path / "model.pkl"
+    seen = []
+
+    class FailingStorage():
+        def download_blob_to_file(self, uri, fileObj):
+            fileObj.write(b"half a model")
+            fileObj.flush()
+            seen.append(path.exists())
+            raise ConnectionError("reset")
+
+    monkeypatch.setattr(audio, "getStorageClient", FailingStorage)
+
+    with pytest.raises(ConnectionError):
+        audio.downloadFromCloudStorage("gs://bucket/models/model.pkl", str(path))
+
+    # Nothing was at the path while the download was going, and the temporary file is gone
+    assert seen == [False]
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_from_cloud_storage_skips_a_file_already_there(tmp_path, monkeypatch):
+    path = tmp_path / "model.pkl"
+    path.write_bytes(b"already here")
+    monkeypatch.setattr(audio, "getStorageClient", lambda: pytest.fail("shouldn't download"))
+
+    assert audio.downloadFromCloudStorage("gs://bucket/models/model.pkl", str(path)) == path
+    assert path.read_bytes() == b"already here"
@@ -0,0 +1,104 @@
+import base64
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from bugg_runtime.audiocache import AudioCache
+
+
+def blob(name: str, data: bytes = b"", crc32c: bool = True):
+    return SimpleNamespace(
+        bucket=SimpleNamespace(name="bucket"), name=name, size=len(data), generation=1,
+        crc32c=base64.b64encode(name.encode("utf-8")[:4]).decode("ascii") if crc32c else None,
+    )
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AudioCache(str(tmp_path / "cache"), maxBytes=100)
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_keys_by_checksum_and_size_or_falls_back_to_the_generation():
+    assert AudioCache.key(blob("abcd", b"12345")) == "crc32c-61626364-5"
+    assert AudioCache.key(blob("abcd", crc32c=False)).startswith("gen-")
+    assert AudioCache.key(blob("abcd", crc32c=False)).endswith("-1")
+
+
+def test_miss_then_hit(cache, tmp_path):
+    clip = blob("clip", b"audio")
+    assert cache.get(clip) is None
+
+    cache.put(clip, data=b"audio")
+    link = cache.get(clip)
+
+    assert read(link) == b"audio"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["bytesServed"], stats["hitRate"]) == (1, 1, 5, 0.5)
+
+
+def test_put_from_a_file(cache, tmp_path):
+    source = tmp_path / "clip.mp3"
+    source.write_bytes(b"from a file")
+    clip = blob("clip", b"from a file")
+
+    cache.put(clip, path=str(source))
+
+    assert read(cache.get(clip)) == b"from a file"
+
+
+def test_evicts_least_recently_used_first(cache):
+    clips = [blob(f"c{i}xx", b"x" * 40) for i in range(3)]
+    cache.put(clips[0], data=b"x" * 40)
+    cache.put(clips[1], data=b"x" * 40)
+    os.utime(cache._entryPath(cache.key(clips[0])), (1, 1))
+    os.utime(cache._entryPath(cache.key(clips[1])), (2, 2))
+    # Reading the oldest makes it the most recently used
+    os.remove(cache.get(clips[0]))
+
+    cache.put(clips[2], data=b"x" * 40)
+
+    assert cache.get(clips[0]) is not None
+    assert cache.get(clips[1]) is None
+    assert cache.get(clips[2]) is not None
+
+
+def test_a_link_outlives_the_entry_being_evicted(cache):
+    clip = blob("clip", b"audio")
+    cache.put(clip, data=b"audio")
+    link = cache.get(clip)
+
+    os.remove(cache._entryPath(cache.key(clip)))
+
+    assert read(link) == b"audio"
+
+
+def test_an_entry_evicted_just_after_linking_is_still_a_hit(cache, monkeypatch):
+    clip = blob("clip", b"audio")
+    cache.put(clip, data=b"audio")
+    link = os.link
+
+    def linkThenEvict(source, destination):
+        link(source, destination)
+        os.remove(source)
+
+    monkeypatch.setattr(os, "link", linkThenEvict)
+    path = cache.get(clip)
+
+    assert read(path) == b"audio"
+    assert cache.stats()["hits"] == 1
+    assert os.listdir(cache._workDir) == [os.path.basename(path)]
+
+
+def test_estimates_the_download_time_saved(cache):
+    clip = blob("clip", b"x" * 10)
+    cache.recordDownload(10, 2.0)
+    cache.put(clip, data=b"x" * 10)
+    cache.get(clip)
+
+    assert cache.stats()["downloadSecsSaved"] == pytest.approx(2.0)
@@ -0,0 +1,69 @@
+import uuid
+from types import SimpleNamespace
+
+from bugg_runtime import completed
+from bugg_runtime.clients import getDb
+from bugg_runtime.completed import RecentlyCompleted, isAlreadyComplete, isForced, shouldSkip
+from bugg_runtime.records import commitWrites
+from bugg_runtime.writebehind import CompletionWrite
+
+
+def message(**attributes):
+    return SimpleNamespace(attributes=attributes)
+
+
+def test_recently_completed_forgets_the_oldest_first():
+    recent = RecentlyCompleted(2)
+    recent.add("a", "1")
+    recent.add("a", "2")
+    recent.add("a", "1")
+    recent.add("a", "3")
+
+    assert ("a", "1") in recent
+    assert ("a", "2") not in recent
+    assert ("a", "3") in recent
+    assert len(recent) == 2
+
+
+def test_recently_completed_can_be_turned_off():
+    recent = RecentlyCompleted(0)
+    recent.add("a", "1")
+
+    assert ("a", "1") not in recent
+
+
+def test_forced_by_attribute_or_for_every_message(monkeypatch):
+    assert isForced(message(force="1"))
+    assert isForced(message(force="true"))
+    assert not isForced(message(force="0"))
+    assert not isForced(SimpleNamespace(attributes=None))
+
+    monkeypatch.setattr(completed, "FORCE_REPROCESS", True)
+    assert isForced(message())
+
+
+def test_already_complete_needs_every_analysis():
+    record = {"analysesPerformed": ["vggish"]}
+
+    assert isAlreadyComplete(["vggish"], "a1", record)
+    assert not isAlreadyComplete(["vggish", "birdnet"], "a1", record)
+    assert not isAlreadyComplete(["vggish"], "a1", None)
+
+
+def test_a_committed_completion_is_remembered_before_the_record_shows_it():
+    audioId = uuid.uuid4().hex
+    getDb().document(f"audio/{audioId}").set({"id": audioId, "analysesPerformed": []})
+    assert not isAlreadyComplete(["vggish"], audioId, {"analysesPerformed": []})
+
+    commitWrites([CompletionWrite("vggish", audioId, [], "union", "record")])
+
+    # The record read before the commit doesn't have it, but the process remembers
+    assert isAlreadyComplete(["vggish"], audioId, {"analysesPerformed": []})
+
+
+def test_should_skip_unless_forced():
+    record = {"analysesPerformed": ["vggish"]}
+
+    assert shouldSkip(message(), ["vggish"], "a1", record)
+    assert not shouldSkip(message(force="1"), ["vggish"], "a1", record)
+    assert not shouldSkip(message(), ["birdnet"], "a1", record)
@@ -0,0 +1,194 @@
+import uuid
+
+import numpy as np
+import pytest
+
+from bugg_runtime import fused
+from bugg_runtime.clients import getDb
+from bugg_runtime.fused import FusedRunner
+from bugg_runtime.records import markAnalysisComplete
+from bugg_runtime.writebehind import stagingWrites, takeStagedWrites
+
+
+@pytest.fixture(autouse=True)
+def decodeAudio(monkeypatch):
+    # Two seconds of a 1kHz tone at whatever rate the runner asks for, rather than running ffmpeg
+    def decode(audio, sampleRate):
+        t = np.arange(2 * sampleRate) / sampleRate
+        return np.sin(2 * np.pi * 1000 * t).astype(np.float32)
+
+    monkeypatch.setattr(fused, "decodeAudio", decode)
+
+
+def createRecord(analysesPerformed: list = ()) -> tuple:
+    audioId = f"test-{uuid.uuid4().hex}"
+    record = {"id": audioId, "analysesPerformed": list(analysesPerformed), "detections": []}
+    getDb().collection("audio").document(audioId).set(record)
+    return audioId, record
+
+
+def readAnalysesPerformed(audioId: str) -> list:
+    return getDb().collection("audio").document(audioId).get().to_dict()["analysesPerformed"]
+
+
+def completes(analysisId: str, seen: list = None):
+    def process(audioId, audioRec, waveform):
+        if seen is not None:
+            seen.append(len(waveform))
+        markAnalysisComplete(analysisId, audioId)
+
+    return process
+
+
+def fails(audioId, audioRec, waveform):
+    raise ValueError("bad model")
+
+
+def test_each_analysis_gets_the_clip_at_its_own_rate():
+    seen = []
+    runner = FusedRunner(canonicalSampleRate=48000)
+    runner.register("a", 48000, completes("a", seen))
+    runner.register("b", 16000, completes("b", seen))
+    audioId, record = createRecord()
+
+    runner(audioId, record, None)
+
+    assert seen == [96000, 32000]
+    assert sorted(readAnalysesPerformed(audioId)) == ["a", "b"]
+
+
+def test_resample_keeps_a_tone_where_it_was():
+    t = np.arange(48000) / 48000
+    tone = np.sin(2 * np.pi * 1000 * t).astype(np.float32)
+
+    resampled = fused.resample(tone, 48000, 16000)
+
+    assert resampled.dtype == np.float32
+    assert len(resampled) == 16000
+    assert np.argmax(np.abs(np.fft.rfft(resampled))) == 1000
+
+
+def test_a_failure_commits_the_analyses_that_finished_then_raises():
+    runner = FusedRunner()
+    runner.register("a", 16000, completes("a"))
+    runner.register("broken", 16000, fails)
+    runner.register("c", 16000, completes("c"))
+    audioId, record = createRecord()
+
+    with pytest.raises(Exception, match="broken failed"):
+        runner(audioId, record, None)
+
+    assert sorted(readAnalysesPerformed(audioId)) == ["a", "c"]
+
+
+def test_a_failure_under_write_behind_commits_the_analyses_that_finished_too():
+    runner = FusedRunner()
+    runner.register("a", 16000, completes("a"))
+    runner.register("broken", 16000, fails)
+    audioId, record = createRecord()
+
+    # As the subscriber stages a message's writes when write-behind is on
+    with stagingWrites(always=True):
+        with pytest.raises(Exception, match="broken failed"):
+            runner(audioId, record, None)
+        assert takeStagedWrites() == []
+
+    assert readAnalysesPerformed(audioId) == ["a"]
+
+
+def test_write_behind_holds_the_writes_back_when_everything_finishes():
+    runner = FusedRunner()
+    runner.register("a", 16000, completes("a"))
+    audioId, record = createRecord()
+
+    with stagingWrites(always=True):
+        runner(audioId, record, None)
+        assert [w.analysisId for w in takeStagedWrites()] == ["a"]
+
+    assert readAnalysesPerformed(audioId) == []
+
+
+def test_chained_analyses_get_the_upstream_output():
+    seen = []
+    runner = FusedRunner()
+    runner.register("vggish", 16000, lambda audioId, audioRec, waveform: len(waveform))
+    runner.chain("anomaly", "vggish", lambda audioId, audioRec, output: seen.append(output))
+    audioId, record = createRecord()
+
+    runner(audioId, record, None)
+
+    assert seen == [32000]
+    assert runner.analysisIds() == ["vggish", "anomaly"]
+
+
+def test_chained_analyses_are_skipped_when_the_upstream_fails():
+    runner = FusedRunner()
+    runner.register("vggish", 16000, fails)
+    runner.chain("anomaly", "vggish", lambda *args: pytest.fail("shouldn't run"))
+    runner.register("other", 16000, completes("other"))
+    audioId, record = createRecord()
+
+    with pytest.raises(Exception, match="vggish failed"):
+        runner(audioId, record, None)
+
+    assert readAnalysesPerformed(audioId) == ["other"]
+
+
+def test_chained_completions_are_committed_together(monkeypatch):
+    commits = []
+    commitWrites = fused.commitWrites
+
+    def recordingCommitWrites(writes):
+        commits.append([w.analysisId for w in writes])
+        commitWrites(writes)
+
+    monkeypatch.setattr(fused, "commitWrites", recordingCommitWrites)
+    runner = FusedRunner()
+    runner.register("vggish", 16000, completes("vggish"))
+    runner.chain("anomaly", "vggish", completes("anomaly"))
+    audioId, record = createRecord()
+
+    runner(audioId, record, None)
+
+    assert commits == [["vggish", "anomaly"]]
+    assert readAnalysesPerformed(audioId) == ["vggish", "anomaly"]
+
+
+def test_chaining_needs_the_upstream_registered_first():
+    with pytest.raises(ValueError):
+        FusedRunner().chain("anomaly", "vggish", lambda *args: None)
+
+
+def test_analyses_that_already_completed_the_clip_are_skipped():
+    ran = []
+    runner = FusedRunner()
+    runner.register("vggish", 16000, lambda *args: ran.append("vggish"))
+    runner.register("birdnet", 48000, lambda *args: ran.append("birdnet"))
+    audioId, record = createRecord(["vggish"])
+
+    runner(audioId, record, None)
+
+    assert ran == ["birdnet"]
+
+
+def test_forced_messages_run_every_analysis_again():
+    ran = []
+    runner = FusedRunner()
+    runner.register("vggish", 16000, lambda *args: ran.append("vggish"))
+    runner.register("birdnet", 48000, lambda *args: ran.append("birdnet"))
+    audioId, record = createRecord(["vggish", "birdnet"])
+
+    runner(audioId, record, None, forced=True)
+
+    assert ran == ["vggish", "birdnet"]
+
+
+def test_a_chained_analysis_left_after_its_upstream_completed_isnt_decoded_or_run(monkeypatch):
+    # e.g. anomaly-detection, which isn't marked complete until the recorder has a model
+    monkeypatch.setattr(fused, "decodeAudio", lambda *args: pytest.fail("shouldn't decode"))
+    runner = FusedRunner()
+    runner.register("vggish", 16000, lambda *args: pytest.fail("shouldn't run"))
+    runner.chain("anomaly", "vggish", lambda *args: pytest.fail("shouldn't run"))
+    audioId, record = createRecord(["vggish"])
+
+    runner(audioId, record, None)
@@ -0,0 +1,125 @@
+import threading
+import time
+
+from bugg_runtime.lanes import BULK, PRIORITY, LaneScheduler, bulkSubscription, parseWeights
+
+
+def waitFor(condition, timeoutSecs: float = 5):
+    deadline = time.monotonic() + timeoutSecs
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def startHolders(scheduler: LaneScheduler, lane: str, count: int, release: threading.Event) -> list:
+    """
+    Threads that each take a slot in the lane and keep it until release is set
+    """
+    def hold():
+        scheduler.acquire(lane)
+        release.wait()
+        scheduler.release(lane)
+
+    threads = [threading.Thread(target=hold, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_bulk_subscription_names():
+    assert bulkSubscription("analyses.vggish-sub") == "analyses.vggish.bulk-sub"
+    assert bulkSubscription("custom") == "custom.bulk"
+    assert parseWeights("4:1") == {PRIORITY: 4, BULK: 1}
+
+
+def test_bulk_lane_leaves_the_reserved_slots_free():
+    scheduler = LaneScheduler(4, weights={PRIORITY: 4, BULK: 1}, reservedSlots=1)
+    release = threading.Event()
+    threads = startHolders(scheduler, BULK, 6, release)
+
+    waitFor(lambda: scheduler.running[BULK] == 3 and scheduler.waiting[BULK] == 3)
+    time.sleep(0.05)
+    assert scheduler.running[BULK] == 3
+
+    # A priority message gets the reserved slot straight away, though bulk messages are waiting
+    acquired = threading.Event()
+    threading.Thread(target=lambda: (scheduler.acquire(PRIORITY), acquired.set()), daemon=True).start()
+    assert acquired.wait(2)
+    assert scheduler.running == {PRIORITY: 1, BULK: 3}
+
+    scheduler.release(PRIORITY)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert scheduler.running == {PRIORITY: 0, BULK: 0}
+
+
+def test_bulk_lane_gets_a_slot_when_reserving_would_leave_it_none():
+    scheduler = LaneScheduler(1, weights={PRIORITY: 4, BULK: 1}, reservedSlots=1)
+    release = threading.Event()
+    threads = startHolders(scheduler, BULK, 1, release)
+
+    waitFor(lambda: scheduler.running[BULK] == 1)
+    release.set()
+    threads[0].join(5)
+
+
+def test_priority_lane_alone_gets_every_slot():
+    scheduler = LaneScheduler(4, weights={PRIORITY: 4, BULK: 1}, reservedSlots=1)
+    release = threading.Event()
+    threads = startHolders(scheduler, PRIORITY, 4, release)
+
+    waitFor(lambda: scheduler.running[PRIORITY] == 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_slots_are_shared_by_weight_while_both_lanes_wait():
+    scheduler = LaneScheduler(3, weights={PRIORITY: 4, BULK: 1}, reservedSlots=1)
+    granted = []
+    lock = threading.Lock()
+
+    def handle(lane):
+        scheduler.acquire(lane)
+        with lock:
+            granted.append(lane)
+        scheduler.release(lane)
+
+    # Hold every slot until both lanes have a backlog
+    for _ in range(3):
+        scheduler.acquire(PRIORITY)
+    threads = [threading.Thread(target=handle, args=(lane,), daemon=True)
+               for lane in [PRIORITY] * 40 + [BULK] * 40]
+    for thread in threads:
+        thread.start()
+    waitFor(lambda: scheduler.backlog() == 80)
+
+    for _ in range(3):
+        scheduler.release(PRIORITY)
+    for thread in threads:
+        thread.join(10)
+
+    assert len(granted) == 80
+    # Both lanes had a backlog for (at least) the first 40 grants, which should go 4:1
+    bulk = granted[:40].count(BULK)
+    assert 7 <= bulk <= 9, granted
+    # Once the priority backlog is gone, the bulk lane takes the rest
+    assert granted[-10:] == [BULK] * 10
+    assert scheduler.running == {PRIORITY: 0, BULK: 0}
+
+
+def test_slots_can_follow_a_changing_limit():
+    limit = {"slots": 1}
+    scheduler = LaneScheduler(lambda: limit["slots"], weights={PRIORITY: 4, BULK: 1}, reservedSlots=1)
+    release = threading.Event()
+    threads = startHolders(scheduler, PRIORITY, 3, release)
+
+    waitFor(lambda: scheduler.running[PRIORITY] == 1 and scheduler.waiting[PRIORITY] == 2)
+    # Waiters check the limit again periodically, not just on release
+    limit["slots"] = 3
+    waitFor(lambda: scheduler.running[PRIORITY] == 3)
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
@@ -0,0 +1,273 @@
+import threading
+import time
+
+import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore, pubsub_v1
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from bugg_runtime.local import (LocalFirestore, LocalPublisher, LocalPubSub, LocalStorage, LocalSubscriber,
+                                transactional)
+
+
+@pytest.fixture
+def db():
+    return LocalFirestore()
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path))
+
+
+@pytest.fixture
+def broker():
+    return LocalPubSub()
+
+
+# Firestore
+
+def test_set_get_and_missing_documents(db):
+    db.document("audio/a1").set({"id": "a1", "tags": ["x"]})
+
+    snapshot = db.collection("audio").document("a1").get()
+    assert snapshot.exists
+    assert snapshot.to_dict() == {"id": "a1", "tags": ["x"]}
+    assert snapshot.get("id") == "a1"
+    assert not db.document("audio/a2").get().exists
+
+
+def test_snapshots_are_copies(db):
+    db.document("audio/a1").set({"tags": ["x"]})
+
+    db.document("audio/a1").get().to_dict()["tags"].append("y")
+
+    assert db.document("audio/a1").get().to_dict() == {"tags": ["x"]}
+
+
+def test_update_applies_field_transforms(db):
+    ref = db.document("audio/a1")
+    ref.set({"analysesPerformed": ["a"], "count": 1, "counts": {"a": 1}, "stale": 2, "nested": {"keep": 1}})
+
+    ref.update({
+        "analysesPerformed": firestore.ArrayUnion(["a", "b"]),
+        "count": firestore.Increment(2),
+        FieldPath("counts", "b-c").to_api_repr(): 3,
+        "stale": firestore.DELETE_FIELD,
+        "nested.added": True,
+    })
+
+    assert ref.get().to_dict() == {"analysesPerformed": ["a", "b"], "count": 3, "counts": {"a": 1, "b-c": 3},
+                                   "nested": {"keep": 1, "added": True}}
+
+
+def test_update_of_a_missing_document_raises(db):
+    with pytest.raises(NotFound):
+        db.document("audio/missing").update({"a": 1})
+
+
+def test_set_with_merge_keeps_other_fields(db):
+    ref = db.document("audio/a1")
+    ref.set({"a": 1, "nested": {"x": 1}})
+
+    ref.set({"b": 2, "nested": {"y": 2}}, merge=True)
+
+    assert ref.get().to_dict() == {"a": 1, "b": 2, "nested": {"x": 1, "y": 2}}
+
+
+def test_a_failing_batch_changes_nothing(db):
+    db.document("audio/a1").set({"a": 1})
+    batch = db.batch()
+    batch.update(db.document("audio/a1"), {"a": 2})
+    batch.update(db.document("audio/missing"), {"a": 2})
+
+    with pytest.raises(NotFound):
+        batch.commit()
+
+    assert db.document("audio/a1").get().to_dict() == {"a": 1}
+
+
+def test_queries_filter_order_and_limit(db):
+    for i, project in enumerate(["p1", "p2", "p1", "p1"]):
+        db.document(f"audio/a{i}").set({"project": project, "uploadedAt": i, "tags": [f"t{i}"]})
+    db.document("audio/a0/detections/d1").set({"project": "p1"})
+
+    query = db.collection("audio").where("project", "==", "p1").order_by("uploadedAt", direction="DESCENDING").limit(2)
+
+    assert [s.id for s in query.stream()] == ["a3", "a2"]
+    assert [s.id for s in db.collection("audio").where("tags", "array_contains", "t1").get()] == ["a1"]
+    # Subcollections aren't part of their parent's collection
+    assert [s.id for s in db.collection("audio/a0/detections").get()] == ["d1"]
+    assert len(db.collection("audio").get()) == 4
+
+
+def test_transactions_read_and_write_together(db):
+    db.document("counters/c").set({"value": 0})
+
+    @transactional
+    def increment(transaction, ref):
+        value = ref.get(transaction=transaction).get("value")
+        transaction.update(ref, {"value": value + 1})
+
+    def run():
+        for _ in range(50):
+            increment(db.transaction(), db.document("counters/c"))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert db.document("counters/c").get().get("value") == 200
+
+
+def test_load_and_dump(db):
+    db.load({"audio/a1": {"id": "a1"}})
+
+    assert db.dump() == {"audio/a1": {"id": "a1"}}
+
+
+# Cloud Storage
+
+def test_blobs_are_files_in_a_bucket_directory(storage, tmp_path):
+    blob = storage.bucket("bucket").blob("audio/p/1.mp3")
+    blob.upload_from_string(b"mp3 bytes")
+
+    assert (tmp_path / "bucket" / "audio" / "p" / "1.mp3").read_bytes() == b"mp3 bytes"
+    fetched = storage.blobFromUri("gs://bucket/audio/p/1.mp3")
+    assert fetched.size is None
+    fetched.reload()
+    assert fetched.size == 9
+    assert fetched.generation is not None
+    assert fetched.download_as_bytes() == b"mp3 bytes"
+
+
+def test_missing_blobs_raise_not_found(storage):
+    blob = storage.bucket("bucket").blob("missing.mp3")
+
+    assert not blob.exists()
+    with pytest.raises(NotFound):
+        blob.reload()
+    with pytest.raises(NotFound):
+        blob.download_as_bytes()
+    assert storage.bucket("bucket").get_blob("missing.mp3") is None
+
+
+def test_metadata_set_before_uploading_is_kept(storage):
+    blob = storage.bucket("bucket").blob("profile.folded")
+    blob.metadata = {"messageId": "m1"}
+    blob.upload_from_string("stacks")
+
+    fetched = storage.bucket("bucket").get_blob("profile.folded")
+    assert fetched.metadata == {"messageId": "m1"}
+
+    # Uploading again without any replaces it, as Cloud Storage does
+    storage.bucket("bucket").blob("profile.folded").upload_from_string("stacks")
+    assert storage.bucket("bucket").get_blob("profile.folded").metadata is None
+
+
+def test_patch_sets_metadata_on_an_existing_blob(storage):
+    blob = storage.bucket("bucket").blob("clip.mp3")
+    blob.upload_from_string(b"mp3")
+
+    blob.metadata = {"analysed": "true"}
+    blob.patch()
+
+    assert storage.bucket("bucket").get_blob("clip.mp3").metadata == {"analysed": "true"}
+
+
+def test_list_blobs_by_prefix(storage):
+    bucket = storage.bucket("bucket")
+    for name in ("audio/a.mp3", "audio/b.mp3", "other/c.mp3"):
+        bucket.blob(name).upload_from_string(b"x")
+
+    assert [b.name for b in bucket.list_blobs(prefix="audio/")] == ["audio/a.mp3", "audio/b.mp3"]
+
+
+def test_download_blob_to_file_by_uri(storage, tmp_path):
+    storage.bucket("bucket").blob("a.mp3").upload_from_string(b"audio")
+
+    with open(tmp_path / "out.mp3", "wb") as f:
+        storage.download_blob_to_file("gs://bucket/a.mp3", f)
+
+    assert (tmp_path / "out.mp3").read_bytes() == b"audio"
+
+
+# Pub/Sub
+
+def test_published_messages_go_to_every_subscription(broker):
+    broker.createSubscription("analyses.vggish", "extra")
+    publisher = LocalPublisher(broker)
+
+    messageId = publisher.publish(publisher.topic_path("project", "analyses.vggish"), b"a1", force="1").result()
+
+    assert broker.pending("analyses.vggish-sub") == 1
+    assert broker.pending("extra") == 1
+    message = broker._queue("analyses.vggish-sub").get_nowait()
+    assert (message.message_id, message.data, message.attributes) == (messageId, b"a1", {"force": "1"})
+
+
+def test_subscriber_acks_and_redelivers_nacked_messages(broker):
+    attempts = []
+    settled = []
+    broker.addListener(lambda message, acked: settled.append(acked))
+
+    def callback(message):
+        attempts.append(message.delivery_attempt)
+        if message.delivery_attempt == 1:
+            message.nack()
+        else:
+            message.ack()
+
+    LocalPublisher(broker).publish("projects/p/topics/t", b"a1")
+    with LocalSubscriber(broker) as subscriber:
+        subscriber.subscribe(subscriber.subscription_path("p", "t-sub"), callback)
+        assert broker.waitUntilDrained("t-sub", timeout=5)
+
+    assert attempts == [1, 2]
+    assert settled == [False, True]
+
+
+def test_a_callback_that_raises_nacks_its_message(broker):
+    attempts = []
+
+    def callback(message):
+        attempts.append(message.delivery_attempt)
+        if message.delivery_attempt == 1:
+            raise ValueError("bad clip")
+        message.ack()
+
+    LocalPublisher(broker).publish("t", b"a1")
+    with LocalSubscriber(broker) as subscriber:
+        subscriber.subscribe("t-sub", callback)
+        assert broker.waitUntilDrained("t-sub", timeout=5)
+
+    assert attempts == [1, 2]
+
+
+def test_flow_control_bounds_the_unsettled_messages(broker):
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def callback(message):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        message.ack()
+
+    publisher = LocalPublisher(broker)
+    for i in range(20):
+        publisher.publish("t", str(i).encode())
+
+    flow_control = pubsub_v1.types.FlowControl(max_messages=3, max_lease_duration=600)
+    with LocalSubscriber(broker) as subscriber:
+        future = subscriber.subscribe("t-sub", callback, flow_control=flow_control)
+        assert broker.waitUntilDrained("t-sub", timeout=10)
+
+    assert max(peak) == 3
+    assert future.cancelled()
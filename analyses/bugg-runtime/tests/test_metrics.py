@@ -0,0 +1,99 @@
+import json
+import threading
+import urllib.request
+
+from bugg_runtime import metrics
+from bugg_runtime.metrics import Metrics, StageTimer, inCurrentMessage
+
+
+def test_stage_timer_totals_and_buckets():
+    timer = StageTimer()
+    timer.observe(0.02)
+    timer.observe(3)
+
+    assert timer.toDict() == {"count": 2, "totalSecs": 3.02, "meanSecs": 1.51, "maxSecs": 3}
+    # Cumulative, as Prometheus histograms are
+    assert timer.buckets[metrics.STAGE_BUCKETS.index(0.05)] == 1
+    assert timer.buckets[metrics.STAGE_BUCKETS.index(5)] == 2
+
+
+def test_snapshot_has_stages_counters_and_gauges():
+    m = Metrics()
+    m.observeStage("download", 0.5)
+    m.increment("messages_received")
+    m.increment("audio_bytes", 100)
+    m.registerGauge("in_flight", lambda: 3)
+    m.registerGauge("broken", lambda: 1 / 0)
+
+    snapshot = m.snapshot()
+
+    assert snapshot["stages"]["download"]["count"] == 1
+    assert snapshot["counters"] == {"messages_received": 1, "audio_bytes": 100}
+    # A gauge that can't be read is left out rather than failing the scrape
+    assert snapshot["gauges"] == {"in_flight": 3}
+
+
+def test_reset_clears_stages_and_counters():
+    m = Metrics()
+    m.observeStage("download", 0.5)
+    m.increment("messages_received")
+
+    m.reset()
+
+    assert m.snapshot() == {"stages": {}, "counters": {}, "gauges": {}}
+
+
+def test_prometheus_text_format():
+    m = Metrics()
+    m.observeStage("inference", 0.2)
+    m.increment("completions", 2)
+    m.registerGauge("in_flight", lambda: 1)
+
+    lines = m.prometheus().splitlines()
+
+    assert "# TYPE bugg_stage_seconds histogram" in lines
+    assert 'bugg_stage_seconds_bucket{stage="inference",le="0.1"} 0' in lines
+    assert 'bugg_stage_seconds_bucket{stage="inference",le="0.25"} 1' in lines
+    assert 'bugg_stage_seconds_bucket{stage="inference",le="+Inf"} 1' in lines
+    assert 'bugg_stage_seconds_count{stage="inference"} 1' in lines
+    assert "bugg_completions_total 2" in lines
+    assert "bugg_in_flight 1" in lines
+
+
+def test_message_collects_its_own_stage_timings(monkeypatch, capsys):
+    m = Metrics()
+    monkeypatch.setattr(metrics, "_metrics", m)
+
+    with m.message("m1"):
+        with metrics.timeStage("download"):
+            pass
+        with metrics.timeStage("download"):
+            pass
+        # A helper thread's stages count towards the message too
+        thread = threading.Thread(target=inCurrentMessage(lambda: m.observeStage("features", 0.25)))
+        thread.start()
+        thread.join()
+
+    line = [line for line in capsys.readouterr().out.splitlines() if line.startswith("Timings for message m1: ")][0]
+    timings = json.loads(line.split(": ", 1)[1])
+    assert set(timings) == {"download", "features", "total"}
+    assert timings["features"] == 0.25
+    assert m.snapshot()["stages"]["download"]["count"] == 2
+
+
+def test_serves_metrics_over_http(monkeypatch):
+    m = Metrics()
+    m.increment("completions")
+    monkeypatch.setattr(metrics, "_metrics", m)
+    server = metrics._ThreadingHTTPServer(("127.0.0.1", 0), metrics._MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert "bugg_completions_total 1" in response.read().decode("utf-8")
+        with urllib.request.urlopen(f"{url}/metrics.json") as response:
+            assert json.loads(response.read())["counters"] == {"completions": 1}
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,144 @@
+import threading
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+from bugg_runtime import fused, pipeline
+from bugg_runtime.clients import BUCKET_NAME, getBucket, getDb
+from bugg_runtime.fused import FusedRunner
+from bugg_runtime.pipeline import AudioPipeline, ByteBudget
+
+
+class Message():
+
+    def __init__(self, audioId: str, attributes: dict = None):
+        self.message_id = audioId
+        self.data = audioId.encode("utf-8")
+        self.attributes = attributes or {}
+        self.acked = 0
+
+    def ack(self):
+        self.acked += 1
+
+    def nack(self):
+        pytest.fail("shouldn't nack")
+
+
+def createClip(data: bytes = b"mp3 bytes", **fields) -> str:
+    audioId = uuid.uuid4().hex
+    getBucket().blob(f"audio/{audioId}.mp3").upload_from_string(data)
+    record = {"id": audioId, "uri": f"gs://{BUCKET_NAME}/audio/{audioId}.mp3", "analysesPerformed": []}
+    record.update(fields)
+    getDb().document(f"audio/{audioId}").set(record)
+    return audioId
+
+
+def test_byte_budget_blocks_until_there_is_room():
+    budget = ByteBudget(100)
+    entered = threading.Event()
+
+    def second():
+        with budget.reserve(60):
+            entered.set()
+
+    with budget.reserve(60):
+        thread = threading.Thread(target=second)
+        thread.start()
+        assert not entered.wait(0.05)
+        assert budget.used() == 60
+    thread.join(5)
+
+    assert entered.is_set()
+    assert budget.used() == 0
+
+
+def test_byte_budget_lets_a_clip_larger_than_the_budget_through_on_its_own():
+    budget = ByteBudget(100)
+
+    with budget.reserve(500):
+        assert budget.used() == 500
+    assert budget.used() == 0
+
+
+def test_pipeline_hands_the_clip_to_process_and_acks():
+    audioId = createClip(b"clip audio")
+    seen = []
+
+    def process(audioId, audioRec, audio):
+        seen.append((audioId, audioRec["id"], audio.read()))
+
+    message = Message(audioId)
+    AudioPipeline("vggish", process)(message)
+
+    assert seen == [(audioId, audioId, b"clip audio")]
+    assert message.acked == 1
+
+
+def test_pipeline_skips_a_clip_the_analysis_has_already_done():
+    audioId = createClip(analysesPerformed=["vggish"])
+    message = Message(audioId)
+
+    AudioPipeline("vggish", lambda *args: pytest.fail("shouldn't process"))(message)
+
+    assert message.acked == 1
+
+
+def test_pipeline_runs_a_forced_message_again():
+    audioId = createClip(analysesPerformed=["vggish"])
+    processed = []
+    message = Message(audioId, {"force": "1"})
+
+    AudioPipeline("vggish", lambda audioId, audioRec, audio: processed.append(audioId))(message)
+
+    assert processed == [audioId]
+    assert message.acked == 1
+
+
+def test_pipeline_releases_the_prefetch_budget_once_the_audio_is_handed_off():
+    audioIds = [createClip(b"x" * 80) for _ in range(2)]
+    on_message = AudioPipeline("vggish", None, prefetch=1, maxPrefetchBytes=100)
+    used = []
+    release = threading.Event()
+
+    def process(audioId, audioRec, audio):
+        used.append(on_message._budget.used())
+        # The first clip waits on the model while the second downloads
+        if audioId == audioIds[0]:
+            release.wait(5)
+
+    on_message.process = process
+    first = threading.Thread(target=on_message, args=(Message(audioIds[0]),))
+    first.start()
+    while len(used) == 0:
+        time.sleep(0.01)
+
+    second = Message(audioIds[1])
+    on_message(second)
+    release.set()
+    first.join(5)
+
+    assert used == [0, 0]
+    assert second.acked == 1
+
+
+def test_pipeline_leases_the_prefetched_messages(monkeypatch):
+    monkeypatch.setattr(pipeline, "INFERENCE_WORKERS", 2)
+
+    assert AudioPipeline("vggish", None, prefetch=3).maxMessages == 5
+
+
+def test_fused_pipeline_runs_only_the_analyses_left_to_do(monkeypatch):
+    monkeypatch.setattr(fused, "decodeAudio", lambda audio, sampleRate: np.zeros(sampleRate, dtype=np.float32))
+    ran = []
+    runner = FusedRunner()
+    runner.register("vggish", 16000, lambda *args: ran.append("vggish"))
+    runner.register("birdnet", 48000, lambda *args: ran.append("birdnet"))
+    on_message = AudioPipeline("fused", runner)
+
+    on_message(Message(createClip(analysesPerformed=["vggish"])))
+    assert ran == ["birdnet"]
+
+    on_message(Message(createClip(analysesPerformed=["vggish"]), {"force": "1"}))
+    assert ran == ["birdnet", "vggish", "birdnet"]
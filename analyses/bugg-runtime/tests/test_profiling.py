@@ -0,0 +1,103 @@
+import sys
+import time
+from collections import Counter
+
+import pytest
+
+from bugg_runtime import profiling
+from bugg_runtime.clients import getBucket
+from bugg_runtime.profiling import StackSampler, collapseStack, withProfiling
+
+
+class Message():
+
+    def __init__(self, messageId: str = "m1", attributes: dict = None):
+        self.message_id = messageId
+        self.data = b"a1"
+        self.attributes = attributes or {}
+        self.acked = 0
+
+    def ack(self):
+        self.acked += 1
+
+
+@pytest.fixture(autouse=True)
+def noProfiles(monkeypatch):
+    monkeypatch.setattr(profiling, "_remaining", 0)
+    monkeypatch.setattr(profiling, "_sampler", StackSampler(intervalSecs=0.001))
+
+
+def busyModel(secs: float):
+    end = time.monotonic() + secs
+    while time.monotonic() < end:
+        pass
+
+
+def test_collapse_stack_goes_from_the_outermost_call_in():
+    def inner():
+        return collapseStack(sys._getframe())
+
+    stack = inner().split(";")
+
+    assert stack[-1].startswith("inner (test_profiling.py:")
+    assert stack[-2].startswith("test_collapse_stack_goes_from_the_outermost_call_in (test_profiling.py:")
+
+
+def test_messages_arent_profiled_unless_asked(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    handled = []
+
+    withProfiling(handled.append, "vggish")(Message())
+
+    assert len(handled) == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_a_control_message_profiles_the_next_messages(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    handled = []
+
+    def callback(message):
+        handled.append(message.message_id)
+        busyModel(0.05)
+
+    wrapped = withProfiling(callback, "vggish")
+    control = Message("c1", {"control": "profile", "messages": "2"})
+    wrapped(control)
+    for messageId in ("m1", "m2", "m3"):
+        wrapped(Message(messageId))
+
+    # The control message is acked and never reaches the callback
+    assert control.acked == 1
+    assert handled == ["m1", "m2", "m3"]
+    assert sorted(p.name for p in (tmp_path / "vggish").iterdir()) == ["m1.folded", "m2.folded"]
+
+    folded = (tmp_path / "vggish" / "m1.folded").read_text().splitlines()
+    samples = Counter()
+    for line in folded:
+        stack, count = line.rsplit(" ", 1)
+        samples[stack.split(";")[-1].split(" ")[0]] += int(count)
+    assert samples["busyModel"] > 0
+
+
+def test_a_failing_message_is_still_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    profiling.requestProfile(1)
+
+    def callback(message):
+        busyModel(0.01)
+        raise ValueError("bad clip")
+
+    with pytest.raises(ValueError):
+        withProfiling(callback, "vggish")(Message())
+
+    assert (tmp_path / "vggish" / "m1.folded").exists()
+
+
+def test_profiles_go_to_the_bucket_by_default(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", None)
+
+    profiling.saveProfile("vggish", Message("m9"), Counter({"main (a.py:1);model (b.py:2)": 3}), 1.0)
+
+    blob = getBucket().blob("artifacts/profiles/vggish/m9.folded")
+    assert blob.download_as_bytes() == b"main (a.py:1);model (b.py:2) 3\n"
@@ -0,0 +1,91 @@
+import types
+
+import pytest
+
+from bugg_runtime import readcache
+from bugg_runtime.readcache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A clock for the cache that only moves when the test advances it
+    """
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(readcache, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+class Loader():
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return f"value {self.calls}"
+
+
+def test_serves_cached_value_until_it_expires(clock):
+    cache = TTLCache(maxEntries=10, ttlSecs=5)
+    load = Loader()
+
+    assert cache.get("a", load) == "value 1"
+    clock.now += 4.9
+    assert cache.get("a", load) == "value 1"
+    clock.now += 0.2
+    assert cache.get("a", load) == "value 2"
+    assert load.calls == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_ttl_per_call_and_per_value(clock):
+    cache = TTLCache(maxEntries=10, ttlSecs=5)
+    load = Loader()
+
+    cache.get("short", load, ttlSecs=1)
+    cache.get("long", load, ttlSecs=lambda value: 60)
+    clock.now += 30
+    assert cache.get("short", load) == "value 3"
+    assert cache.get("long", load) == "value 2"
+
+
+def test_zero_ttl_is_never_cached(clock):
+    cache = TTLCache(maxEntries=10, ttlSecs=0)
+    load = Loader()
+
+    cache.get("a", load)
+    cache.get("a", load)
+    assert load.calls == 2
+
+
+def test_invalidate_forces_a_reload(clock):
+    cache = TTLCache(maxEntries=10, ttlSecs=60)
+    load = Loader()
+
+    cache.get("a", load)
+    cache.get("b", load)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a", load) == "value 3"
+    assert cache.get("b", load) == "value 2"
+
+    cache.clear()
+    assert cache.get("b", load) == "value 4"
+
+
+def test_least_recently_used_are_dropped_first(clock):
+    cache = TTLCache(maxEntries=2, ttlSecs=60)
+    load = Loader()
+
+    cache.get("a", load)
+    cache.get("b", load)
+    # Using a makes b the least recently used
+    cache.get("a", load)
+    cache.get("c", load)
+    assert load.calls == 3
+
+    cache.get("a", load)
+    assert load.calls == 3
+    cache.get("b", load)
+    assert load.calls == 4
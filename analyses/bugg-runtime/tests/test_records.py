@@ -0,0 +1,246 @@
+import uuid
+
+import pytest
+
+from bugg_runtime.clients import getDb
+from bugg_runtime import records
+from bugg_runtime.records import commitWrites, markAnalysisComplete, mergeDetections
+from bugg_runtime.writebehind import CompletionWrite, ResultWrite
+
+
+def createRecord(**fields) -> str:
+    audioId = f"test-{uuid.uuid4().hex}"
+    record = {"id": audioId, "analysesPerformed": [], "detections": []}
+    record.update(fields)
+    getDb().collection("audio").document(audioId).set(record)
+    return audioId
+
+
+def readRecord(audioId: str) -> dict:
+    return getDb().collection("audio").document(audioId).get().to_dict()
+
+
+def readSubcollection(audioId: str) -> dict:
+    detections = getDb().collection("audio").document(audioId).collection("detections").stream()
+    return {snapshot.id: snapshot.to_dict() for snapshot in detections}
+
+
+def byId(detections: list) -> dict:
+    return {d["id"]: d for d in detections}
+
+
+def test_merge_keeps_existing_order_and_appends_new():
+    prev = [{"id": "a"}, {"id": "b"}]
+    merged = mergeDetections(prev, [{"id": "c"}, {"id": "d"}])
+    assert [d["id"] for d in merged] == ["a", "b", "c", "d"]
+
+
+def test_merge_overrides_fields_of_existing_ids_in_place():
+    prev = [{"id": "a", "confidence": 0.1, "uri": "gs://clip-a"}, {"id": "b", "confidence": 0.2}]
+    merged = mergeDetections(prev, [{"id": "b", "confidence": 0.9}, {"id": "a", "confidence": 0.5}])
+
+    assert [d["id"] for d in merged] == ["a", "b"]
+    # Fields the re-run doesn't produce, e.g. clippy's uri, are kept
+    assert merged[0] == {"id": "a", "confidence": 0.5, "uri": "gs://clip-a"}
+    assert merged[1] == {"id": "b", "confidence": 0.9}
+
+
+def test_merge_first_of_repeated_new_ids_wins():
+    merged = mergeDetections([{"id": "a", "confidence": 0.1}],
+                             [{"id": "a", "confidence": 0.5}, {"id": "b", "confidence": 0.6},
+                              {"id": "a", "confidence": 0.7}, {"id": "b", "confidence": 0.8}])
+    assert merged == [{"id": "a", "confidence": 0.5}, {"id": "b", "confidence": 0.6}]
+
+
+def test_merge_leaves_its_inputs_alone():
+    prev = [{"id": "a", "confidence": 0.1}]
+    detections = [{"id": "a", "confidence": 0.5}]
+    mergeDetections(prev, detections)
+    assert prev == [{"id": "a", "confidence": 0.1}]
+    assert detections == [{"id": "a", "confidence": 0.5}]
+
+
+def test_rerun_replaces_its_detections_on_the_record():
+    audioId = createRecord(detections=[{"id": "d1", "analysisId": "first", "confidence": 0.1},
+                                       {"id": "o1", "analysisId": "other"}])
+
+    markAnalysisComplete("first", audioId, [{"id": "d1", "analysisId": "first", "confidence": 0.9}])
+
+    record = readRecord(audioId)
+    assert record["detections"] == [{"id": "d1", "analysisId": "first", "confidence": 0.9}, {"id": "o1", "analysisId": "other"}]
+    assert record["analysesPerformed"] == ["first"]
+
+
+def test_union_completions_add_each_analysis_and_its_detections():
+    audioId = createRecord(analysesPerformed=["earlier"], detections=[{"id": "e1", "analysisId": "earlier"}])
+
+    markAnalysisComplete("first", audioId, [{"id": "f1", "analysisId": "first"}], mode="union")
+    markAnalysisComplete("second", audioId, [], mode="union")
+    markAnalysisComplete("first", audioId, [{"id": "f1", "analysisId": "first"}], mode="union")
+
+    record = readRecord(audioId)
+    assert record["analysesPerformed"] == ["earlier", "first", "second"]
+    assert set(byId(record["detections"])) == {"e1", "f1"}
+    assert len(record["detections"]) == 2
+    assert record["hasDetections"] is True
+
+
+def test_union_rerun_with_different_detections_keeps_both_versions():
+    audioId = createRecord()
+
+    markAnalysisComplete("first", audioId, [{"id": "f1", "analysisId": "first", "confidence": 0.1}], mode="union")
+    markAnalysisComplete("first", audioId, [{"id": "f1", "analysisId": "first", "confidence": 0.9}], mode="union")
+
+    assert [d["confidence"] for d in readRecord(audioId)["detections"]] == [0.1, 0.9]
+
+
+def test_unknown_completion_mode_is_refused():
+    with pytest.raises(ValueError):
+        markAnalysisComplete("first", createRecord(), [], mode="blind")
+
+
+def test_subcollection_storage_writes_each_detection_and_a_summary():
+    audioId = createRecord()
+    detections = [{"id": f"d{i}", "analysisId": "first"} for i in range(3)]
+
+    markAnalysisComplete("first", audioId, detections, storage="subcollection")
+
+    record = readRecord(audioId)
+    assert record["detections"] == []
+    assert (record["detectionCounts"], record["detectionCount"], record["hasDetections"]) == ({"first": 3}, 3, True)
+    assert readSubcollection(audioId) == byId(detections)
+
+
+def test_write_detections_commits_in_batches(monkeypatch):
+    monkeypatch.setattr(records, "MAX_BATCH_WRITES", 2)
+    db = getDb()
+    batches = []
+    batch = db.batch
+
+    def countingBatch():
+        batches.append(batch())
+        return batches[-1]
+
+    monkeypatch.setattr(db, "batch", countingBatch)
+    audioId = createRecord()
+
+    records.writeDetections(audioId, [{"id": f"d{i}"} for i in range(5)])
+
+    assert len(batches) == 3
+    assert set(readSubcollection(audioId)) == {"d0", "d1", "d2", "d3", "d4"}
+
+
+def test_a_failed_detection_write_fails_the_completion(monkeypatch):
+    db = getDb()
+    batch = db.batch
+
+    def failingCommit():
+        raise ConnectionError("aborted")
+
+    def failingBatch():
+        writer = batch()
+        writer.commit = failingCommit
+        return writer
+
+    monkeypatch.setattr(db, "batch", failingBatch)
+    audioId = createRecord()
+
+    with pytest.raises(ConnectionError):
+        markAnalysisComplete("first", audioId, [{"id": "d1", "analysisId": "first"}], storage="subcollection")
+
+    # Nothing marks it complete, so the redelivered message runs it again
+    assert readRecord(audioId)["analysesPerformed"] == []
+
+
+def test_subcollection_summary_doesnt_count_moved_detections_twice():
+    # An analysis that wrote to the array is re-run with subcollection storage, next to another's array detection
+    audioId = createRecord(detections=[{"id": "x1", "analysisId": "x"}, {"id": "x2", "analysisId": "x"},
+                                       {"id": "y1", "analysisId": "y"}])
+
+    markAnalysisComplete("x", audioId, [{"id": "x1", "analysisId": "x"}, {"id": "x2", "analysisId": "x"}],
+                         storage="subcollection")
+
+    record = readRecord(audioId)
+    assert record["detectionCounts"] == {"x": 2}
+    assert record["detectionCount"] == 3
+    assert record["hasDetections"] is True
+    assert set(readSubcollection(audioId)) == {"x1", "x2"}
+
+
+def test_union_subcollection_completion_drops_the_total():
+    audioId = createRecord(detectionCounts={"x": 2}, detectionCount=2, hasDetections=True)
+
+    markAnalysisComplete("y", audioId, [{"id": "y1", "analysisId": "y"}], mode="union", storage="subcollection")
+
+    record = readRecord(audioId)
+    assert record["detectionCounts"] == {"x": 2, "y": 1}
+    assert "detectionCount" not in record
+    assert record["analysesPerformed"] == ["y"]
+
+    # A later transaction mode completion totals them again
+    markAnalysisComplete("z", audioId, [], storage="subcollection")
+    assert readRecord(audioId)["detectionCount"] == 3
+
+
+def test_commit_folds_transaction_and_union_writes_for_one_clip():
+    audioId = createRecord(analysesPerformed=["earlier"],
+                           detections=[{"id": "d1", "analysisId": "first", "confidence": 0.1}])
+
+    commitWrites([
+        CompletionWrite("first", audioId, [{"id": "d1", "analysisId": "first", "confidence": 0.9}], "transaction", "record"),
+        CompletionWrite("union", audioId, [{"id": "d2", "analysisId": "union"}], "union", "record"),
+        CompletionWrite("second", audioId, [{"id": "d3", "analysisId": "second"}], "transaction", "record"),
+    ])
+
+    record = readRecord(audioId)
+    assert sorted(record["analysesPerformed"]) == ["earlier", "first", "second", "union"]
+    assert len(record["analysesPerformed"]) == 4
+    detections = byId(record["detections"])
+    assert set(detections) == {"d1", "d2", "d3"}
+    assert detections["d1"]["confidence"] == 0.9
+    assert record["hasDetections"] is True
+
+
+def test_commit_in_one_batch_matches_committing_one_by_one():
+    def writes(audioId):
+        return [
+            CompletionWrite("first", audioId, [{"id": "d1", "analysisId": "first"}], "transaction", "record"),
+            CompletionWrite("union", audioId, [{"id": "d2", "analysisId": "union"}], "union", "record"),
+            CompletionWrite("first", audioId, [{"id": "d1", "analysisId": "first", "rerun": True}], "transaction", "record"),
+        ]
+
+    batched = createRecord()
+    commitWrites(writes(batched))
+    oneByOne = createRecord()
+    for write in writes(oneByOne):
+        commitWrites([write])
+
+    a, b = readRecord(batched), readRecord(oneByOne)
+    assert sorted(a["analysesPerformed"]) == sorted(b["analysesPerformed"]) == ["first", "union"]
+    assert byId(a["detections"]) == byId(b["detections"])
+    assert byId(a["detections"])["d1"]["rerun"] is True
+
+
+def test_commit_splits_writes_across_commits_and_writes_results(monkeypatch):
+    monkeypatch.setattr(records, "MAX_BATCH_WRITES", 3)
+    commitChunk = records._commitChunk
+    chunks = []
+
+    def countingCommitChunk(writes):
+        chunks.append(len(writes))
+        commitChunk(writes)
+
+    monkeypatch.setattr(records, "_commitChunk", countingCommitChunk)
+    audioIds = [createRecord() for _ in range(3)]
+
+    commitWrites([CompletionWrite("sub", audioIds[0], [{"id": f"s{i}", "analysisId": "sub"} for i in range(5)],
+                                  "transaction", "subcollection")]
+                 + [CompletionWrite("first", audioId, [], "union", "record") for audioId in audioIds]
+                 + [ResultWrite("first", audioIds[1], {"score": 0.5})])
+
+    # The subcollection completion is too big to share a commit, the rest go three at a time
+    assert chunks == [3, 1]
+    assert len(readSubcollection(audioIds[0])) == 5
+    assert sorted(readRecord(audioIds[0])["analysesPerformed"]) == ["first", "sub"]
+    assert [readRecord(audioId)["analysesPerformed"] for audioId in audioIds[1:]] == [["first"], ["first"]]
+    assert records.getAnalysisResult("first", audioIds[1]) == {"score": 0.5}
@@ -0,0 +1,147 @@
+import threading
+import time
+
+import pytest
+
+from bugg_runtime import subscriber, writebehind
+from bugg_runtime.clients import PROJECT_ID, getLocalPubSub, getPublisherClient, getSubscriberClient
+from bugg_runtime.metrics import getMetrics
+from bugg_runtime.writebehind import stageWrite, stagingWrites
+
+
+class Message():
+
+    def __init__(self, messageId: str = "m1"):
+        self.message_id = messageId
+        self.acked = 0
+        self.nacked = 0
+
+    def ack(self):
+        self.acked += 1
+
+    def nack(self):
+        self.nacked += 1
+
+
+def test_inference_pool_bounds_how_many_run_at_once():
+    pool = subscriber.InferencePool(2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def work():
+        with pool.slot():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+    assert pool.busy() == 0
+
+
+def test_ack_message_acks_straight_away_without_write_behind(monkeypatch):
+    monkeypatch.setattr(subscriber, "_writeBehind", None)
+    message = Message()
+
+    with stagingWrites(always=True):
+        stageWrite("write")
+        subscriber.ackMessage(message)
+
+    assert message.acked == 1
+
+
+def test_ack_message_hands_staged_writes_to_the_write_behind_buffer(monkeypatch):
+    submitted = []
+
+    class Buffer():
+        def submit(self, message, writes):
+            submitted.append((message, writes))
+
+    monkeypatch.setattr(subscriber, "_writeBehind", Buffer())
+    message = Message()
+
+    with stagingWrites(always=True):
+        stageWrite("write")
+        subscriber.ackMessage(message)
+
+    assert submitted == [(message, ["write"])]
+    assert message.acked == 0
+
+
+def test_track_in_flight_commits_writes_left_over_after_the_callback(monkeypatch):
+    monkeypatch.setattr(writebehind, "COMPLETION_BATCH_SIZE", 10)
+    committed = []
+    monkeypatch.setattr(subscriber, "commitWrites", committed.append)
+
+    def callback(message):
+        message.ack()
+        stageWrite("late write")
+
+    subscriber._trackInFlight(callback)(Message())
+
+    assert committed == [["late write"]]
+
+
+def test_track_in_flight_counts_failures_and_reraises(monkeypatch):
+    monkeypatch.setattr(writebehind, "COMPLETION_BATCH_SIZE", 10)
+    committed = []
+    monkeypatch.setattr(subscriber, "commitWrites", committed.append)
+    failedBefore = getMetrics().snapshot()["counters"].get("messages_failed", 0)
+
+    def callback(message):
+        stageWrite("write")
+        raise ValueError("bad clip")
+
+    with pytest.raises(ValueError):
+        subscriber._trackInFlight(callback)(Message())
+
+    # The message will be redelivered, so its writes are dropped rather than committed
+    assert committed == []
+    assert getMetrics().snapshot()["counters"]["messages_failed"] == failedBefore + 1
+    assert subscriber.getStatus()["inFlight"] == 0
+
+
+def test_subscribe_handles_every_message_with_several_in_flight(monkeypatch):
+    monkeypatch.setattr(subscriber, "STATUS_INTERVAL_SECS", 0)
+    monkeypatch.setattr(subscriber, "_maxMessages", subscriber._maxMessages)
+    monkeypatch.setattr(subscriber, "_writeBehind", None)
+    lock = threading.Lock()
+    running = []
+    peak = []
+    handled = []
+
+    def callback(message):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+            handled.append(message.data)
+        subscriber.ackMessage(message)
+
+    thread = threading.Thread(target=subscriber.subscribe, args=("test-subscribe-sub", callback, 4), daemon=True)
+    thread.start()
+
+    publisher = getPublisherClient()
+    for i in range(20):
+        publisher.publish(publisher.topic_path(PROJECT_ID, "test-subscribe"), str(i).encode())
+
+    try:
+        assert getLocalPubSub().waitUntilDrained("test-subscribe-sub", timeout=10)
+    finally:
+        getSubscriberClient().close()
+        thread.join(5)
+
+    assert sorted(handled) == sorted(str(i).encode() for i in range(20))
+    assert 1 < max(peak) <= 4
+    assert not thread.is_alive()
@@ -0,0 +1,93 @@
+import threading
+
+from bugg_runtime import writebehind
+from bugg_runtime.writebehind import (WriteBehindBuffer, isStaging, stageWrite, stagingWrites,
+                                      takeStagedWrites)
+
+
+class Message():
+
+    def __init__(self):
+        self.settled = threading.Event()
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
+        self.settled.set()
+
+    def nack(self):
+        self.nacked = True
+        self.settled.set()
+
+
+def test_writes_are_only_staged_when_write_behind_is_on(monkeypatch):
+    with stagingWrites():
+        assert not isStaging()
+        assert not stageWrite("write")
+
+    monkeypatch.setattr(writebehind, "COMPLETION_BATCH_SIZE", 10)
+    with stagingWrites():
+        assert stageWrite("write")
+        assert takeStagedWrites() == ["write"]
+        assert takeStagedWrites() == []
+    assert not isStaging()
+
+
+def test_always_stages_whether_or_not_write_behind_is_on():
+    with stagingWrites(always=True):
+        stageWrite("a")
+        stageWrite("b")
+        assert takeStagedWrites() == ["a", "b"]
+
+
+def test_buffer_commits_a_full_batch_at_once_and_acks_it():
+    commits = []
+    buffer = WriteBehindBuffer(commits.append, maxMessages=3, maxDelaySecs=60)
+    messages = [Message() for _ in range(3)]
+
+    for i, message in enumerate(messages):
+        buffer.submit(message, [f"w{i}"])
+
+    for message in messages:
+        assert message.settled.wait(5)
+    assert commits == [["w0", "w1", "w2"]]
+    assert all(m.acked for m in messages)
+    assert buffer.pending() == 0
+
+
+def test_buffer_commits_a_partial_batch_once_the_oldest_has_waited():
+    commits = []
+    buffer = WriteBehindBuffer(commits.append, maxMessages=10, maxDelaySecs=0.05)
+    message = Message()
+
+    buffer.submit(message, ["w"])
+
+    assert message.settled.wait(5)
+    assert message.acked
+    assert commits == [["w"]]
+
+
+def test_buffer_nacks_the_whole_batch_when_the_commit_fails():
+    def commit(writes):
+        raise ConnectionError("aborted")
+
+    buffer = WriteBehindBuffer(commit, maxMessages=2, maxDelaySecs=60)
+    messages = [Message(), Message()]
+    for message in messages:
+        buffer.submit(message, ["w"])
+
+    for message in messages:
+        assert message.settled.wait(5)
+    assert all(m.nacked and not m.acked for m in messages)
+
+
+def test_flush_hands_every_write_to_one_commit():
+    commits = []
+    buffer = WriteBehindBuffer(commits.append, maxMessages=2)
+    messages = [Message(), Message()]
+
+    buffer.flush([(messages[0], ["a", "b"], 0), (messages[1], ["c"], 0)])
+
+    assert commits == [["a", "b", "c"]]
+    assert all(m.acked for m in messages)
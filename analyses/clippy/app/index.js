@@ -17,7 +17,20 @@ async function processAudio(audioId, detectionId) {
   let snapshot = await admin.firestore().doc(`audio/${audioId}`).get();
   let audioRec = snapshot.data();
 
-  let detection = audioRec.detections.find((d) => d.id === detectionId);
+  let detectionRef = admin
+    .firestore()
+    .doc(`audio/${audioId}/detections/${detectionId}`);
+
+  let detection = (audioRec.detections || []).find((d) => d.id === detectionId);
+  let inSubcollection = false;
+  if (!detection) {
+    // The analyses can store detections in a subcollection instead of on the record
+    let detectionSnapshot = await detectionRef.get();
+    if (detectionSnapshot.exists) {
+      detection = detectionSnapshot.data();
+      inSubcollection = true;
+    }
+  }
   if (!detection) {
     throw new Error(
       `No detection with ID ${detectionId} found on audio ${audioId}`
@@ -105,6 +118,20 @@ async function processAudio(audioId, detectionId) {
 
   // Add a uri to the detection
 
+  if (inSubcollection) {
+    let update = {
+      uri: detectionUri,
+      uriLoudnorm: detectionLoudnormUri,
+    };
+    if (!detection.time && audioRec.uploadedAt && detection.start !== undefined) {
+      update.time = addSeconds(audioRec.uploadedAt.toDate(), detection.start);
+    }
+    await detectionRef.update(update);
+
+    console.log(`Updated detection ${audioId} ${detectionId} ${detectionUri}`);
+    return;
+  }
+
   await admin.firestore().runTransaction(async (txn) => {
     let audioRef = admin.firestore().doc(`audio/${audioId}`);
 
@@ -353,6 +380,25 @@ async function zipFile(exportId, fileName, csv) {
   });
 }
 
+/**
+ * The record's detections, including those the analyses stored in its audio/{id}/detections
+ * subcollection. Only records with detectionCounts have any there.
+ */
+async function getDetections(snap) {
+  let record = snap.data();
+  let detections = record.detections || [];
+  let detectionCounts = record.detectionCounts;
+  if (!detectionCounts) {
+    return detections;
+  }
+
+  let detectionSnaps = await snap.ref.collection("detections").get();
+  // detections left on the record by an analysis that has since run again are in the subcollection now
+  return detections
+    .filter((d) => !(d.analysisId in detectionCounts))
+    .concat(detectionSnaps.docs.map((d) => d.data()));
+}
+
 async function exportDetections(query, onProgress, writer) {
   let hasMore = true;
   let after = null;
@@ -376,7 +422,7 @@ async function exportDetections(query, onProgress, writer) {
           continue;
         }
 
-        for (let detection of record.detections) {
+        for (let detection of await getDetections(snap)) {
           count = count + 1;
           let downloadLinkPrefix = `https://bugg-301712.web.app/download/${
             record.downloadToken || "MISSIGNO"
@@ -461,6 +507,7 @@ async function exportAudioRecords(query, onProgress, writer) {
         let downloadLinkPrefix = `https://bugg-301712.web.app/download/${
           record.downloadToken || "MISSIGNO"
         }`;
+        let detections = await getDetections(snap);
 
         writer.write({
           audio_id: record.id,
@@ -479,8 +526,8 @@ async function exportAudioRecords(query, onProgress, writer) {
           )}`,
 
           has_detections: record.hasDetections === true,
-          detections_count: record.detections.length || 0,
-          detections: record.detections.map((d) =>
+          detections_count: detections.length,
+          detections: detections.map((d) =>
             d.tags.map((t) => `${d.analysisId}:${t}`).join(", ")
           ),
 
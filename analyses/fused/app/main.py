@@ -0,0 +1,45 @@
+import importlib.util
+import os
+import sys
+
+from bugg_runtime import AudioPipeline, FusedRunner, subscribe
+
+subscription_id = os.environ.get("FUSED_SUBSCRIPTION", "analyses.fused-sub")
+# Where the image keeps a copy of each analysis's app directory
+analyses_dir = os.environ.get("FUSED_ANALYSES_DIR", "/analyses")
+# The co-deployed analyses, by their app directory name
+analyses = os.environ.get("FUSED_ANALYSES", "vggish,birdnet-lite,anomaly-detection").split(",")
+
+
+def load_analysis(name: str):
+    """
+    Imports an analysis's main.py under its own name, with its app directory on the path for its other modules
+    """
+    app_dir = os.path.join(analyses_dir, name)
+    sys.path.insert(0, app_dir)
+
+    spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_main", os.path.join(app_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+runner = FusedRunner()
+for name in analyses:
+    analysis = load_analysis(name)
+    if hasattr(analysis, "process_upstream"):
+        # Analyses that are triggered by another run straight after it, on its output
+        runner.chain(analysis.analysis_id, analysis.trigger, analysis.process_upstream)
+    else:
+        runner.register(analysis.analysis_id, analysis.sample_rate, analysis.process_waveform)
+
+# Downloads and decodes each clip once, then hands it to every analysis in turn
+on_message = AudioPipeline("fused", runner)
+
+
+def start():
+    subscribe(subscription_id, on_message, maxMessages=on_message.maxMessages)
+
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,7 @@
+#!/bin/bash
+# The shared runtime and the fused analyses live outside this build context, so stage copies of them alongside the app
+rm -rf bugg-runtime analyses && cp -r ../bugg-runtime bugg-runtime
+mkdir analyses && cp -r ../vggish/app analyses/vggish && cp -r ../birdnet-lite/app analyses/birdnet-lite
+cp -r ../anomaly-detection/app analyses/anomaly-detection
+gcloud builds submit --timeout=900s --tag eu.gcr.io/bugg-301712/analyses-fused
+rm -rf bugg-runtime analyses
@@ -1,17 +1,15 @@
 import json
 import os
 
-import firebase_admin
-from firebase_admin import credentials, firestore
+from bugg_runtime import (deleteDownloadedAudio, downloadAudio,
+                          getAnalysisResult, getAudioDBRecord,
+                          markAnalysisComplete, recordDetection,
+                          setAnalysisResult, unpack)
 from flask import Flask, jsonify, request
 from mutagen.mp3 import MP3
 
-from bugg import *
-
 app = Flask(__name__)
 
-db = firestore.Client()
-
 # A sample that analyses the audio file and posts the results to the database
 @app.route("/", methods=['POST'])
 def hello_world():
@@ -29,7 +27,7 @@ def hello_world():
 
     # Download the audio file from storage to the local disk.
     print("downloading audio")
-    audioPath = downloadAudio(analysisRequest)
+    audioPath = downloadAudio(analysisRequest.analysisId, audioDBRecord)
 
     # An toy example of processing the audio file
     audioMeta = MP3(audioPath)
@@ -38,7 +36,7 @@ def hello_world():
 
     # Cloud Run uses an in-memory disk that is shared across requests so it's important the file is deleted after
     print("deleting file")
-    deleteAudio(audioPath)
+    deleteDownloadedAudio(audioPath)
 
     # If it's less than 1mb you can store the result in firebase
     setAnalysisResult(analysisRequest.analysisId, analysisRequest.audioId, {
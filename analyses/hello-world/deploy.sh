@@ -1,3 +1,6 @@
 #!/bin/bash
+# The shared runtime lives outside this build context, so stage a copy of it alongside the app
+rm -rf bugg-runtime && cp -r ../bugg-runtime bugg-runtime
 gcloud builds submit --tag gcr.io/bugg-301712/hello-world
+rm -rf bugg-runtime
 gcloud run deploy --image gcr.io/bugg-301712/hello-world --platform managed
@@ -1,12 +1,13 @@
-from concurrent.futures import TimeoutError
 from unittest import result
-from google.cloud import pubsub_v1
-from bugg import *
-from google.cloud import storage
-from pyannote_predict import detect_speech
+from bugg_runtime import (AudioFile, AudioPipeline, decodeAudio,
+                          deleteDownloadedAudio, downloadAudioUrl, getDb,
+                          getStorageClient, inferenceSlot,
+                          markAnalysisComplete, subscribe, timeStage)
+from pyannote_predict import SAMPLE_RATE, detect_speech
 import os
+import shutil
+import tempfile
 from datetime import datetime, timedelta
-import librosa
 import hashlib
 
 subscription_id = "speech-filter-sub"
@@ -39,20 +40,18 @@ def on_filter_audio(storage_url: str, audio_file_path: str):
     # e.g. audio/proj_sig/bugg_RPiID-10000sigdemo1/conf_f336ad3
     path_prefix = "/".join(object_name.split("/")[:-1])
 
+    # Decode the mp3 straight into memory at the rate the model expects
+    waveform = decodeAudio(audio_file_path, SAMPLE_RATE)
+
     # Get the duration of the audio file
-    full_duration = librosa.get_duration(filename=audio_file_path)
+    full_duration = len(waveform) / SAMPLE_RATE
     print(f"full_duration={full_duration}")
 
-    # Convert the mp3 to a wav file
-    wav_file_path = audio_file_path.replace(".mp3", ".wav")
-    command = f"ffmpeg -hide_banner -loglevel error -y -i {audio_file_path} {wav_file_path}"
-    print(f"Converting {audio_file_path} to {wav_file_path}")
-    os.system(command)
-
-    detections = detect_speech(wav_file_path)
+    with inferenceSlot():
+        detections = detect_speech(waveform)
     has_human_speech = len(detections) > 0
 
-    client = storage.Client()
+    client = getStorageClient()
 
     if has_human_speech:
         # We need to extract the date from the file name
@@ -63,11 +62,9 @@ def on_filter_audio(storage_url: str, audio_file_path: str):
         # Split into clips of audio with and audio without human speech
         # and upload to the respective buckets
 
-        if not os.path.exists("/tmp/audio-with-speech"):
-            os.makedirs("/tmp/audio-with-speech")
-
-        if not os.path.exists("/tmp/audio-without-speech"):
-            os.makedirs("/tmp/audio-without-speech")
+        # Each message gets its own directories as several may be filtered at once
+        with_speech_dir = tempfile.mkdtemp(prefix="audio-with-speech-")
+        without_speech_dir = tempfile.mkdtemp(prefix="audio-without-speech-")
 
         # Slice the speech out of the audio
         current_time = 0
@@ -81,7 +78,7 @@ def on_filter_audio(storage_url: str, audio_file_path: str):
                 if duration > 0.1:
                     iso_filename = getDateFileName(datetime_base, current_time)
                     print(f"pre without iso_filename={iso_filename}")
-                    command = f"ffmpeg -hide_banner -loglevel error -y -ss {current_time} -i {audio_file_path} -t {duration} -c copy /tmp/audio-without-speech/{iso_filename}.{file_extension}"
+                    command = f"ffmpeg -hide_banner -loglevel error -y -ss {current_time} -i {audio_file_path} -t {duration} -c copy {without_speech_dir}/{iso_filename}.{file_extension}"
                     os.system(command)
                 else:
                     print("duration of clean audio is too short")
@@ -91,7 +88,7 @@ def on_filter_audio(storage_url: str, audio_file_path: str):
             duration = end - start
             iso_filename = getDateFileName(datetime_base, start)
             print(f"with iso_filename={iso_filename}")
-            command = f"ffmpeg -hide_banner -loglevel error -y -ss {start} -i {audio_file_path} -t {duration} -c copy /tmp/audio-with-speech/{iso_filename}.{file_extension}"
+            command = f"ffmpeg -hide_banner -loglevel error -y -ss {start} -i {audio_file_path} -t {duration} -c copy {with_speech_dir}/{iso_filename}.{file_extension}"
             os.system(command)
 
             current_time = end
@@ -101,27 +98,27 @@ def on_filter_audio(storage_url: str, audio_file_path: str):
             duration = full_duration - current_time
             iso_filename = getDateFileName(datetime_base, current_time)
             print(f"last without iso_filename={iso_filename}")
-            command = f"ffmpeg -hide_banner -loglevel error -y -ss {current_time} -i {audio_file_path} -t {duration} -c copy /tmp/audio-without-speech/{iso_filename}.{file_extension}"
+            command = f"ffmpeg -hide_banner -loglevel error -y -ss {current_time} -i {audio_file_path} -t {duration} -c copy {without_speech_dir}/{iso_filename}.{file_extension}"
             os.system(command)
 
         # upload the segments with speech to the quarantine bucket
         quarantine_bucket_name = "bugg-audio-speech-quarantine"
         quarantine_bucket = client.get_bucket(quarantine_bucket_name)
-        for file in os.listdir("/tmp/audio-with-speech/"):
+        for file in os.listdir(with_speech_dir):
             blob = quarantine_bucket.blob(f"{path_prefix}/{file}")
             blob.upload_from_filename(
-                filename=f"/tmp/audio-with-speech/{file}")
+                filename=f"{with_speech_dir}/{file}")
 
         # all others continue processing
         bucket = client.get_bucket("bugg-301712.appspot.com")
-        for file in os.listdir("/tmp/audio-without-speech/"):
+        for file in os.listdir(without_speech_dir):
             blob = bucket.blob(f"{path_prefix}/{file}")
             blob.upload_from_filename(
-                filename=f"/tmp/audio-without-speech/{file}")
+                filename=f"{without_speech_dir}/{file}")
 
-        # Delete the dir /tmp/audio-with-speech and /tmp/audio-without-speech
-        os.system("rm -rf /tmp/audio-with-speech")
-        os.system("rm -rf /tmp/audio-without-speech")
+        # Delete the split audio directories
+        shutil.rmtree(with_speech_dir)
+        shutil.rmtree(without_speech_dir)
 
         db = getDb()
 
@@ -159,26 +156,28 @@ def on_filter_audio(storage_url: str, audio_file_path: str):
     blob = bucket.blob(object_name)
     blob.delete()
 
-    os.remove(wav_file_path)
-
     print(f"{storage_url} completed")
 
 
 analysis_id = "speech-detection-pyannote"
+# The rate the fused runner hands process_waveform
+sample_rate = SAMPLE_RATE
 
 
-def on_process_audio(audio_id: str, audio_rec: dict, audio_file_path: str):
+def on_process_audio(audio_id: str, audio_rec: dict, audio: AudioFile):
 
-    print(f"PROCESSING audioId={audio_id} audio_file_path={audio_file_path}")
+    print(f"PROCESSING audioId={audio_id} audio={audio.name}")
 
-    # Convert the mp3 to a wav file
-    wav_file_path = audio_file_path.replace(".mp3", ".wav")
-    command = f"ffmpeg -hide_banner -loglevel error -y -i {audio_file_path} {wav_file_path}"
-    print(f"Converting {audio_file_path} to {wav_file_path}")
-    os.system(command)
+    # Decode the mp3 straight into memory at the rate the model expects
+    process_waveform(audio_id, audio_rec, decodeAudio(audio, SAMPLE_RATE))
 
-    results = detect_speech(wav_file_path)
-    os.remove(wav_file_path)
+
+def process_waveform(audio_id: str, audio_rec: dict, waveform):
+    """
+    Runs speech detection on a clip already decoded to sample_rate. Also the entry point for the fused runner
+    """
+    with inferenceSlot(), timeStage("inference"):
+        results = detect_speech(waveform)
 
     detections = []
     for detection in results:
@@ -201,6 +200,10 @@ def on_process_audio(audio_id: str, audio_rec: dict, audio_file_path: str):
     print(f"{audio_id} completed with {len(detections)} detections")
 
 
+# Fetches the record and downloads the audio (ahead of time when prefetching) before handing it to on_process_audio
+audio_pipeline = AudioPipeline(analysis_id, on_process_audio)
+
+
 def on_message(message):
     message_string = message.data.decode("utf-8")
 
@@ -222,47 +225,11 @@ def on_message(message):
 
     else:
         # We should have an audio id to run an analysis with
-        audio_id = message_string
-        # Fetch the database record we have for this audio clip
-        audio_rec = getAudioDBRecord(audio_id)
-
-        # Download the audio file
-        audio_file_path = downloadAudio(analysis_id, audio_rec)
-
-        # Run the processing
-        on_process_audio(audio_id, audio_rec, audio_file_path)
-
-        # Cleanup
-        deleteDownloadedAudio(audio_file_path)
-
-        message.ack()
-        print(f"Processing complete for {audio_id}")
+        audio_pipeline(message)
 
 
 def start():
-    project_id = "bugg-301712"
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(
-        project_id, subscription_id)
-
-    # Limit the subscriber to only have one outstanding message at a time.
-    flow_control = pubsub_v1.types.FlowControl(max_messages=1)
-
-    streaming_pull_future = subscriber.subscribe(
-        subscription_path, callback=on_message, flow_control=flow_control
-    )
-    print(f"Listening for messages on {subscription_path}..\n")
-
-    # Wrap subscriber in a 'with' block to automatically call close() when done.
-    with subscriber:
-        try:
-            # When `timeout` is not set, result() will block indefinitely,
-            # unless an exception is encountered first.
-            streaming_pull_future.result()
-        except TimeoutError:
-            streaming_pull_future.cancel()  # Trigger the shutdown.
-            # Block until the shutdown is complete.
-            streaming_pull_future.result()
+    subscribe(subscription_id, on_message, maxMessages=audio_pipeline.maxMessages)
 
 
 if __name__ == "__main__":
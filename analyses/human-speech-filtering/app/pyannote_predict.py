@@ -1,18 +1,41 @@
+import threading
 import torch
 import json
+import numpy as np
 from pyannote.audio.utils.signal import Binarize
 
-def detect_speech(wav_file_path: str):
-    # Device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Rate the sad_ami model was trained at. Audio is decoded straight to it
+SAMPLE_RATE = 16000
 
-    # Load the PyAnnote model
-    print("Loading the model...")
-    sad = torch.hub.load('pyannote/pyannote-audio', 'sad_ami', device=device, batch_size=128)
+# The model is loaded once per process and shared by every message
+sad = None
+sad_lock = threading.Lock()
+
+
+def load_model():
+    global sad
+    with sad_lock:
+        if sad is None:
+            # Device
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+            # Load the PyAnnote model
+            print("Loading the model...")
+            sad = torch.hub.load('pyannote/pyannote-audio', 'sad_ami', device=device, batch_size=128)
+
+    return sad
+
+
+def detect_speech(waveform: np.ndarray):
+    """
+    Finds the regions of speech in mono audio decoded at SAMPLE_RATE
+    """
+    sad = load_model()
 
     print("Loading the audio...")
     binarize = Binarize(offset=0.52, onset=0.52, log_scale=True, min_duration_off=0.6, min_duration_on=0.6)    
-    sad_scores = sad({'uri': 'file', 'audio': wav_file_path})
+    # Precomputed waveforms are passed as (n_samples, n_channels)
+    sad_scores = sad({'uri': 'file', 'waveform': waveform.reshape(-1, 1)})
 
     # speech regions as a list / Can be an alternative to
     # speech.duration if we want to know WHERE is the speech
@@ -1 +1,5 @@
+#!/bin/bash
+# The shared runtime lives outside this build context, so stage a copy of it alongside the app
+rm -rf bugg-runtime && cp -r ../bugg-runtime bugg-runtime
 gcloud builds submit --tag eu.gcr.io/bugg-301712/human-speech-filtering
+rm -rf bugg-runtime
@@ -1,10 +1,15 @@
-import tensorflow as tf
+from bugg_runtime import inCurrentMessage, timeStage
 import vggish_input
 import vggish_params
-import vggish_slim
 import numpy as np
 import urllib.request as urllib
 import os
+import queue
+import threading
+import time
+
+# Batches of examples to compute on a background thread while the session runs the current one. 0 computes them in turn
+OVERLAP_BATCHES = int(os.environ.get('BUGG_VGGISH_OVERLAP_BATCHES', '0'))
 
 '''
 Get an embedding from the AudioSet VGGish network. https://github.com/tensorflow/models/tree/master/research/audioset
@@ -50,12 +55,96 @@ def rebin(a, shape):
     return a.reshape(sh).mean(-1).mean(1)
 
 
+class ClipBatcher(object):
+    '''
+    Collects the examples of clips being handled on different threads and runs them through
+    analyse_many together, so their examples share full batches. submit() blocks until its
+    clip's result is back.
+
+    A group is run once it has enough examples to fill a batch, holds max_clips clips, or its
+    first clip has waited max_delay_secs.
+    '''
+
+    def __init__(self, analyse_many, batch_size, max_clips, max_delay_secs):
+        self.analyse_many = analyse_many
+        self.batch_size = batch_size
+        self.max_clips = max_clips
+        self.max_delay_secs = max_delay_secs
+
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def submit(self, examples):
+        clip = {'examples': examples, 'submitted': time.monotonic(), 'done': threading.Event()}
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('ClipBatcher: the batching thread has stopped')
+            self._pending.append(clip)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vggish-batcher', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+        clip['done'].wait()
+        if 'error' in clip:
+            raise clip['error']
+        return clip['result']
+
+    def _pending_examples(self):
+        return sum(clip['examples'].shape[0] for clip in self._pending)
+
+    def _run(self):
+        group = []
+        try:
+            while True:
+                with self._condition:
+                    while len(self._pending) == 0:
+                        self._condition.wait()
+
+                    while len(self._pending) < self.max_clips and self._pending_examples() < self.batch_size:
+                        remaining = self.max_delay_secs - (time.monotonic() - self._pending[0]['submitted'])
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+
+                    group = self._pending[:self.max_clips]
+                    self._pending = self._pending[self.max_clips:]
+
+                try:
+                    results = self.analyse_many([clip['examples'] for clip in group])
+                    for clip, result in zip(group, results):
+                        clip['result'] = result
+                except Exception as e:
+                    # Every clip in the group fails, and each message is redelivered
+                    for clip in group:
+                        clip['error'] = e
+                for clip in group:
+                    clip['done'].set()
+                group = []
+        finally:
+            # Only reached if the thread is dying (e.g. on a BaseException). Nothing would ever run
+            # the clips still waiting, so they fail now, as does anything submitted from here on
+            with self._condition:
+                self._stopped = True
+                abandoned = group + self._pending
+                self._pending = []
+            for clip in abandoned:
+                if not clip['done'].is_set():
+                    clip.setdefault('error', RuntimeError('ClipBatcher: the batching thread stopped before analysing the clip'))
+                    clip['done'].set()
+
+
 class AudiosetAnalysis(object):
     def setup(self):
         # Paths to downloaded VGGish files.
-        self.checkpoint_path = 'vggish_model.ckpt'
-        self.pca_params_path = 'vggish_pca_params.npz'
+        # Kept next to this file so it can be loaded from another working directory (e.g. by the fused runner)
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+        self.checkpoint_path = os.path.join(app_dir, 'vggish_model.ckpt')
+        self.pca_params_path = os.path.join(app_dir, 'vggish_pca_params.npz')
         self.batch_size = 60
+        self.overlap_batches = OVERLAP_BATCHES
 
         # If we can't find the trained model files, download them
         if not os.path.exists(self.checkpoint_path):
@@ -65,6 +154,10 @@ class AudiosetAnalysis(object):
             print('AudiosetAnalysis: Downloading params file {} (please wait - this may take a while)'.format(self.pca_params_path))
             urllib.urlretrieve('https://storage.googleapis.com/audioset/vggish_pca_params.npz', self.pca_params_path)
 
+        # Imported here so the batching around the session can be used (and tested) without TensorFlow
+        import tensorflow as tf
+        import vggish_slim
+
         # Define VGGish
         self.sess = tf.Graph().as_default()
         config = tf.ConfigProto(device_count={'CPU': 4})
@@ -79,24 +172,176 @@ class AudiosetAnalysis(object):
     def analyse_audio(self, wav_f):
         # Calculate log mel spectrogram as input to CNN
         print('AudiosetAnalysis: Calculating log mel spectrogram for {}'.format(wav_f))
-        input_all = vggish_input.aud_file_to_examples(wav_f)
+        with timeStage('decode'):
+            aud_data, sr = vggish_input.aud_f_read(wav_f)
+        if self.overlap_batches > 0:
+            return self._analyse_overlapped(aud_data, sr)
+
+        return self.analyse_examples(self.waveform_examples(aud_data, sr))
+
+    def analyse_waveform(self, data, sample_rate):
+        '''
+        As analyse_audio, for audio that has already been decoded (e.g. by the fused runner)
+        '''
+        print('AudiosetAnalysis: Calculating log mel spectrogram for {:.1f}s of audio'.format(len(data) / sample_rate))
+        if self.overlap_batches > 0:
+            return self._analyse_overlapped(data, sample_rate)
 
-        print('AudiosetAnalysis: Calculating vggish features {} in batches of {}'.format(wav_f,self.batch_size))
+        return self.analyse_examples(self.waveform_examples(data, sample_rate))
 
+    def audio_examples(self, wav_f):
+        '''
+        The input examples for a file, to analyse along with other clips' in analyse_examples_many
+        '''
+        with timeStage('decode'):
+            aud_data, sr = vggish_input.aud_f_read(wav_f)
+        return self.waveform_examples(aud_data, sr)
+
+    def waveform_examples(self, data, sample_rate):
+        with timeStage('features'):
+            return vggish_input.waveform_to_examples(data, sample_rate)
+
+    def analyse_stream(self, blocks):
+        '''
+        As analyse_waveform, for a recording streamed in blocks already at vggish_params.SAMPLE_RATE.
+        The examples are batched and run as each batch fills, so memory doesn't grow with the
+        recording's length, and the embeddings are the same as analyse_waveform's on the whole of it.
+        '''
+        print('AudiosetAnalysis: Streaming vggish features in batches of {}'.format(self.batch_size))
+        return self._embed(self._overlapped(self._batches(self._stream_examples(blocks))))
+
+    def analyse_examples(self, input_all):
+        print('AudiosetAnalysis: Calculating vggish features for {} examples in batches of {}'.format(input_all.shape[0],self.batch_size))
+        return self._embed(self._batches([input_all]))
+
+    def analyse_examples_many(self, example_arrays):
+        '''
+        As analyse_examples for several clips at once. Their examples are packed into full batches
+        across the clips, so short clips don't each pay for a mostly empty sess.run, and the
+        embeddings are split back into a result per clip, in order.
+        '''
+        counts = [examples.shape[0] for examples in example_arrays]
+        print('AudiosetAnalysis: Calculating vggish features for {} examples from {} clips in batches of {}'.format(sum(counts), len(counts), self.batch_size))
+        embedding_all = self._embeddings(self._batches(example_arrays))
+        return [self._summarise(embeddings) for embeddings in np.split(embedding_all, np.cumsum(counts)[:-1])]
+
+    def _analyse_overlapped(self, data, sample_rate):
+        '''
+        Computes the examples a batch at a time so the next batch's can be worked out while the session runs this one.
+        They come out the same as waveform_to_examples' on the whole waveform.
+        '''
+        data = np.asarray(data, dtype=np.float32)
+        if len(data.shape) > 1:
+            data = np.mean(data, axis=1)
+        with timeStage('features'):
+            data = vggish_input.resample(data, sample_rate, vggish_params.SAMPLE_RATE)
+
+        block_length = self.batch_size * int(round(vggish_params.EXAMPLE_HOP_SECONDS * vggish_params.SAMPLE_RATE))
+        blocks = (data[i:i + block_length] for i in range(0, len(data), block_length))
+        return self._embed(self._overlapped(self._batches(self._stream_examples(blocks))))
+
+    def _overlapped(self, batches):
+        '''
+        Pulls batches (and whatever computing them involves) on a background thread, up to
+        overlap_batches ahead of the session. The time the session spends waiting on them is
+        timed as features_wait, which stays near zero while the features keep up.
+        '''
+        if self.overlap_batches <= 0:
+            for batch in batches:
+                yield batch
+            return
+
+        ready = queue.Queue(maxsize=self.overlap_batches)
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            # Gives up if the session side has stopped taking batches, e.g. after an error
+            while not stopped.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            outcome = finished
+            try:
+                for batch in batches:
+                    if not put(batch):
+                        return
+            except BaseException as e:
+                outcome = e
+            finally:
+                # Always ends the queue, however the batches stopped, so the session side is never left waiting
+                put(outcome)
+                # Stops their source (e.g. a decoder) here, where it was running, if the session side gave up early
+                batches.close()
+
+        producer = threading.Thread(target=inCurrentMessage(produce), name='vggish-features', daemon=True)
+        producer.start()
+        try:
+            while True:
+                with timeStage('features_wait'):
+                    item = ready.get()
+                if item is finished:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            producer.join()
+
+    def _stream_examples(self, blocks):
+        stream = vggish_input.StreamingExamples()
+        # The time spent getting each block is the source's (e.g. decoding), so only push is timed here
+        for block in blocks:
+            with timeStage('features'):
+                examples = stream.push(block)
+            yield examples
+
+    def _batches(self, example_arrays):
+        '''
+        Regroups arrays of examples into batches of batch_size, the last of which may be short
+        '''
+        pending = []
+        pending_count = 0
+        for examples in example_arrays:
+            start = 0
+            while start < examples.shape[0]:
+                take = min(self.batch_size - pending_count, examples.shape[0] - start)
+                pending.append(examples[start:start + take])
+                pending_count += take
+                start += take
+                if pending_count == self.batch_size:
+                    yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+                    pending = []
+                    pending_count = 0
+
+        if pending_count > 0:
+            yield np.concatenate(pending)
+
+    def _embed(self, batches):
+        return self._summarise(self._embeddings(batches))
+
+    def _embeddings(self, batches):
         # For each 0.96s chunk of audio, calculate the VGGish embedding
-        batch_idx = 0
         embedding_all = []
-        while batch_idx < input_all.shape[0]:
-            end_idx = np.min([input_all.shape[0], batch_idx+self.batch_size])
-            input_batch = input_all[batch_idx:end_idx,:,:]
-            batch_idx += self.batch_size
-
-            [embedding_batch] = self.sess.run([self.embedding_tensor],
-                                       feed_dict={self.features_tensor: input_batch})
-            embedding_all.append(embedding_batch)
+        try:
+            for input_batch in batches:
+                with timeStage('inference'):
+                    [embedding_batch] = self.sess.run([self.embedding_tensor],
+                                               feed_dict={self.features_tensor: input_batch})
+                embedding_all.append(embedding_batch)
+        finally:
+            # Stops an overlapped producer straight away if the session fails, rather than whenever the generator is collected
+            batches.close()
 
-        embedding_all = np.vstack(embedding_all)
+        return np.vstack(embedding_all)
 
+    def _summarise(self, embedding_all):
         # Calculate the mean feature vectors at different time scales
         time_per_feat = vggish_params.EXAMPLE_WINDOW_SECONDS
 
@@ -1,35 +1,91 @@
 import os
-from concurrent.futures import TimeoutError
 
 import numpy as np
-from google.cloud import pubsub_v1, storage
+from bugg_runtime import (AudioFile, AudioPipeline, decodeAudio, getBucket,
+                          inferenceSlot, markAnalysisComplete, streamAudio,
+                          subscribe, timeStage)
 
-from AudiosetAnalysis import AudiosetAnalysis
-from bugg import *
+from AudiosetAnalysis import AudiosetAnalysis, ClipBatcher
 
 subscription_id = "analyses.vggish-sub"
 analysis_id = "vggish"
+# The rate VGGish works at. Every clip is decoded straight to it with ffmpeg, streamed or not, so the embeddings don't depend on which path made them
+sample_rate = 16000
+# Clips at least this big are decoded and analysed a block at a time, so memory doesn't grow with their length. 0 never streams
+streaming_min_bytes = int(os.environ.get("BUGG_VGGISH_STREAMING_MIN_BYTES", "0"))
+# Seconds of audio decoded per block when streaming
+streaming_block_secs = float(os.environ.get("BUGG_VGGISH_STREAMING_BLOCK_SECS", "60"))
+# Clips whose examples are run through the model together, 0 or 1 to run each on its own
+batch_clips = int(os.environ.get("BUGG_VGGISH_BATCH_CLIPS", "0"))
+# Longest a clip waits for others to share its batches
+batch_secs = float(os.environ.get("BUGG_VGGISH_BATCH_SECS", "0.5"))
 
 an = AudiosetAnalysis()
 an.setup()
 
-def on_process_audio(audio_id: str, audio_rec: dict, audio_file_path: str):
+
+def analyse_batch(example_arrays: list) -> list:
+    with inferenceSlot():
+        return an.analyse_examples_many(example_arrays)
+
+
+# Packs the examples of the clips in flight into full batches, rather than a mostly empty one per short clip
+batcher = ClipBatcher(analyse_batch, an.batch_size, batch_clips, batch_secs) if batch_clips > 1 else None
+
+
+def on_process_audio(audio_id: str, audio_rec: dict, audio: AudioFile):
     
     print(f"PROCESSING audioId={audio_id}")
 
-    results = an.analyse_audio(audio_file_path)
+    if streaming_min_bytes > 0 and audio.size >= streaming_min_bytes:
+        # Long SD card uploads would otherwise need gigabytes for the waveform, spectrogram and examples
+        with inferenceSlot():
+            results = an.analyse_stream(streamAudio(audio, sample_rate, int(streaming_block_secs * sample_rate)))
+    elif batcher is not None:
+        with inferenceSlot():
+            examples = an.waveform_examples(decodeAudio(audio, sample_rate), sample_rate)
+        # Not holding the slot, which the batch takes when it runs
+        results = batcher.submit(examples)
+    else:
+        with inferenceSlot():
+            results = an.analyse_waveform(decodeAudio(audio, sample_rate), sample_rate)
+
+    save_results(audio_id, audio_rec, results)
+
+
+def process_waveform(audio_id: str, audio_rec: dict, waveform: np.ndarray):
+    """
+    Entry point for the fused runner, which has already decoded the clip to sample_rate
+    """
+    print(f"PROCESSING audioId={audio_id}")
+
+    if batcher is not None:
+        with inferenceSlot():
+            examples = an.waveform_examples(waveform, sample_rate)
+        results = batcher.submit(examples)
+    else:
+        with inferenceSlot():
+            results = an.analyse_waveform(waveform, sample_rate)
+
+    save_results(audio_id, audio_rec, results)
+
+    # Handed to the analyses the fused runner chains after this one
+    return results
+
+
+def save_results(audio_id: str, audio_rec: dict, results: dict):
     print("analysis complete") 
         
     # We store these results in cloud storage
-    client = storage.Client()
-    bucket = client.bucket("bugg-301712.appspot.com")
+    bucket = getBucket()
 
     for res in results.items():
         print('{}: {}'.format(res[0],res[1]))
 
         filename = '{}.npy'.format(res[0])
+        # Named for the clip too, as other messages' results are being saved at the same time
         workingDir = os.path.abspath(".")
-        filePath = f"{workingDir}/{filename}"
+        filePath = f"{workingDir}/{audio_id}_{filename}"
 
         print(f"Writing result to {filePath}")
         np.save(filePath, res[1], False)
@@ -37,13 +93,15 @@ def on_process_audio(audio_id: str, audio_rec: dict, audio_file_path: str):
         project = audio_rec["project"]
         destinationFile = f"artifacts/{analysis_id}/{project}/{audio_id}/{filename}"
         blob = bucket.blob(destinationFile)
-        blob.upload_from_filename(filePath)
+        with timeStage("upload"):
+            blob.upload_from_filename(filePath)
         os.remove(filePath)
         print('saved {}'.format(res[0]))
 
         metadata = {'projectId': project}
         blob.metadata = metadata
-        blob.patch()
+        with timeStage("upload"):
+            blob.patch()
     
     # add the detections to the audio 
     markAnalysisComplete(analysisId=analysis_id, audioId=audio_id, detections=[])
@@ -52,45 +110,13 @@ def on_process_audio(audio_id: str, audio_rec: dict, audio_file_path: str):
 
 
 
-def on_message(message):
-    audio_id = message.data.decode("utf-8") 
-
-    audio_rec = getAudioDBRecord(audio_id)
-
-    # Download the audio file 
-    audio_file_path = downloadAudio(analysis_id, audio_rec)    
-
-    on_process_audio(audio_id, audio_rec, audio_file_path)
-
-    # cleanup
-    deleteDownloadedAudio(audio_file_path)
-
-    message.ack()
-    print(f"Processing complete for {audio_id}")
+# Fetches the record and downloads the audio (ahead of time when prefetching) before handing it to on_process_audio
+on_message = AudioPipeline(analysis_id, on_process_audio)
 
 
 def start():
-    project_id = "bugg-301712"
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, subscription_id)
-
-    # Limit the subscriber to only have one outstanding message at a time.
-    flow_control = pubsub_v1.types.FlowControl(max_messages=1)
-
-    streaming_pull_future = subscriber.subscribe(
-        subscription_path, callback=on_message, flow_control=flow_control
-    )
-    print(f"Listening for messages on {subscription_path}..\n")
-
-    # Wrap subscriber in a 'with' block to automatically call close() when done.
-    with subscriber:
-        try:
-            # When `timeout` is not set, result() will block indefinitely,
-            # unless an exception is encountered first.
-            streaming_pull_future.result()
-        except TimeoutError:
-            streaming_pull_future.cancel()  # Trigger the shutdown.
-            streaming_pull_future.result()  # Block until the shutdown is complete.
+    # Clips can only be batched together if that many messages are in flight
+    subscribe(subscription_id, on_message, maxMessages=max(on_message.maxMessages, batch_clips))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,8 @@
+import os
+import sys
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, app_dir)
+
+# bugg_runtime is installed in the image, and otherwise used from the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(app_dir)), 'bugg-runtime'))
@@ -0,0 +1,202 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import vggish_params
+from AudiosetAnalysis import AudiosetAnalysis, ClipBatcher
+
+
+class FakeSession(object):
+    '''
+    Stands in for the TF session: each example's "embedding" is its first few values, so it can be traced back
+    '''
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def run(self, fetches, feed_dict):
+        [batch] = feed_dict.values()
+        self.batch_sizes.append(batch.shape[0])
+        return [batch[:, 0, :4].copy()]
+
+
+def analysis(batch_size=4, overlap_batches=0):
+    an = AudiosetAnalysis()
+    an.batch_size = batch_size
+    an.overlap_batches = overlap_batches
+    an.sess = FakeSession()
+    an.features_tensor = 'features'
+    an.embedding_tensor = 'embedding'
+    return an
+
+
+def clips(*counts):
+    '''
+    Arrays of examples whose values are their index across all the clips
+    '''
+    start = 0
+    arrays = []
+    for count in counts:
+        index = np.arange(start, start + count, dtype=np.float32)
+        arrays.append(np.broadcast_to(index[:, None, None], (count, 96, 64)).copy())
+        start += count
+    return arrays
+
+
+def waveform(secs, seed=0):
+    rng = np.random.RandomState(seed)
+    return (0.1 * rng.randn(int(secs * vggish_params.SAMPLE_RATE))).astype(np.float32)
+
+
+def test_batches_regroup_examples_across_clips_in_order():
+    an = analysis(batch_size=4)
+    arrays = clips(3, 5, 2, 4)
+
+    batches = list(an._batches(arrays))
+
+    assert [b.shape[0] for b in batches] == [4, 4, 4, 2]
+    np.testing.assert_array_equal(np.concatenate(batches), np.concatenate(arrays))
+
+
+
+def test_analyse_examples_many_splits_results_back_to_their_clips():
+    an = analysis(batch_size=4)
+    arrays = clips(3, 5, 1, 7)
+
+    results = an.analyse_examples_many(arrays)
+
+    # The session only saw full batches
+    assert an.sess.batch_sizes == [4, 4, 4, 4]
+    assert len(results) == 4
+    for examples, result in zip(arrays, results):
+        np.testing.assert_array_equal(result['raw_audioset_feats_960ms'], examples[:, 0, :4])
+        expected = analysis(batch_size=4).analyse_examples(examples)
+        for key in expected:
+            np.testing.assert_array_equal(result[key], expected[key])
+
+def test_streamed_clip_gets_the_same_results_as_the_whole_waveform():
+    data = waveform(11.3)
+    expected = analysis(batch_size=4).analyse_waveform(data, vggish_params.SAMPLE_RATE)
+
+    an = analysis(batch_size=4)
+    results = an.analyse_stream(data[i:i + 12345] for i in range(0, len(data), 12345))
+
+    assert an.sess.batch_sizes == [4, 4, 3]
+    assert set(results) == set(expected)
+    for key in expected:
+        np.testing.assert_array_equal(results[key], expected[key])
+
+
+def test_overlapped_batches_match_and_end_the_producer():
+    an = analysis(batch_size=4, overlap_batches=2)
+    arrays = clips(6, 9)
+
+    batches = list(an._overlapped(an._batches(arrays)))
+
+    np.testing.assert_array_equal(np.concatenate(batches), np.concatenate(arrays))
+    assert [t for t in threading.enumerate() if t.name == 'vggish-features'] == []
+
+
+def test_overlapped_waveform_gets_the_same_results():
+    data = waveform(11.3)
+    expected = analysis(batch_size=4).analyse_waveform(data, vggish_params.SAMPLE_RATE)
+
+    results = analysis(batch_size=4, overlap_batches=2).analyse_waveform(data, vggish_params.SAMPLE_RATE)
+
+    for key in expected:
+        np.testing.assert_array_equal(results[key], expected[key])
+
+
+@pytest.mark.parametrize('error', [ValueError('bad clip'), KeyboardInterrupt()])
+def test_overlapped_errors_reach_the_session_side(error):
+    an = analysis(batch_size=4, overlap_batches=2)
+
+    def failing():
+        yield clips(4)[0]
+        raise error
+
+    with pytest.raises(type(error)):
+        list(an._overlapped(failing()))
+
+
+def test_overlapped_stops_its_source_when_the_session_side_gives_up():
+    an = analysis(batch_size=4, overlap_batches=1)
+    closed = []
+
+    def endless():
+        try:
+            while True:
+                yield clips(4)[0]
+        finally:
+            closed.append(threading.current_thread().name)
+
+    batches = an._overlapped(endless())
+    next(batches)
+    batches.close()
+
+    assert closed == ['vggish-features']
+
+
+def test_clip_batcher_returns_each_clip_its_own_results():
+    an = analysis(batch_size=4)
+    batcher = ClipBatcher(an.analyse_examples_many, an.batch_size, max_clips=8, max_delay_secs=0.2)
+    arrays = clips(3, 2, 5, 1)
+    results = [None] * len(arrays)
+
+    def submit(i):
+        results[i] = batcher.submit(arrays[i])
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(arrays))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    for examples, result in zip(arrays, results):
+        np.testing.assert_array_equal(result['raw_audioset_feats_960ms'], examples[:, 0, :4])
+
+
+def test_clip_batcher_fails_every_clip_of_a_failed_batch():
+    def failing(example_arrays):
+        raise ValueError('session failed')
+
+    batcher = ClipBatcher(failing, 4, max_clips=2, max_delay_secs=0.05)
+
+    with pytest.raises(ValueError):
+        batcher.submit(clips(1)[0])
+    # The thread carries on, so the next clip is still run
+    with pytest.raises(ValueError):
+        batcher.submit(clips(1)[0])
+
+
+# The batching thread dying is the point of the test
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_clip_batcher_fails_its_clips_rather_than_hang_when_its_thread_dies():
+    def interrupted(example_arrays):
+        raise KeyboardInterrupt()
+
+    batcher = ClipBatcher(interrupted, 4, max_clips=2, max_delay_secs=0.05)
+    errors = []
+
+    def submit():
+        try:
+            batcher.submit(clips(1)[0])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=submit) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    batcher._thread.join(5)
+    assert not any(thread.is_alive() for thread in threads + [batcher._thread])
+    assert len(errors) == 3 and all(isinstance(e, RuntimeError) for e in errors)
+
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        batcher.submit(clips(1)[0])
+    assert time.monotonic() - start < 1
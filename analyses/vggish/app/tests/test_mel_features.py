@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import mel_features
+
+
+def waveform(samples, seed=0):
+    rng = np.random.RandomState(seed)
+    return 0.1 * rng.randn(samples)
+
+
+def reference_log_mel(data, sample_rate):
+    '''
+    log_mel_spectrogram as it was before caching, building everything on each call in float64
+    '''
+    window_length = int(round(sample_rate * 0.025))
+    hop_length = int(round(sample_rate * 0.010))
+    fft_length = 2 ** int(np.ceil(np.log(window_length) / np.log(2.0)))
+    frames = mel_features.frame(data, window_length, hop_length) * mel_features.periodic_hann(window_length)
+    spectrogram = np.abs(np.fft.rfft(frames, fft_length))
+    mel_matrix = mel_features.spectrogram_to_mel_matrix(
+        num_mel_bins=64, num_spectrogram_bins=spectrogram.shape[1], audio_sample_rate=sample_rate,
+        lower_edge_hertz=125.0, upper_edge_hertz=7500.0)
+    return np.log(np.dot(spectrogram, mel_matrix) + 0.01)
+
+
+def log_mel(data, **kwargs):
+    return mel_features.log_mel_spectrogram(data, audio_sample_rate=16000, log_offset=0.01, num_mel_bins=64,
+                                            lower_edge_hertz=125.0, upper_edge_hertz=7500.0, **kwargs)
+
+
+def test_float64_is_unchanged_by_caching():
+    data = waveform(16000)
+    expected = reference_log_mel(data, 16000)
+
+    # Twice, so the second call uses the cached window and filterbank
+    for _ in range(2):
+        result = log_mel(data, dtype='float64')
+        assert result.dtype == np.float64
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_cached_arrays_cant_be_changed():
+    log_mel(waveform(16000))
+    window = mel_features._cached_periodic_hann(400, np.float64)
+
+    with pytest.raises(ValueError):
+        window[0] = 1.0
+
+
+def test_float32_stays_close_to_float64():
+    data = waveform(16000)
+
+    result = log_mel(data, dtype='float32')
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, log_mel(data, dtype='float64'), atol=1e-4)
+
+
+def test_threaded_fft_gives_the_same_spectrogram():
+    pytest.importorskip('scipy.fft')
+    data = waveform(16000)
+
+    np.testing.assert_allclose(log_mel(data, dtype='float64', fft_workers=2), log_mel(data, dtype='float64'),
+                               atol=1e-9)
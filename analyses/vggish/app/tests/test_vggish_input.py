@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import vggish_input
+import vggish_params
+
+
+def waveform(secs, seed=0):
+    rng = np.random.RandomState(seed)
+    return (0.1 * rng.randn(int(secs * vggish_params.SAMPLE_RATE))).astype(np.float32)
+
+
+def stream(data, block_samples):
+    examples = vggish_input.StreamingExamples()
+    blocks = [examples.push(data[i:i + block_samples]) for i in range(0, len(data), block_samples)]
+    return np.concatenate(blocks)
+
+
+@pytest.mark.parametrize('block_samples', [7, 399, 401, 12345, 16001, 10 ** 6])
+def test_streaming_matches_the_whole_waveform(block_samples):
+    data = waveform(4.3)
+    expected = vggish_input.waveform_to_examples(data, vggish_params.SAMPLE_RATE)
+
+    streamed = stream(data, block_samples)
+
+    assert expected.shape[0] == 4
+    assert streamed.dtype == np.float32
+    assert streamed.shape == expected.shape
+    np.testing.assert_array_equal(streamed, expected)
+
+
+def test_short_blocks_complete_no_examples_until_an_example_fills():
+    examples = vggish_input.StreamingExamples()
+    data = waveform(1.5)
+
+    first = examples.push(data[:8000])
+    assert first.shape == (0, examples.example_window_length, vggish_params.NUM_MEL_BINS)
+    assert examples.push(data[8000:]).shape[0] == 1
+
+
+def test_polyphase_resampling_keeps_float32_at_the_target_rate():
+    data = waveform(1.0)
+    resampled = vggish_input.resample(data, vggish_params.SAMPLE_RATE, 48000, res_type='polyphase')
+    assert resampled.dtype == np.float32
+    assert len(resampled) == 48000
+    assert vggish_input.resample(data, 16000, 16000) is data
+
+
+def test_kaiser_resampling_matches_polyphase_closely():
+    pytest.importorskip('resampy')
+    data = waveform(1.0)
+    kaiser = vggish_input.resample(data, vggish_params.SAMPLE_RATE, 44100, res_type='kaiser_best')
+    polyphase = vggish_input.resample(data, vggish_params.SAMPLE_RATE, 44100, res_type='polyphase')
+    assert kaiser.dtype == np.float32
+    assert np.abs(kaiser - polyphase)[1000:-1000].max() < 0.01
@@ -15,27 +15,58 @@
 
 """Compute input examples for VGGish from audio waveform."""
 
-import numpy as np
-import resampy
-import librosa
+import os
+from math import gcd
 
-import matplotlib.pyplot as plt
+import numpy as np
 
 import mel_features
 import vggish_params
 
+# How audio is resampled to vggish_params.SAMPLE_RATE: 'kaiser_best' (resampy's best filter, as
+# before), 'kaiser_fast', 'polyphase' (scipy), or any other res_type the installed librosa has
+RESAMPLER = os.environ.get('BUGG_VGGISH_RESAMPLER', 'kaiser_best')
+
+
+def resample(data, sample_rate, target_rate, res_type=None):
+  """Resamples float32 audio with the chosen resampler, keeping it float32."""
+  res_type = res_type or RESAMPLER
+  if sample_rate == target_rate:
+    return data
+  if res_type in ('kaiser_best', 'kaiser_fast'):
+    import resampy
+    resampled = resampy.resample(data, sample_rate, target_rate, filter=res_type)
+  elif res_type == 'polyphase':
+    from scipy.signal import resample_poly
+    divisor = gcd(sample_rate, target_rate)
+    resampled = resample_poly(data, target_rate // divisor, sample_rate // divisor)
+  else:
+    import librosa
+    resampled = librosa.resample(data, orig_sr=sample_rate, target_sr=target_rate, res_type=res_type)
+  return resampled.astype(np.float32, copy=False)
+
+
 try:
-  def aud_f_read(aud_file):
-    aud_data, sr = librosa.load(aud_file)
+  import librosa
+
+  def aud_f_read(aud_file, sample_rate=vggish_params.SAMPLE_RATE, res_type=None):
+    """Decodes a file (or file-like object) to mono float32 at sample_rate.
+
+    The audio is resampled once, straight to the rate VGGish wants. Pass
+    sample_rate=None to keep the file's own rate.
+    """
+    aud_data, sr = librosa.load(aud_file, sr=None, dtype=np.float32)
+    if sample_rate is not None:
+      aud_data, sr = resample(aud_data, sr, sample_rate, res_type), sample_rate
     return aud_data, sr
 
 except ImportError:
 
-  def aud_f_read(aud_file):
+  def aud_f_read(aud_file, sample_rate=vggish_params.SAMPLE_RATE, res_type=None):
     raise NotImplementedError('Audio file reading requires librosa package.')
 
 
-def waveform_to_examples(data, sample_rate):
+def waveform_to_examples(data, sample_rate, res_type=None):
   """Converts audio waveform into an array of examples for VGGish.
 
   Args:
@@ -44,19 +75,21 @@ def waveform_to_examples(data, sample_rate):
       Each sample is generally expected to lie in the range [-1.0, +1.0],
       although this is not required.
     sample_rate: Sample rate of data.
+    res_type: Resampler to use if sample_rate isn't vggish_params.SAMPLE_RATE,
+      defaulting to RESAMPLER.
 
   Returns:
-    3-D np.array of shape [num_examples, num_frames, num_bands] which represents
+    3-D float32 np.array of shape [num_examples, num_frames, num_bands] which represents
     a sequence of examples, each of which contains a patch of log mel
     spectrogram, covering num_frames frames of audio and num_bands mel frequency
     bands, where the frame length is vggish_params.STFT_HOP_LENGTH_SECONDS.
   """
+  data = np.asarray(data, dtype=np.float32)
   # Convert to mono.
   if len(data.shape) > 1:
     data = np.mean(data, axis=1)
   # Resample to the rate assumed by VGGish.
-  if sample_rate != vggish_params.SAMPLE_RATE:
-    data = resampy.resample(data, sample_rate, vggish_params.SAMPLE_RATE)
+  data = resample(data, sample_rate, vggish_params.SAMPLE_RATE, res_type)
 
   # Compute log mel spectrogram features.
   log_mel = mel_features.log_mel_spectrogram(
@@ -79,7 +112,74 @@ def waveform_to_examples(data, sample_rate):
       log_mel,
       window_length=example_window_length,
       hop_length=example_hop_length)
-  return log_mel_examples
+  # The model takes float32, and the examples are the biggest thing held per clip
+  return log_mel_examples.astype(np.float32, copy=False)
+
+
+class StreamingExamples(object):
+  """Streaming version of waveform_to_examples, for recordings too long to hold in full.
+
+  Carries the samples of the last, incomplete STFT window and the log mel frames
+  of the last, incomplete example over to the next block, so the examples come
+  out exactly as waveform_to_examples would compute them from the same samples
+  joined up. Blocks must already be at vggish_params.SAMPLE_RATE, as resampling
+  each block on its own couldn't match resampling the whole.
+  """
+
+  def __init__(self):
+    sample_rate = vggish_params.SAMPLE_RATE
+    self.window_length = int(round(sample_rate * vggish_params.STFT_WINDOW_LENGTH_SECONDS))
+    self.hop_length = int(round(sample_rate * vggish_params.STFT_HOP_LENGTH_SECONDS))
+    features_sample_rate = 1.0 / vggish_params.STFT_HOP_LENGTH_SECONDS
+    self.example_window_length = int(round(
+        vggish_params.EXAMPLE_WINDOW_SECONDS * features_sample_rate))
+    self.example_hop_length = int(round(
+        vggish_params.EXAMPLE_HOP_SECONDS * features_sample_rate))
+
+    self._samples = np.zeros(0, dtype=np.float32)
+    self._log_mel = np.zeros((0, vggish_params.NUM_MEL_BINS), dtype=mel_features.COMPUTE_DTYPE)
+
+  def push(self, block):
+    """Adds the next block of mono samples, of any length.
+
+    Returns:
+      3-D float32 np.array of shape [num_examples, num_frames, num_bands] of the
+      examples the block completed, which may be none.
+    """
+    samples = np.concatenate([self._samples, np.asarray(block, dtype=np.float32)])
+    num_frames = 1 + (len(samples) - self.window_length) // self.hop_length
+    if num_frames < 1:
+      self._samples = samples
+      return self._no_examples()
+
+    block_log_mel = mel_features.log_mel_spectrogram(
+        samples[:(num_frames - 1) * self.hop_length + self.window_length],
+        audio_sample_rate=vggish_params.SAMPLE_RATE,
+        log_offset=vggish_params.LOG_OFFSET,
+        window_length_secs=vggish_params.STFT_WINDOW_LENGTH_SECONDS,
+        hop_length_secs=vggish_params.STFT_HOP_LENGTH_SECONDS,
+        num_mel_bins=vggish_params.NUM_MEL_BINS,
+        lower_edge_hertz=vggish_params.MEL_MIN_HZ,
+        upper_edge_hertz=vggish_params.MEL_MAX_HZ)
+    # The next window starts num_frames hops in
+    self._samples = samples[num_frames * self.hop_length:]
+
+    log_mel = np.concatenate([self._log_mel, block_log_mel])
+    num_examples = 1 + (len(log_mel) - self.example_window_length) // self.example_hop_length
+    if num_examples < 1:
+      self._log_mel = log_mel
+      return self._no_examples()
+
+    examples = mel_features.frame(
+        log_mel[:(num_examples - 1) * self.example_hop_length + self.example_window_length],
+        window_length=self.example_window_length,
+        hop_length=self.example_hop_length)
+    self._log_mel = log_mel[num_examples * self.example_hop_length:]
+    # Copied out of log_mel, which frame() returns a view of
+    return examples.astype(np.float32)
+
+  def _no_examples(self):
+    return np.zeros((0, self.example_window_length, vggish_params.NUM_MEL_BINS), dtype=np.float32)
 
 
 def aud_file_to_examples(aud_file):
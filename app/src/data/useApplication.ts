@@ -12,6 +12,7 @@ import {
   Analysis,
   AudioRecord,
   DetectedAudioSegment,
+  Detection,
   Recorder,
 } from "../../types";
 import { useSetLoading } from "../components/LoadingBar";
@@ -208,6 +209,32 @@ export const dateRangeAtom = atom({
   },
 });
 
+/***
+ * Reads in the detections the analyses stored in the audio/{id}/detections subcollection.
+ * Records that have them have detectionCounts, the others are returned as they are.
+ */
+async function withSubcollectionDetections(
+  snap: firebase.firestore.QueryDocumentSnapshot
+): Promise<AudioRecord> {
+  let audio = snap.data() as AudioRecord;
+  let detectionCounts = audio.detectionCounts;
+  if (!detectionCounts) {
+    return audio;
+  }
+
+  let detectionSnaps = await snap.ref.collection("detections").get();
+  // detections left on the record by an analysis that has since run again are in the subcollection now
+  let onRecord = (audio.detections || []).filter(
+    (d) => !(d.analysisId in detectionCounts!)
+  );
+  return {
+    ...audio,
+    detections: onRecord.concat(
+      detectionSnaps.docs.map((d) => d.data() as Detection)
+    ),
+  };
+}
+
 /***
  * Loads in everything setting up the data to run the dashboard and other screens
  */
@@ -229,6 +256,7 @@ export function useApplication(projectId: string) {
     ) {
       return;
     }
+    let latestSnapshot = 0;
     let unsub = firebase
       .firestore()
       .collection(`audio`)
@@ -239,12 +267,24 @@ export function useApplication(projectId: string) {
       .orderBy("uploadedAt", "desc")
       .onSnapshot(
         (snaps) => {
-          let audio = snaps.docs.map((d) => d.data() as AudioRecord);
-          setAllAudio(audio);
-
-          if (audio.length === 0) {
-            setLoading(false);
-          }
+          let snapshot = ++latestSnapshot;
+          Promise.all(snaps.docs.map(withSubcollectionDetections))
+            .then((audio) => {
+              // a newer snapshot came in while these detections were loading
+              if (snapshot !== latestSnapshot) {
+                return;
+              }
+              setAllAudio(audio);
+
+              if (audio.length === 0) {
+                setLoading(false);
+              }
+            })
+            .catch((err) => {
+              console.error("get detections error", err);
+              // error, try reloading
+              setReloadKey(new Date().toISOString());
+            });
         },
         (err) => {
           console.error("get audio error", err);
@@ -254,6 +294,8 @@ export function useApplication(projectId: string) {
       );
 
     return () => {
+      // drops any detections still loading for the last snapshot
+      latestSnapshot = -1;
       unsub();
     };
   }, [projectId, setReloadKey, reloadKey, setAllAudio, dateRange, setLoading]);
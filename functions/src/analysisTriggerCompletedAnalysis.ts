@@ -63,6 +63,12 @@ export const analysisTriggerCompletedAnalysis = functions
       );
 
       for (let a of analyses) {
+        // Analyses run in the same process as the one they follow (see analyses/fused) finish alongside it
+        if (analysesPerformedAfterSet.has(a.id)) {
+          console.log(`${a.id} has already been performed on ${audioRecAfter.id}`);
+          continue;
+        }
+
         if (a.url) {
           await dispatchTask(a, audioRecAfter, completedAnalysisId);
         }
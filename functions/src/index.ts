@@ -4,6 +4,7 @@ import { analysisTriggerNewAudio } from "./analysisTriggerNewAudio";
 import { giveUserProjectClaims } from "./giveUserProjectClaims";
 import { magicLink } from "./magicLink";
 import { onAudioRecordChanged } from "./onAudioRecordChanged";
+import { onDetectionCreated } from "./onDetectionCreated";
 import { onExportRequested } from "./onExportRequested";
 import { onNewAudioFile } from "./onNewAudioFile";
 import { onNewUser } from "./onNewUser";
@@ -24,6 +25,7 @@ module.exports.onNewUser = onNewUser;
 module.exports.onUploadFromBugg = onUploadFromBugg;
 module.exports.magicLink = magicLink;
 module.exports.onAudioRecordChanged = onAudioRecordChanged;
+module.exports.onDetectionCreated = onDetectionCreated;
 module.exports.onExportRequested = onExportRequested;
 module.exports.processAnomalyFitModelRequests = processAnomalyFitModelRequests;
 
@@ -0,0 +1,45 @@
+/***
+ * Send detections stored in the audio record's detections subcollection to be clipped
+ *
+ * Detections kept in the `detections` array on the audio record are picked up by onAudioRecordChanged
+ *
+ * hello-world has always written a sample detection to the subcollection, which isn't worth clipping
+ */
+
+import * as PubSub from "@google-cloud/pubsub";
+import * as functions from "firebase-functions";
+import { Detection } from "./types";
+
+// Analyses whose detections are only examples, and are never sent to clippy
+const UNCLIPPED_ANALYSES = new Set(["hello-world"]);
+
+export const onDetectionCreated = functions
+  .region("europe-west2")
+  .firestore.document(`audio/{audioId}/detections/{detectionId}`)
+  .onCreate(async (snapshot, context) => {
+    let { audioId, detectionId } = context.params;
+
+    let detection = snapshot.data() as Detection;
+    if (detection.uri) {
+      return;
+    }
+    if (!detection.analysisId || UNCLIPPED_ANALYSES.has(detection.analysisId)) {
+      console.log(
+        `Not clipping ${audioId} ${detectionId} from ${detection.analysisId}`
+      );
+      return;
+    }
+
+    let client = new PubSub.PubSub();
+    let messageId = await client.topic("clippy").publish(
+      Buffer.from(
+        JSON.stringify({
+          audioId: audioId,
+          detectionId: detectionId,
+        })
+      )
+    );
+    console.log(
+      `Published ${audioId} ${detectionId} to be clipped. Message ID = ${messageId}`
+    );
+  });
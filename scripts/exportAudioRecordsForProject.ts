@@ -1,5 +1,6 @@
 import * as admin from "firebase-admin";
 import * as Papa from "papaparse";
+import { getDetections } from "./getDetections";
 import { AudioRecord } from "./types";
 
 require("./initFirebase");
@@ -43,6 +44,7 @@ async function run() {
         let downloadLinkPrefix = `https://bugg-301712.web.app/download/${
           record.downloadToken || "MISSIGNO"
         }`;
+        let detections = await getDetections(snap);
 
         items.push({
           audio_id: record.id,
@@ -61,8 +63,8 @@ async function run() {
           )}`,
 
           has_detections: record.hasDetections === true,
-          detections_count: record.detections.length || 0,
-          detections: record.detections.map((d) =>
+          detections_count: detections.length,
+          detections: detections.map((d) =>
             d.tags.map((t) => `${d.analysisId}:${t}`).join(", ")
           ),
 
@@ -1,5 +1,6 @@
 import * as admin from "firebase-admin";
 import * as Papa from "papaparse";
+import { getDetections } from "./getDetections";
 import { AudioRecord } from "./types";
 
 require("./initFirebase");
@@ -42,7 +43,7 @@ async function run() {
           continue;
         }
 
-        for (let detection of record.detections) {
+        for (let detection of await getDetections(snap)) {
           count = count + 1;
           let downloadLinkPrefix = `https://bugg-301712.web.app/download/${
             record.downloadToken || "MISSIGNO"
@@ -0,0 +1,23 @@
+import * as admin from "firebase-admin";
+import { AudioRecord, Detection } from "./types";
+
+/***
+ * The record's detections, including those the analyses stored in its audio/{id}/detections
+ * subcollection. Only records with detectionCounts have any there.
+ */
+export async function getDetections(
+  snap: admin.firestore.QueryDocumentSnapshot
+): Promise<Detection[]> {
+  let record = snap.data() as AudioRecord;
+  let detections = record.detections || [];
+  let detectionCounts = record.detectionCounts;
+  if (!detectionCounts) {
+    return detections;
+  }
+
+  let detectionSnaps = await snap.ref.collection("detections").get();
+  // detections left on the record by an analysis that has since run again are in the subcollection now
+  return detections
+    .filter((d) => !(d.analysisId in detectionCounts!))
+    .concat(detectionSnaps.docs.map((d) => d.data() as Detection));
+}
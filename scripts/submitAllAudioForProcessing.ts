@@ -2,7 +2,11 @@ require("./initFirebase");
 import * as PubSub from "@google-cloud/pubsub";
 import * as admin from "firebase-admin";
 
-const TOPIC = "projects/bugg-301712/topics/analyses.anomaly-detection";
+// Set BUGG_BULK_LANE=1 to send the backfill to the bulk lane, so it doesn't hold up new uploads.
+// The workers need BUGG_BULK_LANE=1 too, see analyses/bugg-runtime/README.md
+const TOPIC =
+  "projects/bugg-301712/topics/analyses.anomaly-detection" +
+  (process.env.BUGG_BULK_LANE === "1" ? ".bulk" : "");
 
 let client = new PubSub.PubSub();
 
@@ -48,6 +48,10 @@ export interface AudioRecord {
   // True if something has been detected in this audio sample
   hasDetections?: boolean;
   detections?: Detection[];
+  // Set when detections are stored in the audio/{id}/detections subcollection instead of the array above.
+  // detectionCount is removed by union mode completions, which can't total the counts, so sum detectionCounts if it's missing
+  detectionCount?: number;
+  detectionCounts?: { [analysisId: string]: number };
 
   metadata: any;
 